@@ -0,0 +1,193 @@
+from threading import Lock
+from collections import OrderedDict, deque
+from time import monotonic
+from metrics import Histogram
+
+
+ADMISSION_WAIT_SECONDS = Histogram('overcooked_admission_wait_seconds', "Time a game creation request spent queued for server capacity", buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+
+
+class CapacityError(RuntimeError):
+    """
+    Raised (returned) by game creation when every game id is in use, or the server has no CPU or memory budget left
+    """
+    pass
+
+
+class Admission(object):
+    """
+    A queued request by `user_id` to create a `game_name` game with `params`
+    """
+
+    def __init__(self, user_id, game_name, params, priority, timeout):
+        self.user_id = user_id
+        self.game_name = game_name
+        self.params = params
+        self.priority = priority
+        self.enqueued_at = monotonic()
+        self.deadline = self.enqueued_at + timeout
+
+    def waited(self):
+        return monotonic() - self.enqueued_at
+
+
+class AdmissionQueue(object):
+    """
+    Queue of game creation requests waiting for server capacity, served in order of priority class (lower is served
+    first) then arrival. A user has at most one queued request, and re-queueing keeps its original place. Requests
+    only held back by the limit of their own capacity pool don't hold up other pools (see `admit`)
+
+    The throughput of the queue is estimated from the times at which the last `history` games were cleaned up, and
+    used to give every request an estimated time until admission
+
+    Instance variables:
+        - classes (dict): Maps each priority to an OrderedDict of user_id -> Admission, oldest first
+        - releases (deque(float)): Times at which recent games were cleaned up
+        - scheduled (bool): Whether a job pushing queue updates to clients is running (see `needs_updates`)
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, timeout=300, history=20):
+        self.timeout = timeout
+        self.lock = Lock()
+        self.classes = {}
+        self.users = {}
+        self.releases = deque(maxlen=history)
+        self.scheduled = False
+        self.num_admitted = 0
+        self.num_expired = 0
+        self.num_cancelled = 0
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def put(self, user_id, game_name, params, priority=0):
+        """
+        Queues a request unless `user_id` already has one. Returns whether a job pushing updates to clients needs to be
+        started, i.e. no such job is currently running
+        """
+        with self.lock:
+            if user_id not in self.users:
+                admission = Admission(user_id, game_name, params, priority, self.timeout)
+                self.classes.setdefault(priority, OrderedDict())[user_id] = admission
+                self.users[user_id] = admission
+            start_updates = not self.scheduled
+            self.scheduled = True
+            return start_updates
+
+    def remove(self, user_id):
+        """
+        Cancels the request of `user_id`. Returns whether it had one
+        """
+        with self.lock:
+            removed = self._pop(user_id) is not None
+            if removed:
+                self.num_cancelled += 1
+            return removed
+
+    def record_release(self):
+        """
+        Called whenever a game is cleaned up, to estimate throughput
+        """
+        with self.lock:
+            self.releases.append(monotonic())
+
+    def admit(self, reserve, pool_of=None, pool_full=None):
+        """
+        Offers queued requests, in order, to `reserve(admission)`, which returns the resources (i.e. a game id) it will
+        be served with, or None if they are not available yet. Returns (admission, resources) for the first request
+        that was admitted (and so dequeued) and (None, None) if there was none
+
+        A request that needs more of the shared resources than are free is never skipped, so it holds up the ones
+        behind it rather than waiting forever while cheaper ones overtake it. If given, `pool_of(admission)` names the
+        pool a request draws from and `pool_full(admission)` tells whether a request that could not be reserved is only
+        held back by the limit of its own pool. Holding up other pools can't help such a request, so it is passed over
+        along with every later request of the same pool, which keeps each pool served in order
+        """
+        with self.lock:
+            full_pools = set()
+            for admission in self._queued():
+                pool = pool_of(admission) if pool_of else None
+                if pool is not None and pool in full_pools:
+                    continue
+                resources = reserve(admission)
+                if resources is not None:
+                    break
+                if pool is None or not pool_full(admission):
+                    return None, None
+                full_pools.add(pool)
+            else:
+                return None, None
+            self._pop(admission.user_id)
+            self.num_admitted += 1
+        ADMISSION_WAIT_SECONDS.observe(admission.waited())
+        return admission, resources
+
+    def expire(self):
+        """
+        Removes and returns every request that has been waiting for longer than `timeout`
+        """
+        now = monotonic()
+        with self.lock:
+            expired = [admission for admission in self.users.values() if admission.deadline <= now]
+            for admission in expired:
+                self._pop(admission.user_id)
+            self.num_expired += len(expired)
+            return expired
+
+    def positions(self):
+        """
+        Returns [(Admission, position)] for every queued request, where position 1 is the next to be admitted
+        """
+        with self.lock:
+            queued = list(self._queued())
+        return [(admission, position) for position, admission in enumerate(queued, 1)]
+
+    def eta(self, position):
+        """
+        Estimated number of seconds until the request at `position` is admitted, or None if there is no estimate yet
+        """
+        releases = list(self.releases)
+        if len(releases) < 2 or releases[-1] == releases[0]:
+            return None
+        interval = (releases[-1] - releases[0]) / (len(releases) - 1)
+        return max(position * interval - (monotonic() - releases[-1]), 0)
+
+    def needs_updates(self):
+        """
+        Called by the job pushing updates to clients. Returns False, and marks the job as stopped, once the queue is empty
+        """
+        with self.lock:
+            self.scheduled = bool(self.users)
+            return self.scheduled
+
+    def _queued(self):
+        # Must be called while holding self.lock. Yields every queued request in the order they are served in
+        for priority in sorted(self.classes):
+            yield from self.classes[priority].values()
+
+    def _pop(self, user_id):
+        # Must be called while holding self.lock
+        admission = self.users.pop(user_id, None)
+        if admission is None:
+            return None
+        queued = self.classes[admission.priority]
+        del queued[user_id]
+        if not queued:
+            del self.classes[admission.priority]
+        return admission
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "queued" : len(self.users),
+                "queued_by_priority" : { priority : len(queued) for priority, queued in self.classes.items() },
+                "admitted" : self.num_admitted,
+                "expired" : self.num_expired,
+                "cancelled" : self.num_cancelled,
+                "eta_per_position" : self.eta(1)
+            }
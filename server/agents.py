@@ -0,0 +1,156 @@
+from threading import Lock
+from collections import OrderedDict
+from time import monotonic
+import copy, json, os
+
+# Optional per-agent metadata file, relative to the agent's directory
+AGENT_METADATA_FILE = 'metadata.json'
+
+
+class AgentCache(object):
+    """
+    Process-wide cache of loaded agents. Every agent is loaded at most once (until evicted) and each game receives
+    its own cheap instance derived from the cached one
+
+    Instances are derived as follows:
+        - RLlib agents (anything with a `policy` attribute) are shallow copied, so the expensive policy/model is shared
+          while per-game fields (`agent_index`, `rnn_state`) stay independent. `agent_index` is set to the requested index
+        - Every other agent is deep copied, since scripted agents are small and may carry arbitrary internal state
+
+    Cached agents are evicted in least-recently-used order once the estimated size of all cached agents exceeds
+    `max_bytes`. The size of an agent is estimated by the on-disk size of its directory in AGENT_DIR
+
+    Each agent's metadata (see `load_agent_metadata`) is read along with it, or by `get_metadata` for agents that are
+    loaded elsewhere (i.e. in policy worker processes), and kept for the life of the process. So is the lock serializing
+    loads of each agent: another thread may still hold or wait on it when the agent is evicted, and dropping it would let
+    a later `get` load the same agent concurrently. Both are bounded by the number of agents in AGENT_DIR
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, loader, max_bytes=2 * 1024 ** 3):
+        """
+        loader (callable):  loader(agent_dir, npc_id, idx) returns a freshly loaded agent
+        max_bytes (int):    Memory budget for all cached agents combined
+        """
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.agents = OrderedDict()
+        self.lock = Lock()
+        self.key_locks = {}
+        self.metadata = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0
+
+    def get(self, agent_dir, npc_id, idx=0):
+        """
+        Returns a per-game instance of agent `npc_id`, loading it first if necessary
+        """
+        key = (agent_dir, npc_id)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, Lock())
+
+        # Serialize loads of the same agent, but let different agents load concurrently
+        with key_lock:
+            with self.lock:
+                entry = self.agents.get(key, None)
+                if entry:
+                    self.hits += 1
+                    self.agents.move_to_end(key)
+            if not entry:
+                entry = self._load(key, agent_dir, npc_id, idx)
+        return self._instance(entry[0], idx)
+
+    def get_metadata(self, agent_dir, npc_id):
+        """
+        Returns the metadata of agent `npc_id`, only reading it from disk the first time
+        """
+        key = (agent_dir, npc_id)
+        with self.lock:
+            metadata = self.metadata.get(key, None)
+        if metadata is None:
+            metadata = load_agent_metadata(agent_dir, npc_id)
+            with self.lock:
+                self.metadata[key] = metadata
+        return metadata
+
+    def preload(self, agent_dir, npc_ids):
+        """
+        Eagerly load every agent in `npc_ids`. Agents that fail to load are skipped and reported in the returned dict
+        """
+        errors = {}
+        for npc_id in npc_ids:
+            try:
+                self.get(agent_dir, npc_id)
+            except Exception as e:
+                errors[npc_id] = e
+        return errors
+
+    def _load(self, key, agent_dir, npc_id, idx):
+        start = monotonic()
+        agent = self.loader(agent_dir, npc_id, idx)
+        size = _dir_size(os.path.join(agent_dir, npc_id))
+        metadata = load_agent_metadata(agent_dir, npc_id)
+        with self.lock:
+            self.metadata[key] = metadata
+            self.misses += 1
+            self.load_time += monotonic() - start
+            self.agents[key] = (agent, size)
+            self._evict()
+            return (agent, size)
+
+    def _evict(self):
+        # Always keep the most recently used agent, even if it alone exceeds the budget
+        while len(self.agents) > 1 and self.num_bytes > self.max_bytes:
+            self.agents.popitem(last=False)
+            self.evictions += 1
+
+    def _instance(self, agent, idx):
+        if hasattr(agent, 'policy'):
+            instance = copy.copy(agent)
+            if hasattr(instance, 'agent_index'):
+                instance.agent_index = idx
+            return instance
+        return copy.deepcopy(agent)
+
+    @property
+    def num_bytes(self):
+        return sum(size for _, size in self.agents.values())
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "agents" : [npc_id for _, npc_id in self.agents],
+                "bytes" : self.num_bytes,
+                "max_bytes" : self.max_bytes,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "total_load_time" : self.load_time,
+                "mean_load_time" : self.load_time / self.misses if self.misses else 0
+            }
+
+
+def load_agent_metadata(agent_dir, npc_id):
+    """
+    Returns the contents of the agent's metadata file, or an empty dict if it has none. Recognized keys:
+        - min_ticks_per_action (int): Never query the agent more often than once every this many ticks
+        - max_ticks_per_action (int): Never query the agent less often than once every this many ticks
+    """
+    path = os.path.join(agent_dir, npc_id, AGENT_METADATA_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
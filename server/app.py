@@ -5,20 +5,29 @@ if os.getenv('FLASK_ENV', 'production') == 'production':
     eventlet.monkey_patch()
 
 # All other imports must come after patch to ensure eventlet compatibility
-import pickle, queue, atexit, json, logging
+import pickle, atexit, json, logging
 from threading import Lock
-from utils import ThreadSafeSet, ThreadSafeDict
-from flask import Flask, render_template, jsonify, request
+from time import monotonic
+from functools import partial
+from utils import LifecycleMonitor
+from registry import GameRegistry, ShardedDict
+from scheduler import TickScheduler
+from gameloop import GameLoop
+from shards import GameShardPool
+from lobby import Lobby, lobby_key
+from admission import AdmissionQueue, CapacityError
+from capacity import CapacityManager, estimate_game_cost
+from flask import Flask, render_template, jsonify, request, Response
 from flask_socketio import SocketIO, join_room, leave_room, emit
-from game import OvercookedGame, OvercookedTutorial, Game, OvercookedPsiturk
-import game
+from game import OvercookedGame, OvercookedTutorial, Game, OvercookedPsiturk, get_game_detail
+import game, gameloop, planner_cache, metrics
+from metrics import Gauge, EMIT_SECONDS, CREATE_GAME_SECONDS, CREATE_GAME_FAILURES
 
 
 ### Thoughts -- where I'll log potential issues/ideas as they come up
 # Should make game driver code more error robust -- if overcooked randomlly errors we should catch it and report it to user
 # Right now, if one user 'join's before other user's 'join' finishes, they won't end up in same game
 # Could use a monitor on a conditional to block all global ops during calls to _ensure_consistent_state for debugging
-# Could cap number of sinlge- and multi-player games separately since the latter has much higher RAM and CPU usage
 
 ###########
 # Globals #
@@ -44,44 +53,153 @@ MAX_GAME_LENGTH = CONFIG['MAX_GAME_LENGTH']
 # Path to where pre-trained agents will be stored on server
 AGENT_DIR = CONFIG['AGENT_DIR']
 
-# Maximum number of games that can run concurrently. Contrained by available memory and CPU
+# Maximum number of games that can exist concurrently. Games are admitted against the CPU and memory budgets below,
+# so this is only a hard cap on the number of (i.e. very cheap) games
 MAX_GAMES = CONFIG['MAX_GAMES']
 
+# CPU (in cores) and memory (in MB) available to games. Every game's cost is estimated from its configuration using the
+# unit costs in GAME_COSTS (per game, per scripted NPC, per RLlib NPC and for showPotential), and a game is only
+# created once its cost fits in what is left of both budgets. CAPACITY_POOL_LIMITS optionally caps the fraction of the
+# budgets usable by a cost class ('human', 'scripted' or 'rllib', see capacity.py)
+CAPACITY_CPU_CORES = CONFIG['CAPACITY_CPU_CORES']
+CAPACITY_MEMORY_MB = CONFIG['CAPACITY_MEMORY_MB']
+CAPACITY_POOL_LIMITS = CONFIG['CAPACITY_POOL_LIMITS']
+GAME_COSTS = CONFIG['GAME_COSTS']
+
 # Frames per second cap for serving to client
 MAX_FPS = CONFIG['MAX_FPS']
 
+# Whether `state_pong` broadcasts should only carry the changes since the previous broadcast
+STATE_DELTAS = CONFIG['STATE_DELTAS']
+
+# Number of `state_pong` broadcasts between full-state keyframes when STATE_DELTAS is enabled
+KEYFRAME_INTERVAL = CONFIG['KEYFRAME_INTERVAL']
+
+# How the game loop absorbs ticks that run late. One of 'catch_up', 'skip_broadcasts' or 'sleep' (see utils.TickClock)
+TICK_POLICY = CONFIG['TICK_POLICY']
+
+# Maximum number of missed ticks a game loop will try to make up before dropping them
+MAX_CATCH_UP_TICKS = CONFIG['MAX_CATCH_UP_TICKS']
+
+# Length (in milliseconds) of a tick scheduler slot. Games whose ticks are due within the same slot are stepped together
+TICK_SLOT_MS = CONFIG['TICK_SLOT_MS']
+
+# How NPC actions are computed. 'threads' runs every NPC on a shared pool of NPC_THREADS threads, 'batched' shares one
+# forward pass across all games using the same agent, and 'process' runs agents in separate worker processes. 'threads'
+# is the default, as a hung policy cannot stall the agents sharing its batch or worker process (see NpcWorkerPool)
+NPC_INFERENCE = CONFIG['NPC_INFERENCE']
+
+# Maximum time (in milliseconds) the batched inference service waits to fill a batch before running it
+INFERENCE_BATCH_LATENCY_MS = CONFIG['INFERENCE_BATCH_LATENCY_MS']
+
+# Maximum number of NPC states evaluated in a single batched forward pass
+INFERENCE_MAX_BATCH_SIZE = CONFIG['INFERENCE_MAX_BATCH_SIZE']
+
+# Number of worker processes hosting NPC policies when NPC_INFERENCE is 'process'
+NPC_PROCESSES = CONFIG['NPC_PROCESSES']
+
+# Number of threads shared by all NPCs not served by the batched service or worker processes (i.e. every NPC when
+# NPC_INFERENCE is 'threads', and agents that cannot be batched or moved to a worker process, i.e. scripted ones, otherwise)
+NPC_THREADS = CONFIG['NPC_THREADS']
+
+# An NPC that has not produced an action NPC_DEADLINE_MS after being asked plays NPC_FALLBACK_ACTION ("stay" or "last",
+# i.e. repeat its previous action) instead. Agents missing NPC_MAX_MISSES deadlines in a row are quarantined, i.e. not
+# queried at all, for NPC_QUARANTINE_S seconds. Actions slower than NPC_SLO_MS are counted as latency SLO violations
+NPC_DEADLINE_MS = CONFIG['NPC_DEADLINE_MS']
+NPC_SLO_MS = CONFIG['NPC_SLO_MS']
+NPC_FALLBACK_ACTION = CONFIG['NPC_FALLBACK_ACTION']
+NPC_MAX_MISSES = CONFIG['NPC_MAX_MISSES']
+NPC_QUARANTINE_S = CONFIG['NPC_QUARANTINE_S']
+
+# Whether the number of ticks between NPC forward passes adapts to each agent's measured latency. NPCs are queried at
+# most as often as their game's ticks_per_ai_action and at least once every NPC_MAX_TICKS_PER_ACTION ticks, spending
+# no more than NPC_CPU_BUDGET of that interval computing. Both bounds can be overridden in an agent's metadata.json
+ADAPTIVE_NPC_CADENCE = CONFIG['ADAPTIVE_NPC_CADENCE']
+NPC_CPU_BUDGET = CONFIG['NPC_CPU_BUDGET']
+NPC_MAX_TICKS_PER_ACTION = CONFIG['NPC_MAX_TICKS_PER_ACTION']
+
+# Memory budget (in MB, estimated from agent size on disk) for agents kept loaded between games
+AGENT_CACHE_MB = CONFIG['AGENT_CACHE_MB']
+
+# Agents to load at startup rather than on first use
+PRELOAD_AGENTS = CONFIG['PRELOAD_AGENTS']
+
+# Where precomputed MotionPlanners (used for potential display) are persisted between restarts
+PLANNER_CACHE_DIR = CONFIG['PLANNER_CACHE_DIR']
+
+# Whether to compute any missing MotionPlanners for all configured layouts at startup (see planner_cache.py)
+PRECOMPUTE_PLANNERS = CONFIG['PRECOMPUTE_PLANNERS']
+
+# Maximum number of times per second a game's state potential is recomputed when showPotential is enabled
+POTENTIAL_MAX_RATE = CONFIG['POTENTIAL_MAX_RATE']
+
+# Psiturk trajectories are appended to a per-game file in this directory once more than TRAJECTORY_MAX_BUFFERED
+# transitions are held in memory, and read back when the data is sent to the client. Set to null to never spill
+TRAJECTORY_SPILL_DIR = CONFIG['TRAJECTORY_SPILL_DIR']
+TRAJECTORY_MAX_BUFFERED = CONFIG['TRAJECTORY_MAX_BUFFERED']
+
+# Psiturk trajectories are uploaded to clients during play, every TRAJECTORY_UPLOAD_INTERVAL seconds, in chunks of at
+# most TRAJECTORY_CHUNK_ROWS transitions. Chunks not acknowledged within TRAJECTORY_ACK_TIMEOUT seconds are re-sent
+TRAJECTORY_CHUNK_ROWS = CONFIG['TRAJECTORY_CHUNK_ROWS']
+TRAJECTORY_UPLOAD_INTERVAL = CONFIG['TRAJECTORY_UPLOAD_INTERVAL']
+TRAJECTORY_ACK_TIMEOUT = CONFIG['TRAJECTORY_ACK_TIMEOUT']
+
+# Number of games listed per page by `/debug/summary`, unless the request sets `limit`
+DEBUG_PAGE_SIZE = CONFIG['DEBUG_PAGE_SIZE']
+
+# Maximum time (in milliseconds) a debug snapshot waits for in-flight game transitions before reading the registries anyway
+DEBUG_SNAPSHOT_TIMEOUT_MS = CONFIG['DEBUG_SNAPSHOT_TIMEOUT_MS']
+
+# When every game id is in use, requests to create a game wait (for at most ADMISSION_TIMEOUT_S seconds) in a queue
+# served by priority class, lowest first. Game names missing from ADMISSION_PRIORITIES are served last. Queued clients
+# are sent their position and estimated wait every ADMISSION_UPDATE_INTERVAL_S seconds. Set ADMISSION_TIMEOUT_S to 0
+# to fail creation immediately instead
+ADMISSION_TIMEOUT_S = CONFIG['ADMISSION_TIMEOUT_S']
+ADMISSION_UPDATE_INTERVAL_S = CONFIG['ADMISSION_UPDATE_INTERVAL_S']
+ADMISSION_PRIORITIES = CONFIG['ADMISSION_PRIORITIES']
+ADMISSION_DEFAULT_PRIORITY = max(ADMISSION_PRIORITIES.values(), default=0) + 1
+
+# Number of independently locked shards the game and user registries are split into
+REGISTRY_SHARDS = CONFIG['REGISTRY_SHARDS']
+
+# Number of worker processes games (and their game loops) are run in, so that simulating them is spread over several
+# cores. This process then only handles sockets and forwards game updates to and from the workers. Set to 0 to run
+# games in this process. Note that the CAPACITY budgets above are for the whole host
+GAME_PROCESSES = CONFIG['GAME_PROCESSES']
+
 # Default configuration for psiturk experiment
 PSITURK_CONFIG = json.dumps(CONFIG['psiturk'])
 
 # Default configuration for tutorial
 TUTORIAL_CONFIG = json.dumps(CONFIG['tutorial'])
 
-# Global queue of available IDs. This is how we synch game creation and keep track of how many games are in memory
-FREE_IDS = queue.Queue(maxsize=MAX_GAMES)
-
-# Bitmap that indicates whether ID is currently in use. Game with ID=i is "freed" by setting FREE_MAP[i] = True
-FREE_MAP = ThreadSafeDict()
-
-# Initialize our ID tracking data
-for i in range(MAX_GAMES):
-    FREE_IDS.put(i)
-    FREE_MAP[i] = True
+# Lifecycle state (free, reserved, waiting or active) of each of the MAX_GAMES game ids, and the game object of every id
+# in use. This is how we synch game creation and keep track of how many games are in memory
+REGISTRY = GameRegistry(MAX_GAMES, num_shards=REGISTRY_SHARDS)
 
-# Mapping of game-id to game objects
-GAMES = ThreadSafeDict()
+# Index of the IDs of games that are waiting for additional players to join, by game configuration
+LOBBY = Lobby()
 
-# Set of games IDs that are currently being played
-ACTIVE_GAMES = ThreadSafeSet()
+# Users waiting for a free game id and enough CAPACITY to create their game with
+ADMISSIONS = AdmissionQueue(timeout=ADMISSION_TIMEOUT_S)
 
-# Queue of games IDs that are waiting for additional players to join. Note that some of these IDs might
-# be stale (i.e. if FREE_MAP[id] = True)
-WAITING_GAMES = queue.Queue()
+# CPU and memory reserved by every game id in use
+CAPACITY = CapacityManager(CAPACITY_CPU_CORES, CAPACITY_MEMORY_MB, pool_limits=CAPACITY_POOL_LIMITS)
 
 # Mapping of users to locks associated with the ID. Enforces user-level serialization
-USERS = ThreadSafeDict()
+USERS = ShardedDict(REGISTRY_SHARDS)
 
 # Mapping of user id's to the current game (room) they are in
-USER_ROOMS = ThreadSafeDict()
+USER_ROOMS = ShardedDict(REGISTRY_SHARDS)
+
+# Mapping of game-id to the StateDeltaEncoder tracking what was last broadcast to that room
+STATE_ENCODERS = ShardedDict(REGISTRY_SHARDS)
+
+# Mapping of game-id to the TickClock pacing that game's loop. Used to report achieved tick rates
+GAME_CLOCKS = ShardedDict(REGISTRY_SHARDS)
+
+# Tracks create/join/leave/teardown transitions so that debug snapshots never observe one half done
+LIFECYCLE = LifecycleMonitor()
 
 # Mapping of string game names to corresponding classes
 GAME_NAME_TO_CLS = {
@@ -90,7 +208,42 @@ GAME_NAME_TO_CLS = {
     "psiturk" : OvercookedPsiturk
 }
 
-game._configure(MAX_GAME_LENGTH, AGENT_DIR)
+# Settings of the game and gameloop modules, shared with the GAME_PROCESSES workers
+GAME_SETTINGS = {
+    "max_game_time" : MAX_GAME_LENGTH,
+    "agent_dir" : AGENT_DIR,
+    "npc_inference" : NPC_INFERENCE,
+    "batch_latency" : INFERENCE_BATCH_LATENCY_MS / 1000,
+    "max_batch_size" : INFERENCE_MAX_BATCH_SIZE,
+    "num_policy_processes" : NPC_PROCESSES,
+    "agent_cache_bytes" : AGENT_CACHE_MB * 1024 ** 2,
+    "planner_cache_dir" : PLANNER_CACHE_DIR,
+    "potential_max_rate" : POTENTIAL_MAX_RATE,
+    "trajectory_spill_dir" : TRAJECTORY_SPILL_DIR,
+    "trajectory_max_buffered" : TRAJECTORY_MAX_BUFFERED,
+    "trajectory_chunk_rows" : TRAJECTORY_CHUNK_ROWS,
+    "trajectory_ack_timeout" : TRAJECTORY_ACK_TIMEOUT,
+    "fps" : MAX_FPS,
+    "adaptive_npc_cadence" : ADAPTIVE_NPC_CADENCE,
+    "npc_cpu_budget" : NPC_CPU_BUDGET,
+    "npc_max_ticks_per_action" : NPC_MAX_TICKS_PER_ACTION,
+    "num_npc_threads" : NPC_THREADS,
+    "npc_deadline" : NPC_DEADLINE_MS / 1000,
+    "npc_slo" : NPC_SLO_MS / 1000,
+    "npc_max_misses" : NPC_MAX_MISSES,
+    "npc_quarantine_time" : NPC_QUARANTINE_S,
+    "npc_fallback_action" : NPC_FALLBACK_ACTION
+}
+LOOP_SETTINGS = {
+    "state_deltas" : STATE_DELTAS,
+    "keyframe_interval" : KEYFRAME_INTERVAL,
+    "tick_policy" : TICK_POLICY,
+    "max_catch_up_ticks" : MAX_CATCH_UP_TICKS,
+    "trajectory_upload_interval" : TRAJECTORY_UPLOAD_INTERVAL
+}
+
+game._configure(**GAME_SETTINGS)
+gameloop._configure(**LOOP_SETTINGS)
 
 
 
@@ -111,59 +264,121 @@ handler = logging.FileHandler(LOGFILE)
 handler.setLevel(logging.ERROR)  
 app.logger.addHandler(handler)  
 
+# Steps every active GameLoop from a single background task
+SCHEDULER = TickScheduler(TICK_SLOT_MS / 1000, socketio.start_background_task, logger=app.logger, sleep=socketio.sleep)
+
 
 #################################
 # Global Coordination Functions #
 #################################
 
-def try_create_game(game_name ,**kwargs):
+def try_create_game(game_name, curr_id=None, **kwargs):
     """
-    Tries to create a brand new Game object based on parameters in `kwargs`
+    Tries to create a brand new Game object based on parameters in `kwargs`, with id `curr_id` if given (i.e.
+    one reserved by `admit_queued`) and a newly reserved id otherwise
     
     Returns (Game, Error) that represent a pointer to a game object, and error that occured
     during creation, if any. In case of error, `Game` returned in None. In case of sucess, 
     `Error` returned is None
 
     Possible Errors:
-        - Runtime error if server is at max game capacity
+        - CapacityError (a RuntimeError) if server is at max game capacity, or others are already waiting for capacity
+        - ValueError if the game is too expensive to ever be admitted
         - Propogate any error that occured in game __init__ function
     """
+    with CREATE_GAME_SECONDS.time():
+        return _try_create_game(game_name, curr_id, **kwargs)
+
+def _try_create_game(game_name, curr_id=None, **kwargs):
     try:
-        curr_id = FREE_IDS.get(block=False)
-        assert FREE_MAP[curr_id], "Current id is already in use"
+        if curr_id is None:
+            cost = estimate_game_cost(kwargs, GAME_COSTS)
+            if not CAPACITY.can_ever_fit(cost):
+                raise ValueError("Game exceeds the server's capacity ({} cores, {} MB)".format(cost.cpu, cost.memory_mb))
+            # Don't overtake requests that are already waiting for capacity. Once queued, this request is admitted straight
+            # away if they are only held back by the limits of other pools (see `admit_queued`)
+            curr_id = None if len(ADMISSIONS) else reserve_game_id(cost)
+            if curr_id is None:
+                raise CapacityError("Server at max capacity")
+        assert REGISTRY.state(curr_id) == GameRegistry.RESERVED, "Current id is not reserved"
         game_cls = GAME_NAME_TO_CLS.get(game_name, OvercookedGame)
-        game = game_cls(id=curr_id, **kwargs)
-    except queue.Empty:
-        err = RuntimeError("Server at max capacity")
-        return None, err
+        if SHARDS:
+            game = SHARDS.create_game(game_cls, curr_id, kwargs, weight=CAPACITY.get_cost(curr_id).cpu)
+        else:
+            game = game_cls(id=curr_id, **kwargs)
+    except CapacityError as e:
+        CREATE_GAME_FAILURES.labels('capacity').inc()
+        return None, e
     except Exception as e:
+        CREATE_GAME_FAILURES.labels('error').inc()
+        if curr_id is not None and REGISTRY.state(curr_id) == GameRegistry.RESERVED:
+            # The id was never used, hand it on rather than leaking it
+            release_id(curr_id)
         return None, e
     else:
-        GAMES[game.id] = game
-        FREE_MAP[game.id] = False
         return game, None
 
 def cleanup_game(game):
-    if FREE_MAP[game.id]:
-        raise ValueError("Double free on a game")
+    # Raises a ValueError on a double free. The id stays reserved, so it can't be reused, until it is released below
+    REGISTRY.remove(game.id)
 
     # User tracking
-    for user_id in game.players:
+    for user_id in list(game.players) + list(game.spectators):
         leave_curr_room(user_id)
 
     # Socketio tracking
     socketio.close_room(game.id)
 
     # Game tracking
-    FREE_MAP[game.id] = True
-    FREE_IDS.put(game.id)
-    del GAMES[game.id]
+    LOBBY.remove(game.id)
+    STATE_ENCODERS.pop(game.id, None)
+    GAME_CLOCKS.pop(game.id, None)
+    if SHARDS:
+        SHARDS.close_game(game.id)
 
-    if game.id in ACTIVE_GAMES:
-        ACTIVE_GAMES.remove(game.id)
+    release_id(game.id)
+
+def reserve_game_id(cost):
+    """
+    Takes a free game id and reserves `cost` for it. Returns None, without reserving anything, if either is unavailable
+    """
+    game_id = REGISTRY.reserve()
+    if game_id is None:
+        return None
+    if not CAPACITY.reserve(game_id, cost):
+        REGISTRY.release(game_id)
+        return None
+    return game_id
+
+def release_id(game_id):
+    """
+    Frees a game id and the capacity reserved for it, then hands them straight to the head of the ADMISSIONS queue
+    """
+    CAPACITY.release(game_id)
+    REGISTRY.release(game_id)
+    ADMISSIONS.record_release()
+    admit_queued()
+
+def admit_queued():
+    """
+    Admits queued requests, in order, for as long as the first one that isn't only held back by its own pool's limit fits
+    in the free capacity (see `AdmissionQueue.admit`)
+    """
+    while True:
+        admission, game_id = ADMISSIONS.admit(
+            lambda admission : reserve_game_id(_admission_cost(admission)),
+            pool_of=lambda admission : _admission_cost(admission).pool,
+            pool_full=lambda admission : CAPACITY.is_pool_full(_admission_cost(admission)))
+        if admission is None:
+            return
+        # The id stays RESERVED, which snapshots consider consistent, until the admitted user's game is created
+        socketio.start_background_task(_admit, admission, game_id)
+
+def _admission_cost(admission):
+    return estimate_game_cost(admission.params, GAME_COSTS)
 
 def get_game(game_id):
-    return GAMES.get(game_id, None)
+    return REGISTRY.get(game_id)
 
 def get_curr_game(user_id):
     return get_game(get_curr_room(user_id))
@@ -175,23 +390,24 @@ def set_curr_room(user_id, room_id):
     USER_ROOMS[user_id] = room_id
 
 def leave_curr_room(user_id):
-    del USER_ROOMS[user_id]
+    USER_ROOMS.pop(user_id, None)
 
-def get_waiting_game():
+def get_waiting_game(key=None):
     """
-    Return a pointer to a waiting game, if one exists
+    Return (game, key), a pointer to the longest waiting game whose configuration matches `key` (or to any
+    waiting game if `key` is None) and its configuration. Returns (None, None) if no such game exists
 
-    Note: The use of a queue ensures that no two threads will ever receive the same pointer, unless
-    the waiting game's ID is re-added to the WAITING_GAMES queue
+    Note: The LOBBY ensures that no two threads will ever receive the same pointer, unless
+    the waiting game is re-added to the LOBBY. The game might still be cleaned up by its last
+    player leaving, so check `is_registered` once holding its lock
     """
-    try:
-        waiting_id = WAITING_GAMES.get(block=False)
-        while FREE_MAP[waiting_id]:
-            waiting_id = WAITING_GAMES.get(block=False)
-    except queue.Empty:
-        return None
-    else:
-        return get_game(waiting_id)
+    return LOBBY.take(key)
+
+def is_registered(game):
+    """
+    Whether `game` has not been cleaned up. Only meaningful while holding `game.lock`, as games are cleaned up under it
+    """
+    return get_game(game.id) is game
 
 
 
@@ -218,26 +434,27 @@ def  _leave_game(user_id):
         return False
     
     # Acquire this game's lock to ensure all global state updates are atomic
-    with game.lock:
+    with LIFECYCLE.transition(), game.lock:
+        if not is_registered(game):
+            # Finished since it was looked up, which already took the user out of it
+            return False
+
         # Update socket state maintained by socketio
         leave_room(game.id)
 
         # Update user data maintained by this app
         leave_curr_room(user_id)
 
-        # Update game state maintained by game object
-        if user_id in game.players:
-            game.remove_player(user_id)
-        else:
-            game.remove_spectator(user_id)
+        # Update game state maintained by game object. The game deactivates itself if it can't go on without the user
+        game.leave(user_id)
         
         # Whether the game was active before the user left
-        was_active = game.id in ACTIVE_GAMES
+        was_active = REGISTRY.state(game.id) == GameRegistry.ACTIVE
 
         # Rebroadcast data and handle cleanup based on the transition caused by leaving
         if was_active and game.is_empty():
             # Active -> Empty
-            game.deactivate()
+            LIFECYCLE.begin(_teardown_key(game))
         elif game.is_empty():
             # Waiting -> Empty
             cleanup_game(game)
@@ -249,35 +466,133 @@ def  _leave_game(user_id):
             pass
         elif was_active and not game.is_empty():
             # Active -> Waiting
-            game.deactivate()
-            
-            
+            LIFECYCLE.begin(_teardown_key(game))
 
     return was_active
 
-def _create_game(user_id, game_name, params={}):
-    game, err = try_create_game(game_name, **params)
-    if not game:
-        emit("creation_failed", { "error" : err.__repr__() })
-        return
-    spectating = True
-    with game.lock:
-        if not game.is_full():
-            spectating = False
-            game.add_player(user_id)
-        else:
-            spectating = True
-            game.add_spectator(user_id)
+def _join_waiting_game(user_id, game, key):
+    """
+    Adds `user_id` to `game`, just taken from the LOBBY with configuration `key`, and starts it if it is ready. Returns
+    False if the game was cleaned up in the meantime
+    """
+    with LIFECYCLE.transition(), game.lock:
+        if not is_registered(game):
+            return False
+
+        ADMISSIONS.remove(user_id)
         join_room(game.id)
         set_curr_room(user_id, game.id)
-        if game.is_ready():
-            game.activate()
-            ACTIVE_GAMES.add(game.id)
-            emit('start_game', { "spectating" : spectating, "start_info" : game.to_json()}, room=game.id)
-            socketio.start_background_task(play_game, game, fps=MAX_FPS)
+
+        if game.join(user_id):
+            # Game is ready to begin play
+            REGISTRY.activate(game.id)
+            emit('start_game', { "spectating" : False, "start_info" : game.to_json()}, room=game.id)
+            start_game_loop(game)
         else:
-            WAITING_GAMES.put(game.id)
+            # Still need to keep waiting for players
+            LOBBY.add(game, key)
             emit('waiting', { "in_game" : True }, room=game.id)
+    return True
+
+def _teardown_key(game):
+    # A deactivated game stays ACTIVE in the REGISTRY until its GameLoop finishes it, which ends this transition
+    return ('teardown', game.id)
+
+def start_game_loop(game):
+    """
+    Starts ticking `game`, which was just activated, and broadcasting its state. Must be called while holding `game.lock`
+    """
+    if SHARDS:
+        # Ticked by the scheduler of the game's worker, which relays the loop's broadcasts back (see `emit_to_room`)
+        game.start_loop()
+        return
+    loop = GameLoop(game, fps=MAX_FPS, emit=partial(emit_to_room, game.id), spawn=socketio.start_background_task, on_finish=_finish_game, transition=LIFECYCLE.transition)
+    STATE_ENCODERS[game.id] = loop.encoder
+    GAME_CLOCKS[game.id] = loop.clock
+    SCHEDULER.add(loop)
+
+def emit_to_room(game_id, event, data):
+    with EMIT_SECONDS.labels(event).time():
+        socketio.emit(event, data, room=game_id)
+
+def _finish_game(game):
+    # Called by the game's GameLoop once it is over, as part of a LIFECYCLE transition and holding `game.lock`. Ends the
+    # teardown transition started by the last player leaving, if any, which must happen before the game's id can be reused
+    LIFECYCLE.end(_teardown_key(game))
+    cleanup_game(game)
+
+def _finish_remote_game(game_id):
+    # Called once the loop of a game hosted by SHARDS is over, or the game's worker died, after its `end_game` was
+    # broadcast
+    game = get_game(game_id)
+    if not game:
+        return
+    with LIFECYCLE.transition(), game.lock:
+        if is_registered(game):
+            _finish_game(game)
+
+def _create_game(user_id, game_name, params={}, curr_id=None):
+    """
+    Creates a new game with `user_id` in it, or queues the user for admission if the server is at capacity. Only
+    registering the game and adding the user to it is a LIFECYCLE transition: the game's id stays RESERVED, which
+    snapshots consider consistent, while the game is constructed (i.e. while its agents load)
+
+    Also called outside of socket handlers (see `_admit`), so only uses context free socketio calls
+    """
+    game, err = try_create_game(game_name, curr_id, **params)
+    if isinstance(err, CapacityError) and ADMISSION_TIMEOUT_S:
+        _queue_admission(user_id, game_name, params)
+        return
+    if not game:
+        socketio.emit("creation_failed", { "error" : err.__repr__() }, room=user_id)
+        return
+    with LIFECYCLE.transition(), game.lock:
+        REGISTRY.add(game)
+        started = game.join(user_id)
+        spectating = user_id in game.spectators
+        join_room(game.id, sid=user_id, namespace='/')
+        set_curr_room(user_id, game.id)
+        if started:
+            REGISTRY.activate(game.id)
+            socketio.emit('start_game', { "spectating" : spectating, "start_info" : game.to_json()}, room=game.id)
+            start_game_loop(game)
+        else:
+            LOBBY.add(game, lobby_key(game_name, params))
+            socketio.emit('waiting', { "in_game" : True }, room=game.id)
+
+def _queue_admission(user_id, game_name, params):
+    if ADMISSIONS.put(user_id, game_name, params, priority=ADMISSION_PRIORITIES.get(game_name, ADMISSION_DEFAULT_PRIORITY)):
+        SCHEDULER.add(AdmissionUpdater())
+    # Capacity might have been freed since creation failed
+    admit_queued()
+    if user_id in ADMISSIONS:
+        _emit_admission_status(user_id)
+
+def _emit_admission_status(user_id):
+    for admission, position in ADMISSIONS.positions():
+        if admission.user_id == user_id:
+            socketio.emit('admission_queued', _get_admission_status(admission, position), room=user_id)
+            return
+
+def _get_admission_status(admission, position):
+    return { "position" : position, "queued" : len(ADMISSIONS), "eta" : ADMISSIONS.eta(position), "waited" : admission.waited() }
+
+def _admit(admission, game_id):
+    """
+    Creates the game of a user that was waiting for admission, with the id that was just freed for them
+    """
+    user_id = admission.user_id
+    user_lock = USERS.get(user_id, None)
+    if not user_lock:
+        # Disconnected in the meantime
+        release_id(game_id)
+        return
+    with user_lock, app.app_context():
+        if get_curr_room(user_id) is not None:
+            # Joined a waiting game in the meantime
+            release_id(game_id)
+            return
+        _create_game(user_id, admission.game_name, admission.params, curr_id=game_id)
 
 
 
@@ -285,47 +600,148 @@ def _create_game(user_id, game_name, params={}):
 # Debugging Helpers #
 #####################
 
-def _ensure_consistent_state():
+def _take_snapshot():
+    """
+    Copies the global registries. Should only be called through `get_snapshot`, which makes sure the copy is not taken
+    half way through a lifecycle transition
+    """
+    registry = REGISTRY.snapshot()
+    states = registry['states']
+    return {
+        "games" : registry['games'],
+        "states" : states,
+        "active_ids" : set(game_id for game_id, state in states.items() if state == GameRegistry.ACTIVE),
+        "waiting_ids" : sorted(game_id for game_id, state in states.items() if state == GameRegistry.WAITING),
+        "lobby_ids" : LOBBY.ids(),
+        "free_ids" : registry['free_ids'],
+        "user_rooms" : USER_ROOMS.snapshot()
+    }
+
+def get_snapshot():
+    """
+    Returns (snapshot, consistent), where `snapshot` is a copy of the global registries (see `_take_snapshot`) and
+    `consistent` is False if some transition was still in flight after DEBUG_SNAPSHOT_TIMEOUT_MS
+    """
+    return LIFECYCLE.snapshot(_take_snapshot, timeout=DEBUG_SNAPSHOT_TIMEOUT_MS / 1000)
+
+def _ensure_consistent_state(snapshot=None):
     """
     Simple sanity checks of invariants on global state data
 
-    Let ACTIVE be the set of all active game IDs, GAMES be the set of all existing
-    game IDs, and WAITING be the set of all waiting (non-stale) game IDs. Note that
-    a game could be in the WAITING_GAMES queue but no longer exist (indicated by 
-    the FREE_MAP)
+    Let ACTIVE, WAITING and FREE be the sets of game IDs in each state of the REGISTRY, GAMES be
+    the set of all existing game IDs, and LOBBY be the set of all game IDs in the LOBBY
 
     - Intersection of WAITING and ACTIVE games must be empty set
     - Union of WAITING and ACTIVE must be equal to GAMES
-    - id \in FREE_IDS => FREE_MAP[id] 
-    - id \in ACTIVE_GAMES => Game in active state
-    - id \in WAITING_GAMES => Game in inactive state
-    """
-    waiting_games = set()
-    active_games = set()
-    all_games = set(GAMES)
+    - id \in FREE_IDS <=> id \in FREE
+    - id \in LOBBY => id \in WAITING
+    - id \in ACTIVE => Game in active state
+    - id \in WAITING => Game in inactive state
+    - Every user's room is in GAMES
 
-    for game_id in list(FREE_IDS.queue):
-        assert FREE_MAP[game_id], "Freemap in inconsistent state"
+    Checks `snapshot` if given, otherwise takes one (see `get_snapshot`)
+    """
+    if snapshot is None:
+        snapshot, _ = get_snapshot()
+    games = snapshot['games']
+    waiting_games = set(snapshot['waiting_ids'])
+    active_games = snapshot['active_ids']
+    all_games = set(games)
+    free_ids = set(game_id for game_id, state in snapshot['states'].items() if state == GameRegistry.FREE)
 
-    for game_id in list(WAITING_GAMES.queue):
-        if not FREE_MAP[game_id]:
-            waiting_games.add(game_id)
+    assert len(snapshot['free_ids']) == len(set(snapshot['free_ids'])), "ID freed twice"
+    assert set(snapshot['free_ids']) == free_ids, "Free list in inconsistent state"
 
-    for game_id in ACTIVE_GAMES:
-        active_games.add(game_id)
+    assert waiting_games.issuperset(snapshot['lobby_ids']), "Lobby ID not waiting"
 
     assert waiting_games.union(active_games) == all_games, "WAITING union ACTIVE != ALL"
 
     assert not waiting_games.intersection(active_games), "WAITING intersect ACTIVE != EMPTY"
 
-    assert all([get_game(g_id)._is_active for g_id in active_games]), "Active ID in waiting state"
-    assert all([not get_game(g_id)._id_active for g_id in waiting_games]), "Waiting ID in active state"
+    assert all([games[g_id]._is_active for g_id in active_games]), "Active ID in waiting state"
+    assert all([not games[g_id]._is_active for g_id in waiting_games]), "Waiting ID in active state"
+
+    assert all([room_id in all_games for room_id in snapshot['user_rooms'].values()]), "User in freed room"
+
+
+def get_agent_cache_stats():
+    return game.AGENT_CACHE.get_stats()
+
+def get_inference_stats():
+    if game.INFERENCE_SERVICE:
+        return game.INFERENCE_SERVICE.get_stats()
+    if game.POLICY_POOL:
+        return game.POLICY_POOL.get_stats()
+    return None
+
+def get_npc_pool_stats():
+    return game.NPC_POOL.get_stats()
+
+def get_agent_health_stats():
+    return game.AGENT_HEALTH.get_stats()
+
+def get_game_counts():
+    counts = { (state,) : count for state, count in REGISTRY.counts().items() }
+    counts[('total',)] = len(REGISTRY)
+    return counts
 
+def get_tick_rates():
+    if SHARDS:
+        return { (game_id,) : stats['tick_rate'] for game_id, stats in SHARDS.get_tick_stats().items() }
+    return { (game_id,) : clock.tick_rate for game_id, clock in GAME_CLOCKS.items() }
+
+def get_shard_stats():
+    return SHARDS.get_stats() if SHARDS else None
+
+def get_mean_tick_rate():
+    rates = get_tick_rates()
+    return sum(rates.values()) / len(rates) if rates else 0
+
+def get_configured_layouts():
+    layouts = set(LAYOUTS)
+    layouts.update(CONFIG['psiturk']['experimentParams']['layouts'])
+    layouts.update(CONFIG['tutorial']['tutorialParams']['layouts'])
+    return sorted(layouts)
 
 def get_agent_names():
     return [d for d in os.listdir(AGENT_DIR) if os.path.isdir(os.path.join(AGENT_DIR, d))]
 
 
+###########
+# Metrics #
+###########
+
+# Gauges are evaluated on scrape from state that is tracked anyway, so they cost nothing on the game loop path.
+# Latency histograms and counters are recorded where the work happens (see metrics.py)
+
+Gauge('overcooked_games', "Number of game ids by status", labelnames=('status',), callback=get_game_counts)
+Gauge('overcooked_lobby_longest_wait_seconds', "How long the longest waiting game has been in the lobby", callback=lambda : LOBBY.get_stats()['longest_current_wait'])
+Gauge('overcooked_admission_queue', "Number of game creation requests waiting for capacity, by priority class", labelnames=('priority',), callback=lambda : {
+    (priority,) : count for priority, count in ADMISSIONS.get_stats()['queued_by_priority'].items()
+})
+Gauge('overcooked_capacity_utilization', "Fraction of the CPU or memory budget (whichever is scarcer) reserved by games", callback=CAPACITY.get_utilization)
+Gauge('overcooked_pool_cpu_utilization', "Fraction of the CPU budget reserved by games, by cost class", labelnames=('pool',), callback=lambda : {
+    (name,) : pool['cpu_utilization'] for name, pool in CAPACITY.get_stats()['pools'].items()
+})
+Gauge('overcooked_pool_memory_utilization', "Fraction of the memory budget reserved by games, by cost class", labelnames=('pool',), callback=lambda : {
+    (name,) : pool['memory_utilization'] for name, pool in CAPACITY.get_stats()['pools'].items()
+})
+Gauge('overcooked_pool_games', "Number of games, by cost class", labelnames=('pool',), callback=lambda : {
+    (name,) : pool['games'] for name, pool in CAPACITY.get_stats()['pools'].items()
+})
+Gauge('overcooked_users', "Number of users currently in a room", callback=lambda : len(USER_ROOMS))
+Gauge('overcooked_scheduler_jobs', "Number of game loops registered with the tick scheduler", callback=lambda : len(SCHEDULER))
+Gauge('overcooked_npc_pool_tasks', "NPC worker pool queue depth", labelnames=('state',), callback=lambda : {
+    (key,) : value for key, value in get_npc_pool_stats().items() if key in ('ready', 'busy', 'hung', 'tasks')
+})
+Gauge('overcooked_target_fps', "Configured game ticks per second", callback=lambda : MAX_FPS)
+Gauge('overcooked_achieved_fps', "Achieved game ticks per second, by game", labelnames=('game_id',), callback=get_tick_rates)
+Gauge('overcooked_achieved_fps_mean', "Mean achieved game ticks per second over all running games", callback=get_mean_tick_rate)
+Gauge('overcooked_game_process_games', "Number of games hosted by each game worker process", labelnames=('worker',), callback=lambda : {
+    (str(idx),) : count for idx, count in enumerate(get_shard_stats()['games_per_worker'])
+} if SHARDS else {})
+
+
 ######################
 # Application routes #
 ######################
@@ -354,44 +770,118 @@ def tutorial():
     psiturk = request.args.get('psiturk', False)
     return render_template('tutorial.html', config=TUTORIAL_CONFIG, psiturk=psiturk)
 
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/debug')
 def debug():
+    """
+    Full dump of the server state, including the complete state of every game. Expensive on a busy server, prefer
+    `/debug/summary` for polling
+    """
+    snapshot, consistent = get_snapshot()
     resp = {}
-    games = []
+    games = snapshot['games']
     active_games = []
     waiting_games = []
     users = []
-    free_ids = []
-    free_map = {}
-    for game_id in ACTIVE_GAMES:
-        game = get_game(game_id)
-        active_games.append({"id" : game_id, "state" : game.to_json()})
-
-    for game_id in list(WAITING_GAMES.queue):
-        game = get_game(game_id)
-        game_state = None if FREE_MAP[game_id] else game.to_json()
-        waiting_games.append({ "id" : game_id, "state" : game_state})
+    for game_id in snapshot['active_ids']:
+        active_games.append(_get_game_detail(games[game_id]))
+
+    for game_id in snapshot['waiting_ids']:
+        waiting_games.append({ "id" : game_id, "state" : games[game_id].to_json()})
+
+    for user_id, room_id in snapshot['user_rooms'].items():
+        users.append({ user_id : room_id })
+
+    resp['consistent'] = consistent
+    resp['scheduler'] = SCHEDULER.get_stats()
+    resp['shards'] = get_shard_stats()
+    resp['inference'] = get_inference_stats()
+    resp['npc_pool'] = get_npc_pool_stats()
+    resp['agent_health'] = get_agent_health_stats()
+    resp['agent_cache'] = get_agent_cache_stats()
+    resp['lobby'] = LOBBY.get_stats()
+    resp['admissions'] = ADMISSIONS.get_stats()
+    resp['capacity'] = CAPACITY.get_stats()
+    resp['active_games'] = active_games
+    resp['waiting_games'] = waiting_games
+    resp['all_games'] = list(games)
+    resp['users'] = users
+    resp['free_ids'] = snapshot['free_ids']
+    resp['states'] = snapshot['states']
+    return jsonify(resp)
 
-    for game_id in GAMES:
-        games.append(game_id)
+@app.route('/debug/summary')
+def debug_summary():
+    """
+    Cheap overview of the server: counts and per-game metadata (no game state), `limit` games at a time starting at
+    `offset`, ordered by game id. The registries are copied at once, between lifecycle transitions, and checked against
+    `_ensure_consistent_state` before being summarized
+    """
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = max(request.args.get('limit', DEBUG_PAGE_SIZE, type=int), 0)
+    snapshot, consistent = get_snapshot()
+    games = snapshot['games']
+    active_ids = snapshot['active_ids']
+    waiting_ids = set(snapshot['waiting_ids'])
 
-    for user_id in USER_ROOMS:
-        users.append({ user_id : get_curr_room(user_id) })
+    try:
+        _ensure_consistent_state(snapshot)
+        violation = None
+    except AssertionError as e:
+        violation = str(e)
+
+    page = []
+    for game_id in sorted(games)[offset:offset + limit]:
+        summary = games[game_id].get_summary()
+        summary['status'] = snapshot['states'][game_id]
+        cost = CAPACITY.get_cost(game_id)
+        summary['cost'] = cost.to_dict() if cost else None
+        page.append(summary)
 
-    for game_id in list(FREE_IDS.queue):
-        free_ids.append(game_id)
+    resp = {}
+    resp['consistent'] = consistent
+    resp['violation'] = violation
+    resp['counts'] = {
+        "games" : len(games),
+        "active" : len(active_ids),
+        "waiting" : len(waiting_ids),
+        "free" : len(snapshot['free_ids']),
+        "reserved" : len(snapshot['states']) - len(games) - len(snapshot['free_ids']),
+        "in_lobby" : len(snapshot['lobby_ids']),
+        "queued" : len(ADMISSIONS),
+        "users" : len(snapshot['user_rooms'])
+    }
+    resp['offset'] = offset
+    resp['limit'] = limit
+    resp['games'] = page
+    resp['lobby'] = LOBBY.get_stats()
+    resp['admissions'] = ADMISSIONS.get_stats()
+    resp['capacity'] = CAPACITY.get_stats()
+    resp['lifecycle'] = LIFECYCLE.get_stats()
+    return jsonify(resp)
 
-    for game_id in FREE_MAP:
-        free_map[game_id] = FREE_MAP[game_id]
+@app.route('/debug/games/<int:game_id>')
+def debug_game(game_id):
+    """
+    Full detail (including game state) for a single game
+    """
+    game = get_game(game_id)
+    if not game:
+        return jsonify({ "error" : "No game with id {}".format(game_id) }), 404
+    return jsonify(_get_game_detail(game))
 
-    
-    resp['active_games'] = active_games
-    resp['waiting_games'] = waiting_games
-    resp['all_games'] = games
-    resp['users'] = users
-    resp['free_ids'] = free_ids
-    resp['free_map'] = free_map
-    return jsonify(resp)
+def _get_game_detail(game):
+    if SHARDS:
+        # Collected by the game's worker in a single request, under the game's lock there
+        return game.get_detail()
+    with game.lock:
+        clock = GAME_CLOCKS.get(game.id, None)
+        detail = get_game_detail(game, clock.get_stats() if clock else None)
+    detail['summary'] = game.get_summary()
+    return detail
 
 
 #########################
@@ -412,6 +902,11 @@ def on_create(data):
         if curr_game:
             # Cannot create if currently in a game
             return
+
+        if user_id in ADMISSIONS:
+            # Already queued, don't pile up requests
+            _emit_admission_status(user_id)
+            return
         
         params = data.get('params', {})
         #hardcoded since there is no input for toggling this flag
@@ -433,42 +928,37 @@ def on_join(data):
             # Cannot join if currently in a game
             return
         
-        # Retrieve a currently open game if one exists
-        game = get_waiting_game()
+        # Retrieve a currently open game with the requested configuration if one exists. Joins that don't ask for
+        # a particular game (i.e. lobby polling) can be matched with any waiting game
+        params = data.get('params', {})
+        game_name = data.get('game_name', 'overcooked')
+        requested_key = lobby_key(game_name, params) if 'params' in data or 'game_name' in data else None
+        game, key = get_waiting_game(requested_key)
 
-        if not game and create_if_not_found:
-            # No available game was found so create a game
-            params = data.get('params', {})
-            game_name = data.get('game_name', 'overcooked')
-            _create_game(user_id, game_name, params)
+        # Game was found so join it. If it was cleaned up since it was taken from the lobby, try the next one
+        while game and not _join_waiting_game(user_id, game, key):
+            game, key = get_waiting_game(requested_key)
+
+        if game:
             return
 
-        elif not game:
+        if user_id in ADMISSIONS:
+            # Already queued to create a game, don't pile up requests
+            _emit_admission_status(user_id)
+            return
+
+        if create_if_not_found:
+            # No available game was found so create a game
+            _create_game(user_id, game_name, params)
+        else:
             # No available game was found so start waiting to join one
             emit('waiting', { "in_game" : False })
-        else:
-            # Game was found so join it
-            with game.lock:
-
-                join_room(game.id)
-                set_curr_room(user_id, game.id)
-                game.add_player(user_id)
-                    
-                if game.is_ready():
-                    # Game is ready to begin play
-                    game.activate()
-                    ACTIVE_GAMES.add(game.id)
-                    emit('start_game', { "spectating" : False, "start_info" : game.to_json()}, room=game.id)
-                    socketio.start_background_task(play_game, game)
-                else:
-                    # Still need to keep waiting for players
-                    WAITING_GAMES.put(game.id)
-                    emit('waiting', { "in_game" : True }, room=game.id)
 
 @socketio.on('leave')
 def on_leave(data):
     user_id = request.sid
     with USERS[user_id]:
+        ADMISSIONS.remove(user_id)
         was_active = _leave_game(user_id)
 
         if was_active:
@@ -488,6 +978,33 @@ def on_action(data):
     game.enqueue_action(user_id, action)
 
 
+@socketio.on('resync')
+def on_resync(data):
+    # Client missed a delta (or joined mid-game) and needs a full keyframe to rebuild its state
+    user_id = request.sid
+    if SHARDS:
+        game = get_curr_game(user_id)
+        if game:
+            game.request_keyframe()
+        return
+    encoder = STATE_ENCODERS.get(get_curr_room(user_id), None)
+    if encoder:
+        encoder.request_keyframe()
+
+
+@socketio.on('trajectory_ack')
+def on_trajectory_ack(data):
+    user_id = request.sid
+    game = get_curr_game(user_id)
+    seq = data.get('seq', None) if isinstance(data, dict) else None
+    if not isinstance(seq, int):
+        # Malformed ack, nothing to acknowledge
+        return
+    stream = game.get_data_stream() if game else None
+    if stream:
+        stream.ack(seq, user_id)
+
+
 @socketio.on('connect')
 def on_connect():
     user_id = request.sid
@@ -504,6 +1021,7 @@ def on_disconnect():
     if user_id not in USERS:
         return
     with USERS[user_id]:
+        ADMISSIONS.remove(user_id)
         _leave_game(user_id)
 
     del USERS[user_id]
@@ -513,47 +1031,55 @@ def on_disconnect():
 
 # Exit handler for server
 def on_exit():
-    # Force-terminate all games on server termination
-    for game_id in GAMES:
-        socketio.emit('end_game', { "status" : Game.Status.INACTIVE, "data" : get_game(game_id).get_data() }, room=game_id)
+    # Force-terminate all games on server termination. Streamed game data is sent as chunks, as in GameLoop.finish,
+    # rather than built into a single payload
+    for game_id, curr_game in REGISTRY.snapshot()['games'].items():
+        stream = None if SHARDS else curr_game.get_data_stream()
+        if stream:
+            data = curr_game.get_data_manifest()
+            stream.drain(partial(emit_to_room, game_id, 'trajectory_chunk'))
+        else:
+            data = curr_game.get_data()
+        socketio.emit('end_game', { "status" : Game.Status.INACTIVE, "data" : data }, room=game_id)
 
 
 
 
-#############
-# Game Loop #
-#############
+##################
+# Admission Loop #
+##################
 
-def play_game(game, fps=30):
+class AdmissionUpdater(object):
     """
-    Asynchronously apply real-time game updates and broadcast state to all clients currently active
-    in the game. Note that this loop must be initiated by a parallel thread for each active game
-
-    game (Game object):     Stores relevant game state. Note that the game id is the same as to socketio
-                            room id for all clients connected to this game
-    fps (int):              Number of game ticks that should happen every second
+    Periodically expires timed out admission requests and pushes every queued client its position and estimated wait.
+    Stepped by the SCHEDULER while anyone is queued
     """
-    status = Game.Status.ACTIVE
-    while status != Game.Status.DONE and status != Game.Status.INACTIVE:
-        with game.lock:
-            status = game.tick()
-        if status == Game.Status.RESET:
-            with game.lock:
-                data = game.get_data()
-            socketio.emit('reset_game', { "state" : game.to_json(), "timeout" : game.reset_timeout, "data" : data}, room=game.id)
-            socketio.sleep(game.reset_timeout/1000)
-        else:
-            socketio.emit('state_pong', { "state" : game.get_state() }, room=game.id)
-        socketio.sleep(1/fps)
-    
-    with game.lock:
-        data = game.get_data()
-        socketio.emit('end_game', { "status" : status, "data" : data }, room=game.id)
 
-        if status != Game.Status.INACTIVE:
-            game.deactivate()
-        cleanup_game(game)
+    def __repr__(self):
+        return "AdmissionUpdater()"
 
+    def step(self):
+        expired = ADMISSIONS.expire()
+        for admission in expired:
+            err = CapacityError("Timed out after {}s waiting for server capacity".format(ADMISSION_TIMEOUT_S))
+            socketio.emit('creation_failed', { "error" : err.__repr__() }, room=admission.user_id)
+        if expired:
+            # An expensive request at the head may have been holding up cheaper ones that fit
+            admit_queued()
+        if not ADMISSIONS.needs_updates():
+            return None
+        for admission, position in ADMISSIONS.positions():
+            socketio.emit('admission_queued', _get_admission_status(admission, position), room=admission.user_id)
+        return monotonic() + ADMISSION_UPDATE_INTERVAL_S
+
+
+#################
+# Game Sharding #
+#################
+
+# Worker processes hosting every game when GAME_PROCESSES is set, None otherwise. Each worker prewarms the same MDPs and
+# preloads the same agents as this process would at startup
+SHARDS = GameShardPool(GAME_PROCESSES, GAME_SETTINGS, LOOP_SETTINGS, on_emit=emit_to_room, on_finish=_finish_remote_game, spawn=socketio.start_background_task, fps=MAX_FPS, slot_duration=TICK_SLOT_MS / 1000, warm_up=(get_configured_layouts(), [{}, { "old_dynamics" : True }], PRELOAD_AGENTS), logger=app.logger) if GAME_PROCESSES else None
 
 
 if __name__ == '__main__':
@@ -564,5 +1090,24 @@ if __name__ == '__main__':
     # Attach exit handler to ensure graceful shutdown
     atexit.register(on_exit)
 
+    # Build every configured layout's MDP now so that `activate` (which runs under game.lock) never has to parse layouts.
+    # `on_create` always sets old_dynamics, while games created through `on_join` use the default mdp params
+    if SHARDS:
+        # Workers prewarm and preload on their own, games don't run here
+        SHARDS.start()
+    else:
+        for layout_name, err in game.prewarm_mdps(get_configured_layouts(), [{}, { "old_dynamics" : True }]).items():
+            app.logger.error("Failed to prewarm layout {}: {}".format(layout_name, err.__repr__()))
+
+    # The first potential-enabled game on a layout would otherwise compute its planner inside the request handler
+    if PRECOMPUTE_PLANNERS:
+        for layout_name, err in planner_cache.warm_up(get_configured_layouts(), [{}, { "old_dynamics" : True }]).items():
+            app.logger.error("Failed to precompute planner for layout {}: {}".format(layout_name, err.__repr__()))
+
+    # Pay agent loading costs up front rather than in the first game's request handler
+    if not SHARDS:
+        for agent_name, err in game.preload_agents(PRELOAD_AGENTS).items():
+            app.logger.error("Failed to preload agent {}: {}".format(agent_name, err.__repr__()))
+
     # https://localhost:80 is external facing address regardless of build environment
     socketio.run(app, host=host, port=port, log_output=app.config['DEBUG'])
\ No newline at end of file
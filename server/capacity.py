@@ -0,0 +1,158 @@
+from threading import Lock
+
+# Tolerance for rounding errors accumulated by adding and subtracting fractional costs
+_EPSILON = 1e-9
+
+
+class GameCost(object):
+    """
+    Estimated steady state resource usage of a single game
+
+    Instance variables:
+        - pool (str): Cost class of the game. 'human' if all players are human, 'rllib' if any NPC is a learned
+            (RLlib) agent and 'scripted' otherwise
+        - cpu (float): Estimated CPU usage, in cores
+        - memory_mb (float): Estimated memory usage, in MB
+    """
+
+    def __init__(self, pool, cpu, memory_mb):
+        self.pool = pool
+        self.cpu = cpu
+        self.memory_mb = memory_mb
+
+    def to_dict(self):
+        return { "pool" : self.pool, "cpu" : self.cpu, "memory_mb" : self.memory_mb }
+
+
+def is_learned_agent(npc_id):
+    # Mirrors `game.load_policy`, which restores (or loads the export of) an RLlib agent for these directories
+    return npc_id.lower().startswith('rllib')
+
+
+def estimate_game_cost(params, costs):
+    """
+    Estimates the cost of an OvercookedGame created with `params` from the unit `costs` (a dict mapping 'game',
+    'scripted_npc', 'rllib_npc' and 'potential' to dicts of 'cpu' and 'memory_mb')
+    """
+    npcs = [params.get(player, 'human') for player in ('playerZero', 'playerOne')]
+    npcs = [npc_id for npc_id in npcs if npc_id != 'human']
+    num_learned = sum(is_learned_agent(npc_id) for npc_id in npcs)
+    units = [('game', 1), ('rllib_npc', num_learned), ('scripted_npc', len(npcs) - num_learned), ('potential', int(bool(params.get('showPotential', False))))]
+
+    pool = 'rllib' if num_learned else 'scripted' if npcs else 'human'
+    cpu = sum(costs[unit]['cpu'] * count for unit, count in units)
+    memory_mb = sum(costs[unit]['memory_mb'] * count for unit, count in units)
+    return GameCost(pool, cpu, memory_mb)
+
+
+class CapacityManager(object):
+    """
+    Admits games against a CPU and a memory budget rather than a fixed number of games, so that many cheap games can
+    run next to a few expensive ones
+
+    Games are grouped into pools by their cost class. `pool_limits` optionally caps the fraction of both budgets a pool
+    may use, i.e. to keep expensive games from crowding out cheap ones. Pools without a limit are only bound by the
+    overall budgets
+
+    Instance variables:
+        - reservations (dict): Maps the id of every admitted game to its GameCost
+        - cpu_used (float), memory_used_mb (float): Sum of the costs of all admitted games
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, cpu_budget, memory_budget_mb, pool_limits={}):
+        self.cpu_budget = cpu_budget
+        self.memory_budget_mb = memory_budget_mb
+        self.pool_limits = dict(pool_limits)
+        self.lock = Lock()
+        self.reservations = {}
+        self.cpu_used = 0
+        self.memory_used_mb = 0
+        self.pools = {}
+
+    def can_ever_fit(self, cost):
+        """
+        Whether a game of `cost` could be admitted on an otherwise idle server
+        """
+        return self._within(cost.cpu, cost.memory_mb, self.pool_limits.get(cost.pool, 1))
+
+    def reserve(self, key, cost):
+        """
+        Reserves `cost` for the game identified by `key` if it fits in the remaining budgets. Returns whether it did
+        """
+        with self.lock:
+            if not self._fits(cost):
+                return False
+            self.reservations[key] = cost
+            self.cpu_used += cost.cpu
+            self.memory_used_mb += cost.memory_mb
+            pool = self.pools.setdefault(cost.pool, { "games" : 0, "cpu" : 0, "memory_mb" : 0 })
+            pool['games'] += 1
+            pool['cpu'] += cost.cpu
+            pool['memory_mb'] += cost.memory_mb
+            return True
+
+    def release(self, key):
+        """
+        Releases the reservation of `key`, if any
+        """
+        with self.lock:
+            cost = self.reservations.pop(key, None)
+            if cost is None:
+                return
+            self.cpu_used -= cost.cpu
+            self.memory_used_mb -= cost.memory_mb
+            pool = self.pools[cost.pool]
+            pool['games'] -= 1
+            pool['cpu'] -= cost.cpu
+            pool['memory_mb'] -= cost.memory_mb
+
+    def is_pool_full(self, cost):
+        """
+        Whether a game of `cost` only fails to fit because of the limit of its pool, rather than the overall budgets
+        """
+        with self.lock:
+            if cost.pool not in self.pool_limits:
+                return False
+            if not self._within(self.cpu_used + cost.cpu, self.memory_used_mb + cost.memory_mb, 1):
+                return False
+            return not self._fits(cost)
+
+    def get_cost(self, key):
+        return self.reservations.get(key, None)
+
+    def _fits(self, cost):
+        # Must be called while holding self.lock
+        if not self._within(self.cpu_used + cost.cpu, self.memory_used_mb + cost.memory_mb, 1):
+            return False
+        if cost.pool not in self.pool_limits:
+            return True
+        pool = self.pools.get(cost.pool, { "cpu" : 0, "memory_mb" : 0 })
+        return self._within(pool['cpu'] + cost.cpu, pool['memory_mb'] + cost.memory_mb, self.pool_limits[cost.pool])
+
+    def _within(self, cpu, memory_mb, share):
+        return cpu <= self.cpu_budget * share + _EPSILON and memory_mb <= self.memory_budget_mb * share + _EPSILON
+
+    def get_utilization(self):
+        """
+        Fraction of the scarcer of the two budgets that is in use
+        """
+        return max(self.cpu_used / self.cpu_budget, self.memory_used_mb / self.memory_budget_mb)
+
+    def get_stats(self):
+        with self.lock:
+            pools = {}
+            for name, pool in self.pools.items():
+                pools[name] = dict(pool)
+                pools[name]['cpu_utilization'] = pool['cpu'] / self.cpu_budget
+                pools[name]['memory_utilization'] = pool['memory_mb'] / self.memory_budget_mb
+                pools[name]['limit'] = self.pool_limits.get(name, None)
+            return {
+                "cpu_budget" : self.cpu_budget,
+                "memory_budget_mb" : self.memory_budget_mb,
+                "cpu_used" : self.cpu_used,
+                "memory_used_mb" : self.memory_used_mb,
+                "utilization" : self.get_utilization(),
+                "pools" : pools
+            }
@@ -0,0 +1,236 @@
+"""
+Ray-free inference artifacts for RLlib agents
+
+Restoring an RLlib agent through `human_aware_rl.rllib.rllib.load_agent` requires Ray, the full PPO trainer and (for
+PPO_BC agents) the BC model, even though only the policy network is needed to compute actions. `export_agent` loads
+an agent once, the slow way, and writes out just the policy network's architecture and weights plus the featurization
+config. `load_exported_agent` then rebuilds an equivalent agent on top of a pure numpy forward pass.
+
+Usage (from the server directory, inside an environment with human_aware_rl installed):
+
+    python exported_agent.py static/assets/agents/RllibCrampedRoomPPO_BC_temp
+
+Once `inference.json` and `inference.npz` exist in an agent directory, the server loads them in place of the checkpoint
+"""
+from overcooked_ai_py.mdp.overcooked_mdp import OvercookedGridworld
+from overcooked_ai_py.mdp.actions import Action
+import numpy as np
+import argparse, json, os
+
+# Bumped whenever the artifact format changes in a backwards incompatible way
+EXPORT_VERSION = 1
+
+# File names (relative to the agent directory) of the exported architecture/featurization config and weights
+EXPORT_CONFIG_FILE = 'inference.json'
+EXPORT_WEIGHTS_FILE = 'inference.npz'
+
+# Slope used by `tf.nn.leaky_relu` when it is passed as a layer activation
+TF_LEAKY_RELU_ALPHA = 0.2
+
+
+def has_exported_agent(agent_path):
+    return os.path.exists(os.path.join(agent_path, EXPORT_CONFIG_FILE))
+
+def load_exported_agent(agent_path, agent_index=0):
+    """
+    Returns an ExportedAgent built from the artifact in `agent_path`. Does not import Ray or TensorFlow
+    """
+    with open(os.path.join(agent_path, EXPORT_CONFIG_FILE), 'r') as f:
+        config = json.load(f)
+    if config['version'] != EXPORT_VERSION:
+        raise ValueError("Unsupported export version {}, re-export the agent".format(config['version']))
+    with np.load(os.path.join(agent_path, EXPORT_WEIGHTS_FILE)) as weights:
+        weights = { name : weights[name] for name in weights.files }
+
+    policy = NumpyPolicy(config['model'], weights)
+    featurize = _build_featurize_fn(config['featurization'])
+    return ExportedAgent(policy, agent_index, featurize)
+
+
+class ExportedAgent(object):
+    """
+    Drop-in replacement for `RlLibAgent` backed by a NumpyPolicy. Exposes the same `policy`, `featurize`, `agent_index`
+    and `rnn_state` attributes so that it can be batched by the BatchedInferenceService
+    """
+
+    def __init__(self, policy, agent_index, featurize):
+        self.policy = policy
+        self.agent_index = agent_index
+        self.featurize = featurize
+        self.rnn_state = []
+
+    def reset(self):
+        self.rnn_state = []
+
+    def action(self, state):
+        obs = self.featurize(state)[self.agent_index]
+        _, _, info = self.policy.compute_actions(np.array([obs]), self.rnn_state)
+        probs = _softmax(info["action_dist_inputs"])[0]
+        action_idx = np.random.choice(len(Action.ALL_ACTIONS), p=probs)
+        return Action.INDEX_TO_ACTION[action_idx], { "action_probs" : probs }
+
+
+class NumpyPolicy(object):
+    """
+    Evaluates an exported Keras functional model with numpy. Mirrors the subset of `rllib.Policy.compute_actions`
+    used by the server
+    """
+
+    def __init__(self, model_config, weights):
+        self.layers = model_config['layers']
+        self.output = model_config['output']
+        self.weights = { layer['name'] : [weights["{}/{}".format(layer['name'], i)] for i in range(layer['num_weights'])] for layer in self.layers }
+
+    def compute_actions(self, obs_batch, state_batches=None):
+        outputs = {}
+        for layer in self.layers:
+            inputs = [outputs[name] for name in layer['inputs']] or [obs_batch.astype(np.float32)]
+            outputs[layer['name']] = _apply_layer(layer, self.weights[layer['name']], inputs)
+        logits = outputs[self.output]
+        return np.argmax(logits, axis=1), [], { "action_dist_inputs" : logits }
+
+
+def _apply_layer(layer, weights, inputs):
+    class_name, config = layer['class_name'], layer['config']
+    x = inputs[0]
+    if class_name == 'InputLayer':
+        return x
+    if class_name == 'Flatten':
+        return x.reshape(x.shape[0], -1)
+    if class_name == 'Concatenate':
+        return np.concatenate(inputs, axis=config.get('axis', -1))
+    if class_name == 'LeakyReLU':
+        return np.where(x > 0, x, x * config.get('alpha', 0.3))
+    if class_name == 'Activation':
+        return _activation(config['activation'], x)
+    if class_name == 'Dense':
+        out = x @ weights[0]
+        if config.get('use_bias', True):
+            out = out + weights[1]
+        return _activation(config.get('activation', 'linear'), out)
+    if class_name == 'Conv2D':
+        out = _conv2d(x, weights[0], config['padding'], config.get('strides', [1, 1]))
+        if config.get('use_bias', True):
+            out = out + weights[1]
+        return _activation(config.get('activation', 'linear'), out)
+    raise ValueError("Layer type {} is not supported by exported agents".format(class_name))
+
+def _conv2d(x, kernel, padding, strides):
+    """
+    NHWC convolution with an (kh, kw, in, out) kernel, implemented as one matmul per kernel offset
+    """
+    if tuple(strides) != (1, 1):
+        raise ValueError("Only unit strides are supported by exported agents")
+    kh, kw = kernel.shape[:2]
+    if padding == 'same':
+        pad_h, pad_w = kh - 1, kw - 1
+        x = np.pad(x, ((0, 0), (pad_h // 2, pad_h - pad_h // 2), (pad_w // 2, pad_w - pad_w // 2), (0, 0)))
+    out_h, out_w = x.shape[1] - kh + 1, x.shape[2] - kw + 1
+    out = np.zeros((x.shape[0], out_h, out_w, kernel.shape[3]), dtype=x.dtype)
+    for i in range(kh):
+        for j in range(kw):
+            out += x[:, i:i + out_h, j:j + out_w, :] @ kernel[i, j]
+    return out
+
+def _activation(name, x):
+    if name == 'linear':
+        return x
+    if name == 'relu':
+        return np.maximum(x, 0)
+    if name == 'leaky_relu':
+        return np.where(x > 0, x, x * TF_LEAKY_RELU_ALPHA)
+    if name == 'tanh':
+        return np.tanh(x)
+    if name == 'sigmoid':
+        return 1 / (1 + np.exp(-x))
+    raise ValueError("Activation {} is not supported by exported agents".format(name))
+
+def _softmax(logits):
+    logits = logits - np.max(logits, axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / np.sum(exp, axis=1, keepdims=True)
+
+def _build_featurize_fn(featurization):
+    if featurization['type'] != 'lossless':
+        raise ValueError("Featurization {} is not supported by exported agents".format(featurization['type']))
+    mdp_params = dict(featurization['mdp_params'])
+    layout_name = mdp_params.pop('layout_name')
+    mdp = OvercookedGridworld.from_layout_name(layout_name, **mdp_params)
+    horizon = featurization['horizon']
+    return lambda state: mdp.lossless_state_encoding(state, horizon=horizon)
+
+
+
+##########
+# Export #
+##########
+
+def export_agent(agent_path, policy_id='ppo'):
+    """
+    Restores the RLlib checkpoint in `agent_path`/agent and writes the inference artifact next to it. Requires Ray
+    """
+    # Heavy imports are deferred so that loading exported agents never pulls them in
+    from human_aware_rl.rllib.rllib import load_trainer
+    from game import fix_bc_path
+    import ray
+
+    checkpoint_path = os.path.join(agent_path, 'agent')
+    fix_bc_path(checkpoint_path)
+    try:
+        trainer = load_trainer(checkpoint_path)
+        policy = trainer.get_policy(policy_id)
+        env_config = trainer.config['env_config']
+        model = policy.model
+        if model.get_initial_state():
+            raise ValueError("Recurrent policies cannot be exported")
+        keras_model = model.base_model
+        model_config, weights = _serialize_keras_model(keras_model)
+    finally:
+        if ray.is_initialized():
+            ray.shutdown()
+
+    config = {
+        "version" : EXPORT_VERSION,
+        "model" : model_config,
+        "featurization" : {
+            "type" : "lossless",
+            "mdp_params" : env_config['mdp_params'],
+            "horizon" : env_config.get('env_params', {}).get('horizon', 400)
+        }
+    }
+    with open(os.path.join(agent_path, EXPORT_CONFIG_FILE), 'w') as f:
+        json.dump(config, f)
+    np.savez(os.path.join(agent_path, EXPORT_WEIGHTS_FILE), **weights)
+    return config
+
+def _serialize_keras_model(keras_model):
+    """
+    Returns (model_config, weights) for a Keras functional model, with layers listed in topological order
+    """
+    keras_config = keras_model.get_config()
+    layers, weights = [], {}
+    for layer_config, layer in zip(keras_config['layers'], keras_model.layers):
+        inbound = layer_config['inbound_nodes']
+        layer_weights = layer.get_weights()
+        layers.append({
+            "name" : layer.name,
+            "class_name" : layer_config['class_name'],
+            "config" : layer_config['config'],
+            "inputs" : [node[0] for node in inbound[0]] if inbound else [],
+            "num_weights" : len(layer_weights)
+        })
+        for i, w in enumerate(layer_weights):
+            weights["{}/{}".format(layer.name, i)] = w
+    # The first model output is the action logits, the second is the value function
+    output = keras_config['output_layers'][0][0]
+    return { "layers" : layers, "output" : output }, weights
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export an RLlib agent directory into a Ray-free inference artifact")
+    parser.add_argument('agent_paths', nargs='+', help="Agent directories, i.e. static/assets/agents/RllibMyAgent")
+    parser.add_argument('--policy_id', default='ppo', help="ID of the policy to export from the trainer")
+    args = parser.parse_args()
+    for agent_path in args.agent_paths:
+        export_agent(agent_path, policy_id=args.policy_id)
+        print("Exported {}".format(agent_path))
@@ -1,14 +1,24 @@
 from abc import ABC, abstractmethod
-from threading import Lock, Thread
-from queue import Queue, LifoQueue, Empty, Full
-from time import time
+from threading import Lock, Thread, Condition
+from collections import OrderedDict
+from queue import Queue, Empty, Full
+from time import time, monotonic
 from overcooked_ai_py.mdp.overcooked_mdp import OvercookedGridworld
-from overcooked_ai_py.mdp.overcooked_env import OvercookedEnv
 from overcooked_ai_py.mdp.actions import Action, Direction
-from overcooked_ai_py.planning.planners import MotionPlanner, NO_COUNTERS_PARAMS
-from human_aware_rl.rllib.rllib import load_agent
-import random, os, pickle, json
-import ray
+from overcooked_ai_py.planning.planners import NO_COUNTERS_PARAMS
+from inference import BatchedInferenceService, PolicyProcessPool, RemotePolicy, NpcWorkerPool, AgentHealthMonitor, is_batchable
+from agents import AgentCache
+from exported_agent import has_exported_agent, load_exported_agent
+from planner_cache import get_motion_planner
+from trajectory import TrajectoryRecorder, TrajectoryStream
+from metrics import TICK_SECONDS, TICKS, APPLY_ACTIONS_SECONDS, NPC_INFERENCE_SECONDS, NPC_DEADLINE_MISSES
+import planner_cache
+from functools import lru_cache
+import random, os, pickle, json, math
+
+# Note: ray and human_aware_rl (and with them TensorFlow) are deliberately not imported at module level. They are only
+# needed to restore rllib checkpoints, so `load_policy` imports them the first time such an agent is requested.
+# `import_benchmark.py` guards against these imports creeping back in
 
 # Relative path to where all static pre-trained agents are stored on server
 AGENT_DIR = None
@@ -16,10 +26,75 @@ AGENT_DIR = None
 # Maximum allowable game time (in seconds)
 MAX_GAME_TIME = None
 
-def _configure(max_game_time, agent_dir):
-    global AGENT_DIR, MAX_GAME_TIME
+# How NPC actions are computed. 'threads' shares the NPC_POOL worker threads, 'batched' shares a BatchedInferenceService
+# and 'process' runs agents loaded from AGENT_DIR inside the worker processes of a PolicyProcessPool
+NPC_INFERENCE = 'threads'
+
+# Bounded pool of threads computing the actions of every NPC that is not served by the INFERENCE_SERVICE or POLICY_POOL
+NPC_POOL = NpcWorkerPool(num_workers=8)
+
+# Service batching NPC forward passes across all games, if NPC_INFERENCE == 'batched'
+INFERENCE_SERVICE = None
+
+# Worker processes hosting NPC policies, if NPC_INFERENCE == 'process'
+POLICY_POOL = None
+
+# Deadlines, latency SLO and quarantine state of every agent, across all games and backends. An NPC that has not
+# produced an action AGENT_HEALTH.deadline seconds after being asked plays NPC_FALLBACK_ACTION instead, either 'stay'
+# or 'last' (repeat its previous action)
+AGENT_HEALTH = AgentHealthMonitor()
+NPC_FALLBACK_ACTION = 'stay'
+
+# Maximum number of potential function evaluations per second, per game
+POTENTIAL_MAX_RATE = 10
+
+# Whether the number of ticks between NPC forward passes adapts to each agent's measured latency (see CadenceController).
+# NPCs are never queried more often than their game's `ticks_per_ai_action`, and never less often than
+# NPC_MAX_TICKS_PER_ACTION, unless overridden by the agent's metadata.json. NPC_CPU_BUDGET is the fraction of the time
+# between queries an NPC may spend computing its action
+ADAPTIVE_NPC_CADENCE = True
+NPC_CPU_BUDGET = 0.5
+NPC_MAX_TICKS_PER_ACTION = 15
+
+# Duration of one game tick, in seconds
+TICK_DURATION = 1 / 30
+
+# Directory Psiturk trajectories are spilled to once more than TRAJECTORY_MAX_BUFFERED transitions are pending in memory.
+# Trajectories are never spilled if None
+TRAJECTORY_SPILL_DIR = None
+TRAJECTORY_MAX_BUFFERED = 900
+
+# Maximum number of transitions per uploaded trajectory chunk, and how long (in seconds) to wait on a client's ack
+# before re-sending a chunk
+TRAJECTORY_CHUNK_ROWS = 300
+TRAJECTORY_ACK_TIMEOUT = 10
+
+def _configure(max_game_time, agent_dir, npc_inference='threads', batch_latency=0.005, max_batch_size=32, num_policy_processes=2, agent_cache_bytes=None, planner_cache_dir=None, potential_max_rate=10, trajectory_spill_dir=None, trajectory_max_buffered=900, trajectory_chunk_rows=300, trajectory_ack_timeout=10, fps=30, adaptive_npc_cadence=True, npc_cpu_budget=0.5, npc_max_ticks_per_action=15, num_npc_threads=8, npc_deadline=0.5, npc_slo=0.1, npc_max_misses=3, npc_quarantine_time=300, npc_fallback_action='stay'):
+    global AGENT_DIR, MAX_GAME_TIME, NPC_INFERENCE, INFERENCE_SERVICE, POLICY_POOL, POTENTIAL_MAX_RATE, TRAJECTORY_SPILL_DIR, TRAJECTORY_MAX_BUFFERED, TRAJECTORY_CHUNK_ROWS, TRAJECTORY_ACK_TIMEOUT
+    global TICK_DURATION, ADAPTIVE_NPC_CADENCE, NPC_CPU_BUDGET, NPC_MAX_TICKS_PER_ACTION, NPC_POOL, AGENT_HEALTH, NPC_FALLBACK_ACTION
     MAX_GAME_TIME = max_game_time
     AGENT_DIR = agent_dir
+    POTENTIAL_MAX_RATE = potential_max_rate
+    TRAJECTORY_SPILL_DIR = trajectory_spill_dir
+    TRAJECTORY_MAX_BUFFERED = trajectory_max_buffered
+    TRAJECTORY_CHUNK_ROWS = trajectory_chunk_rows
+    TRAJECTORY_ACK_TIMEOUT = trajectory_ack_timeout
+    TICK_DURATION = 1 / fps
+    ADAPTIVE_NPC_CADENCE = adaptive_npc_cadence
+    NPC_CPU_BUDGET = npc_cpu_budget
+    NPC_MAX_TICKS_PER_ACTION = npc_max_ticks_per_action
+    if planner_cache_dir is not None:
+        planner_cache.configure(planner_cache_dir)
+    if agent_cache_bytes is not None:
+        AGENT_CACHE.max_bytes = agent_cache_bytes
+    NPC_POOL = NpcWorkerPool(num_workers=num_npc_threads)
+    AGENT_HEALTH = AgentHealthMonitor(deadline=npc_deadline, slo=npc_slo, max_misses=npc_max_misses, quarantine_time=npc_quarantine_time)
+    NPC_FALLBACK_ACTION = npc_fallback_action
+    NPC_INFERENCE = npc_inference
+    if NPC_INFERENCE == 'batched':
+        INFERENCE_SERVICE = BatchedInferenceService(latency_budget=batch_latency, max_batch_size=max_batch_size)
+    elif NPC_INFERENCE == 'process':
+        POLICY_POOL = PolicyProcessPool(num_workers=num_policy_processes)
 
 def fix_bc_path(path):
     """
@@ -41,6 +116,102 @@ def fix_bc_path(path):
             
 
 
+def load_policy(agent_dir, npc_id, idx=0):
+    """
+    Loads the agent stored in `agent_dir`/`npc_id`. Module level (rather than a method) so that it can be pickled and
+    run inside PolicyProcessPool workers
+    """
+    if has_exported_agent(os.path.join(agent_dir, npc_id)):
+        try:
+            # Ray-free artifact produced by `exported_agent.py`, preferred over restoring the full trainer
+            return load_exported_agent(os.path.join(agent_dir, npc_id), agent_index=idx)
+        except Exception as e:
+            raise IOError("Error loading exported agent\n{}".format(e.__repr__()))
+    elif npc_id.lower().startswith("rllib"):
+        # Deferred so that servers that never serve rllib agents do not pay for TensorFlow and Ray
+        from human_aware_rl.rllib.rllib import load_agent
+        import ray
+        try:
+            # Loading rllib agents requires additional helpers
+            fpath = os.path.join(agent_dir, npc_id, 'agent')
+            fix_bc_path(fpath)
+            agent =  load_agent(fpath, agent_index=idx)
+            return agent
+        except Exception as e:
+            raise IOError("Error loading Rllib Agent\n{}".format(e.__repr__()))
+        finally:
+            # Always kill ray after loading agent, otherwise, ray will crash once process exits
+            if ray.is_initialized():
+                ray.shutdown()
+    else:
+        try:
+            fpath = os.path.join(agent_dir, npc_id, 'agent.pickle')
+            with open(fpath, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            raise IOError("Error loading agent\n{}".format(e.__repr__()))
+
+
+# Agents loaded by this process, shared (via cheap per-game copies) between all games
+AGENT_CACHE = AgentCache(load_policy)
+
+def load_cached_policy(agent_dir, npc_id, idx=0, cache_bytes=None):
+    """
+    Returns a per-game instance of agent `npc_id` from the AGENT_CACHE. `cache_bytes` lets PolicyProcessPool workers,
+    which have their own cache, share the server's memory budget setting
+    """
+    if cache_bytes is not None:
+        AGENT_CACHE.max_bytes = cache_bytes
+    return AGENT_CACHE.get(agent_dir, npc_id, idx)
+
+def preload_agents(npc_ids):
+    """
+    Load `npc_ids` into the AGENT_CACHE ahead of time so that the first game using them does not pay the load
+    """
+    if NPC_INFERENCE == 'process':
+        # Agents are loaded by (and cached in) the policy workers instead
+        return {}
+    return AGENT_CACHE.preload(AGENT_DIR, npc_ids)
+
+def get_mdp(layout_name, mdp_params={}):
+    """
+    Returns (mdp, start_state) for `layout_name` built with `mdp_params`, constructing the gridworld only the first time
+    a given (layout, mdp_params) pair is requested
+
+    The returned OvercookedGridworld is shared by every game in this process and must be treated as immutable. The
+    start state is a fresh copy
+    """
+    mdp, start_state = _build_mdp(layout_name, json.dumps(mdp_params, sort_keys=True))
+    return mdp, start_state.deepcopy()
+
+@lru_cache(maxsize=128)
+def _build_mdp(layout_name, mdp_params_json):
+    mdp = OvercookedGridworld.from_layout_name(layout_name, **json.loads(mdp_params_json))
+    return mdp, mdp.get_standard_start_state()
+
+def prewarm_mdps(layouts, mdp_params_list=({},)):
+    """
+    Builds the MDP for every combination of `layouts` and `mdp_params_list` ahead of time. Returns { layout : error }
+    for any layout that failed to build
+    """
+    errors = {}
+    for layout_name in layouts:
+        for mdp_params in mdp_params_list:
+            try:
+                get_mdp(layout_name, mdp_params)
+            except Exception as e:
+                errors[layout_name] = e
+    return errors
+
+
+def get_game_detail(game, tick_stats):
+    """
+    Full detail (including game state) of `game` for debugging, given the stats of the TickClock ticking it (if any).
+    Must be called while holding `game.lock`
+    """
+    return {"id" : game.id, "state" : game.to_json(), "tick_stats" : tick_stats, "npc_stats" : game.get_npc_stats()}
+
+
 class Game(ABC):
 
     """
@@ -79,6 +250,7 @@ class Game(ABC):
         pending_actions List[(Queue)]: Buffer of (player_id, action) pairs have submitted that haven't been commited yet
         lock (Lock):    Used to serialize updates to the game state
         is_active(bool): Whether the game is currently being played or not
+        created_at (float): Time (`time.time`) at which this game was created
         """
         self.players = []
         self.spectators = set()
@@ -86,6 +258,7 @@ class Game(ABC):
         self.id = kwargs.get('id', id(self))
         self.lock = Lock()
         self._is_active = False
+        self.created_at = time()
 
     @abstractmethod
     def is_full(self):
@@ -188,12 +361,14 @@ class Game(ABC):
         """ 
         if not self.is_active:
             return self.Status.INACTIVE
-        if self.needs_reset():
-            self.reset()
-            return self.Status.RESET
-
-        self.apply_actions()
-        return self.Status.DONE if self.is_finished() else self.Status.ACTIVE
+        with TICK_SECONDS.time():
+            TICKS.inc()
+            if self.needs_reset():
+                self.reset()
+                return self.Status.RESET
+
+            self.apply_actions()
+            return self.Status.DONE if self.is_finished() else self.Status.ACTIVE
     
     def enqueue_action(self, player_id, action):
         """
@@ -209,7 +384,8 @@ class Game(ABC):
             return
         try:
             player_idx = self.players.index(player_id)
-            self.pending_actions[player_idx].put(action)
+            # Never block, this is called from the tick path and from shared NPC worker threads
+            self.pending_actions[player_idx].put(action, block=False)
         except Full:
             pass
 
@@ -228,6 +404,20 @@ class Game(ABC):
         """
         return self.get_state()
 
+    def get_summary(self):
+        """
+        Return a small JSON compatible description of the game (no game state) for monitoring. Only reads plain attributes,
+        so it is safe to call without holding `self.lock`
+        """
+        return {
+            "id" : self.id,
+            "type" : type(self).__name__,
+            "active" : self._is_active,
+            "players" : list(self.players),
+            "num_spectators" : len(self.spectators),
+            "age" : time() - self.created_at
+        }
+
     def is_empty(self):
         """
         Return whether it is safe to garbage collect this game instance
@@ -287,6 +477,34 @@ class Game(ABC):
         else:
             return True
 
+    def join(self, user_id):
+        """
+        Adds user_id as a player, or as a spectator if the game is full, and activates the game if it is now ready.
+        Returns whether the game was activated
+        """
+        if self.is_full():
+            self.add_spectator(user_id)
+        else:
+            self.add_player(user_id)
+        if not self.is_ready():
+            return False
+        self.activate()
+        return True
+
+    def leave(self, user_id):
+        """
+        Removes user_id, whether they are a player or a spectator, and deactivates the game if it can't go on without
+        them. Returns whether the game was deactivated
+        """
+        if user_id in self.players:
+            self.remove_player(user_id)
+        else:
+            self.remove_spectator(user_id)
+        if not self.is_active or self.is_ready():
+            return False
+        self.deactivate()
+        return True
+
 
     def clear_pending_actions(self):
         """
@@ -306,6 +524,19 @@ class Game(ABC):
         Return any game metadata to server driver. Really only relevant for Psiturk code
         """
         return {}
+
+    def get_npc_stats(self):
+        """
+        Return any diagnostics about the game's NPC players, for debugging
+        """
+        return {}
+
+    def get_data_stream(self):
+        """
+        Return the TrajectoryStream used to upload game data to clients during play, if any. For such games the data
+        sent on reset/end is the manifest returned by `get_data_manifest` rather than `get_data`
+        """
+        return None
         
 
 
@@ -373,6 +604,160 @@ class DummyInteractiveGame(Game):
             state['player_{}_count'.format(i)] = self.counts[i]
         return state
 
+
+class PotentialEvaluator(object):
+    """
+    Computes the potential function of a game's state in a background thread, so that it never runs on the tick path
+
+    Only the most recently submitted state is ever evaluated (older unevaluated states are dropped), evaluations are
+    throttled to at most `max_rate` per second, and results are memoized by state
+
+    One evaluator serves a game for all of its layouts: `start` points it at the current layout's mdp and `pause`
+    discards anything in flight once play stops. Its thread is kept across pauses, and only exits after `idle_timeout`
+    seconds without play
+
+    Instance variables:
+        - result ((int, float)): (tick, potential) of the most recently evaluated state, or None if nothing has been
+            evaluated since the last `start`. Always replaced as a whole, so the two never mismatch
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, gamma=0.99, max_rate=10, memo_size=1024, idle_timeout=30):
+        self.gamma = gamma
+        self.min_interval = 1 / max_rate if max_rate else 0
+        self.memo_size = memo_size
+        self.idle_timeout = idle_timeout
+        self.memo = OrderedDict()
+        self.mdp = None
+        self.mp = None
+        self.result = None
+        self.latest = None
+        self.running = False
+        # Bumped on every start and pause, so evaluations that were in flight meanwhile are dropped
+        self.generation = 0
+        self.thread = None
+        self.cond = Condition()
+
+    def start(self, mdp, mp):
+        with self.cond:
+            if mdp is not self.mdp:
+                self.memo.clear()
+            self.mdp = mdp
+            self.mp = mp
+            self.result = None
+            self.latest = None
+            self.running = True
+            self.generation += 1
+            if not self.thread:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def submit(self, state, tick):
+        with self.cond:
+            self.latest = (state, tick)
+            self.cond.notify()
+
+    def pause(self):
+        with self.cond:
+            self.running = False
+            self.latest = None
+            self.generation += 1
+            self.cond.notify()
+
+    def run(self):
+        last_eval = 0
+        while True:
+            # Throttle before picking up a state, so we always evaluate the freshest one
+            wait = last_eval + self.min_interval - monotonic()
+            if wait > 0:
+                with self.cond:
+                    self.cond.wait(wait)
+            with self.cond:
+                while not (self.running and self.latest):
+                    if not self.cond.wait(self.idle_timeout) and not self.running:
+                        # Not restarted in a while, the game is most likely over. `start` spawns a new thread if not
+                        self.thread = None
+                        return
+                state, tick = self.latest
+                self.latest = None
+                generation, mdp, mp = self.generation, self.mdp, self.mp
+            last_eval = monotonic()
+            phi = self._evaluate(state, mdp, mp)
+            with self.cond:
+                if generation == self.generation:
+                    self.result = (tick, phi)
+
+    def _evaluate(self, state, mdp, mp):
+        # Only ever called from the evaluator's thread
+        if state in self.memo:
+            self.memo.move_to_end(state)
+            return self.memo[state]
+        phi = mdp.potential_function(state, mp, gamma=self.gamma)
+        self.memo[state] = phi
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+        return phi
+
+
+class CadenceController(object):
+    """
+    Picks how many ticks pass between forward passes of a single NPC, based on how long its forward passes take
+
+    The controller tracks an exponential moving average of the measured action latency and chooses the smallest
+    cadence, within [min_ticks, max_ticks], at which the NPC spends no more than `cpu_budget` of the time between
+    queries computing actions. Fast agents are queried every `min_ticks` ticks, slow ones are queried less often
+    instead of falling behind
+
+    Instance variables:
+        - ticks_per_action (int): Current cadence
+        - latency (float): Moving average of action latency, in seconds. None until the first measurement
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, min_ticks, max_ticks, tick_duration, cpu_budget=0.5, smoothing=0.2):
+        self.min_ticks = min_ticks
+        self.max_ticks = max(min_ticks, max_ticks)
+        self.tick_duration = tick_duration
+        self.cpu_budget = cpu_budget
+        self.smoothing = smoothing
+        self.ticks_per_action = min_ticks
+        self.latency = None
+        self.last_tick = 0
+        self.lock = Lock()
+
+    def reset(self, tick=0):
+        """
+        Restarts the cadence from `tick` (i.e. on a new layout) while keeping the latency measured so far
+        """
+        with self.lock:
+            self.last_tick = tick
+
+    def due(self, tick):
+        """
+        Whether the NPC should be queried on `tick`
+        """
+        with self.lock:
+            if tick - self.last_tick < self.ticks_per_action:
+                return False
+            self.last_tick = tick
+            return True
+
+    def observe(self, latency):
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            ticks = math.ceil(self.latency / (self.cpu_budget * self.tick_duration))
+            self.ticks_per_action = min(max(ticks, self.min_ticks), self.max_ticks)
+
+    def get_stats(self):
+        with self.lock:
+            return { "ticks_per_action" : self.ticks_per_action, "latency" : self.latency }
+
     
 class OvercookedGame(Game):
     """
@@ -382,13 +767,19 @@ class OvercookedGame(Game):
         - max_players (int): Maximum number of players that can be in the game at once
         - mdp (OvercookedGridworld): Controls the underlying Overcooked game logic
         - score (int): Current reward acheived by all players
+        - potential_evaluator (PotentialEvaluator): Computes the potential shown to players off the tick path, if show_potential
         - max_time (int): Number of seconds the game should last
         - npc_policies (dict): Maps user_id to policy (Agent) for each AI player
-        - npc_state_queues (dict): Mapping of NPC user_ids to LIFO queues for the policy to process
+        - npc_agent_names (dict): Maps user_id to the name of the agent directory each AI player was loaded from
+        - npc_metadata (dict): Maps user_id to the metadata of each AI player's agent (see `load_agent_metadata`)
         - curr_tick (int): How many times the game server has called this instance's `tick` method
         - ticker_per_ai_action (int): How many frames should pass in between NPC policy forward passes. 
-            Note that this is a lower bound; if the policy is computationally expensive the actual frames
-            per forward pass can be higher
+            Note that this is a lower bound; if ADAPTIVE_NPC_CADENCE is set, computationally expensive policies are
+            queried less often (see CadenceController)
+        - npc_cadences (dict): Maps user_id to the CadenceController deciding when each AI player is queried
+        - npc_waiting_since (dict): Maps user_id to the time since which each AI player has been asked for an action
+            without producing one, or None. Checked against AGENT_HEALTH.deadline every tick
+        - npc_last_actions (dict): Maps user_id to the last action computed by each AI player on the current layout
         - action_to_overcooked_action (dict): Maps action names returned by client to action names used by OvercookedGridworld
             Note that this is an instance variable and not a static variable for efficiency reasons
         - human_players (set(str)): Collection of all player IDs that correspond to humans
@@ -396,8 +787,9 @@ class OvercookedGame(Game):
         - randomized (boolean): Whether the order of the layouts should be randomized
     
     Methods:
-        - npc_policy_consumer: Background process that asynchronously computes NPC policy forward passes. One thread
-            spawned for each NPC
+        - _request_npc_action: Hands the latest state to whichever NPC backend is in use. NPC forward passes run on the
+            shared NPC_POOL, unless NPC_INFERENCE is 'batched' (shared INFERENCE_SERVICE) or the policy is a
+            RemotePolicy hosted by the POLICY_POOL
         - _curr_game_over: Determines whether the game on the current mdp has ended
     """
 
@@ -410,10 +802,14 @@ class OvercookedGame(Game):
         self.mdp = None
         self.mp = None
         self.score = 0
-        self.phi = 0
+        self.potential_evaluator = None
         self.max_time = min(int(gameTime), MAX_GAME_TIME)
         self.npc_policies = {}
-        self.npc_state_queues = {}
+        self.npc_agent_names = {}
+        self.npc_metadata = {}
+        self.npc_cadences = {}
+        self.npc_waiting_since = {}
+        self.npc_last_actions = {}
         self.action_to_overcooked_action = {
             "STAY" : Action.STAY,
             "UP" : Direction.NORTH,
@@ -424,6 +820,7 @@ class OvercookedGame(Game):
         }
         self.ticks_per_ai_action = 4
         self.curr_tick = 0
+        self.curr_layout = None
         self.human_players = set()
         self.npc_players = set()
 
@@ -434,13 +831,15 @@ class OvercookedGame(Game):
             player_zero_id = playerZero + '_0'
             self.add_player(player_zero_id, idx=0, buff_size=1, is_human=False)
             self.npc_policies[player_zero_id] = self.get_policy(playerZero, idx=0)
-            self.npc_state_queues[player_zero_id] = LifoQueue()
+            self.npc_agent_names[player_zero_id] = playerZero
+            self.npc_metadata[player_zero_id] = AGENT_CACHE.get_metadata(AGENT_DIR, playerZero) if AGENT_DIR else {}
 
         if playerOne != 'human':
             player_one_id = playerOne + '_1'
             self.add_player(player_one_id, idx=1, buff_size=1, is_human=False)
             self.npc_policies[player_one_id] = self.get_policy(playerOne, idx=1)
-            self.npc_state_queues[player_one_id] = LifoQueue()
+            self.npc_agent_names[player_one_id] = playerOne
+            self.npc_metadata[player_one_id] = AGENT_CACHE.get_metadata(AGENT_DIR, playerOne) if AGENT_DIR else {}
         
 
     def _curr_game_over(self):
@@ -468,13 +867,104 @@ class OvercookedGame(Game):
                 raise ValueError("Inconsistent state")
 
 
-    def npc_policy_consumer(self, policy_id):
-        queue = self.npc_state_queues[policy_id]
-        policy = self.npc_policies[policy_id]
-        while self._is_active:
-            state = queue.get()
-            npc_action, _ = policy.action(state)
-            super(OvercookedGame, self).enqueue_action(policy_id, npc_action)
+    def _request_npc_action(self, npc_id, state, reset=False):
+        """
+        Ask `npc_id` for an action on `state`, resetting its policy first if `reset`
+        """
+        policy = self.npc_policies[npc_id]
+        agent_name = self.npc_agent_names[npc_id]
+        if AGENT_HEALTH.is_quarantined(agent_name):
+            self._play_fallback_action(npc_id)
+            return
+        requested_at = monotonic()
+        if self.npc_waiting_since.get(npc_id, None) is None:
+            self.npc_waiting_since[npc_id] = requested_at
+        def callback(npc_action):
+            # Includes any time spent queued in the shared backend, which is part of what the NPC can sustain
+            latency = monotonic() - requested_at
+            NPC_INFERENCE_SECONDS.labels(backend).observe(latency)
+            self.npc_cadences[npc_id].observe(latency)
+            AGENT_HEALTH.record(agent_name, latency)
+            self.npc_waiting_since[npc_id] = None
+            self.npc_last_actions[npc_id] = npc_action
+            super(OvercookedGame, self).enqueue_action(npc_id, npc_action)
+        backend = self._get_backend(npc_id)
+        if backend == 'process':
+            if reset:
+                policy.reset()
+            policy.request(state, callback)
+        elif backend == 'batched':
+            # Like the pool, the service resets the policy itself, between forward passes
+            INFERENCE_SERVICE.submit(self.npc_agent_names[npc_id], (self.id, npc_id), policy, state, callback, reset=reset)
+        else:
+            # The pool resets the policy itself, once any action still being computed from a previous activation returns
+            NPC_POOL.submit((self.id, npc_id), policy, state, callback, reset=reset)
+
+    def _check_npc_deadlines(self):
+        """
+        Play the fallback action for every NPC that missed its inference deadline. Never blocks on the NPCs themselves
+        """
+        now = monotonic()
+        for npc_id, waiting_since in list(self.npc_waiting_since.items()):
+            if waiting_since is None or now - waiting_since <= AGENT_HEALTH.deadline:
+                continue
+            # Restart the clock so that a hung NPC keeps missing (and eventually gets quarantined) once per deadline.
+            # Quarantined NPCs are no longer queried, so there is nothing left to wait on
+            agent_name = self.npc_agent_names[npc_id]
+            self.npc_waiting_since[npc_id] = now
+            NPC_DEADLINE_MISSES.inc()
+            if AGENT_HEALTH.is_quarantined(agent_name) or AGENT_HEALTH.record_miss(agent_name):
+                self.npc_waiting_since[npc_id] = None
+            backend = self._get_backend(npc_id)
+            if backend == 'threads':
+                NPC_POOL.replace_hung_workers(AGENT_HEALTH.deadline * AGENT_HEALTH.max_misses)
+            elif backend == 'process':
+                POLICY_POOL.replace_hung_workers(AGENT_HEALTH.deadline * AGENT_HEALTH.max_misses)
+            self._play_fallback_action(npc_id)
+
+    def _play_fallback_action(self, npc_id):
+        action = Action.STAY
+        if NPC_FALLBACK_ACTION == 'last':
+            action = self.npc_last_actions.get(npc_id, Action.STAY)
+        super(OvercookedGame, self).enqueue_action(npc_id, action)
+
+    def get_npc_stats(self):
+        stats = {}
+        for npc_id in self.npc_policies:
+            cadence = self.npc_cadences.get(npc_id, None)
+            stats[npc_id] = {
+                "cadence" : cadence.get_stats() if cadence else None,
+                "quarantined" : AGENT_HEALTH.is_quarantined(self.npc_agent_names[npc_id]),
+                "mailbox" : NPC_POOL.get_task_stats((self.id, npc_id)) if self._uses_npc_pool(npc_id) else None
+            }
+        return stats
+
+    def _get_cadence(self, npc_id):
+        # Read when the game was created, as this runs under the game's lock
+        metadata = self.npc_metadata.get(npc_id, {})
+        min_ticks = metadata.get('min_ticks_per_action', self.ticks_per_ai_action)
+        max_ticks = metadata.get('max_ticks_per_action', NPC_MAX_TICKS_PER_ACTION) if ADAPTIVE_NPC_CADENCE else min_ticks
+        return CadenceController(min_ticks, max_ticks, TICK_DURATION, cpu_budget=NPC_CPU_BUDGET)
+
+    def _get_backend(self, npc_id):
+        """
+        Which shared backend computes the actions of `npc_id`: 'process' (POLICY_POOL), 'batched' (INFERENCE_SERVICE) or
+        'threads' (NPC_POOL). Only RLlib agents can share a forward pass, so any other agent (i.e. scripted or pickled
+        ones) runs on the NPC_POOL even in 'batched' mode. Policies built by `get_policy` overrides (i.e. TutorialAI)
+        stay local even in 'process' mode
+        """
+        policy = self.npc_policies[npc_id]
+        if isinstance(policy, RemotePolicy):
+            return 'process'
+        if NPC_INFERENCE == 'batched' and is_batchable(policy):
+            return 'batched'
+        return 'threads'
+
+    def _uses_npc_pool(self, npc_id):
+        """
+        Whether `npc_id` is served by the NPC_POOL rather than another shared backend
+        """
+        return self._get_backend(npc_id) == 'threads'
 
 
     def is_full(self):
@@ -500,10 +990,15 @@ class OvercookedGame(Game):
         pass
 
     def apply_actions(self):
+        start = monotonic()
+
         # Default joint action, as NPC policies and clients probably don't enqueue actions fast 
         # enough to produce one at every tick
         joint_action = [Action.STAY] * len(self.players)
 
+        # NPCs that are late get a fallback action rather than stalling the game
+        self._check_npc_deadlines()
+
         # Synchronize individual player actions into a joint-action as required by overcooked logic
         for i in range(len(self.players)):
             try:
@@ -515,16 +1010,18 @@ class OvercookedGame(Game):
         prev_state = self.state
         self.state, info = self.mdp.get_state_transition(prev_state, joint_action)
         if self.show_potential:
-            self.phi = self.mdp.potential_function(prev_state, self.mp, gamma=0.99)
+            # As before evaluation moved off the tick path, the potential shown is that of the state actions were taken in
+            self.potential_evaluator.submit(prev_state, self.curr_tick)
 
         # Send next state to all background consumers if needed
-        if self.curr_tick % self.ticks_per_ai_action == 0:
-            for npc_id in self.npc_policies:
-                self.npc_state_queues[npc_id].put(self.state, block=False)
+        for npc_id in self.npc_policies:
+            if self.npc_cadences[npc_id].due(self.curr_tick):
+                self._request_npc_action(npc_id, self.state)
 
         # Update score based on soup deliveries that might have occured
         curr_reward = sum(info['sparse_reward_by_agent'])
         self.score += curr_reward
+        APPLY_ACTIONS_SECONDS.observe(monotonic() - start)
 
         # Return about the current transition
         return prev_state, joint_action, info
@@ -553,32 +1050,43 @@ class OvercookedGame(Game):
             raise ValueError("Inconsistent State")
 
         self.curr_layout = self.layouts.pop()
-        self.mdp = OvercookedGridworld.from_layout_name(self.curr_layout, **self.mdp_params)
-        if self.show_potential:
-            self.mp = MotionPlanner.from_pickle_or_compute(self.mdp, counter_goals=NO_COUNTERS_PARAMS)
-        self.state = self.mdp.get_standard_start_state()
-        if self.show_potential:
-            self.phi = self.mdp.potential_function(self.state, self.mp, gamma=0.99)
+        self.mdp, self.state = get_mdp(self.curr_layout, self.mdp_params)
         self.start_time = time()
         self.curr_tick = 0
+        if self.show_potential:
+            self.mp = get_motion_planner(self.mdp, counter_goals=NO_COUNTERS_PARAMS)
+            if not self.potential_evaluator:
+                self.potential_evaluator = PotentialEvaluator(gamma=0.99, max_rate=POTENTIAL_MAX_RATE)
+            self.potential_evaluator.start(self.mdp, self.mp)
+            self.potential_evaluator.submit(self.state, self.curr_tick)
         self.score = 0
-        self.threads = []
         for npc_policy in self.npc_policies:
-            self.npc_policies[npc_policy].reset()
-            self.npc_state_queues[npc_policy].put(self.state)
-            t = Thread(target=self.npc_policy_consumer, args=(npc_policy,))
-            self.threads.append(t)
-            t.start()
+            if npc_policy not in self.npc_cadences:
+                self.npc_cadences[npc_policy] = self._get_cadence(npc_policy)
+            self.npc_cadences[npc_policy].reset(self.curr_tick)
+            self.npc_waiting_since[npc_policy] = None
+            self.npc_last_actions.pop(npc_policy, None)
+            if AGENT_HEALTH.is_quarantined(self.npc_agent_names[npc_policy]):
+                # Quarantined policies may still be stuck in a previous call, don't touch them
+                continue
+            self._request_npc_action(npc_policy, self.state, reset=True)
 
     def deactivate(self):
         super(OvercookedGame, self).deactivate()
-        # Ensure the background consumers do not hang
+        if self.potential_evaluator:
+            self.potential_evaluator.pause()
+        # Cancel outstanding NPC requests. None of the backends block on this, actions still being computed are
+        # discarded when they complete
         for npc_policy in self.npc_policies:
-            self.npc_state_queues[npc_policy].put(self.state)
-
-        # Wait for all background threads to exit
-        for t in self.threads:
-            t.join()
+            policy = self.npc_policies[npc_policy]
+            backend = self._get_backend(npc_policy)
+            if backend == 'process':
+                policy.cancel()
+            elif backend == 'batched':
+                INFERENCE_SERVICE.cancel(self.npc_agent_names[npc_policy], (self.id, npc_policy))
+            else:
+                NPC_POOL.remove((self.id, npc_policy))
+            self.npc_waiting_since[npc_policy] = None
 
         # Clear all action queues
         self.clear_pending_actions()
@@ -586,12 +1094,24 @@ class OvercookedGame(Game):
 
     def get_state(self):
         state_dict = {}
-        state_dict['potential'] = self.phi if self.show_potential else None
+        result = self.potential_evaluator.result if self.show_potential and self.potential_evaluator else None
+        state_dict['potential'] = result[1] if result else None
+        # How many ticks old the reported potential is, since it is computed asynchronously
+        state_dict['potential_age'] = self.curr_tick - result[0] if result else None
         state_dict['state'] = self.state.to_dict()
         state_dict['score'] = self.score
         state_dict['time_left'] = max(self.max_time - (time() - self.start_time), 0)
         return state_dict
 
+    def get_summary(self):
+        summary = super(OvercookedGame, self).get_summary()
+        summary['layout'] = self.curr_layout
+        summary['layouts_left'] = len(self.layouts)
+        summary['tick'] = self.curr_tick
+        summary['score'] = self.score
+        summary['npcs'] = sorted(self.npc_agent_names.values())
+        return summary
+
     def to_json(self):
         obj_dict = {}
         obj_dict['terrain'] = self.mdp.terrain_mtx if self._is_active else None
@@ -599,26 +1119,9 @@ class OvercookedGame(Game):
         return obj_dict
 
     def get_policy(self, npc_id, idx=0):
-        if npc_id.lower().startswith("rllib"):
-            try:
-                # Loading rllib agents requires additional helpers
-                fpath = os.path.join(AGENT_DIR, npc_id, 'agent')
-                fix_bc_path(fpath)
-                agent =  load_agent(fpath, agent_index=idx)
-                return agent
-            except Exception as e:
-                raise IOError("Error loading Rllib Agent\n{}".format(e.__repr__()))
-            finally:
-                # Always kill ray after loading agent, otherwise, ray will crash once process exits
-                if ray.is_initialized():
-                    ray.shutdown()
-        else:
-            try:
-                fpath = os.path.join(AGENT_DIR, npc_id, 'agent.pickle')
-                with open(fpath, 'rb') as f:
-                    return pickle.load(f)
-            except Exception as e:
-                raise IOError("Error loading agent\n{}".format(e.__repr__()))
+        if NPC_INFERENCE == 'process':
+            return POLICY_POOL.create_policy(load_cached_policy, AGENT_DIR, npc_id, idx, AGENT_CACHE.max_bytes)
+        return load_cached_policy(AGENT_DIR, npc_id, idx)
 
 
 class OvercookedPsiturk(OvercookedGame):
@@ -626,7 +1129,9 @@ class OvercookedPsiturk(OvercookedGame):
     Wrapper on OvercookedGame that handles additional housekeeping for Psiturk experiments
 
     Instance Variables:
-        - trajectory (list(dict)): list of state-action pairs in current trajectory
+        - trajectory (TrajectoryRecorder): columnar log of the transitions in the current trajectory. Spills to disk
+            once more than TRAJECTORY_MAX_BUFFERED transitions are pending
+        - trajectory_stream (TrajectoryStream): uploads the trajectory to clients in chunks during play
         - psiturk_uid (string): Unique id for each psiturk game instance (provided by Psiturk backend)
             Note, this is not the user id -- two users in the same game will have the same psiturk_uid
         - trial_id (string): Unique identifier for each psiturk trial, updated on each call to reset
@@ -634,13 +1139,15 @@ class OvercookedPsiturk(OvercookedGame):
 
     Methods:
         get_data: Returns the accumulated trajectory data and clears the self.trajectory instance variable
+        get_data_manifest: Closes the current segment of the trajectory stream and returns its manifest
     
     """
 
     def __init__(self, *args, psiturk_uid='-1', **kwargs):
         super(OvercookedPsiturk, self).__init__(*args, showPotential=False, **kwargs)
         self.psiturk_uid = psiturk_uid
-        self.trajectory = []
+        self.trajectory = TrajectoryRecorder(spill_dir=TRAJECTORY_SPILL_DIR, max_buffered=TRAJECTORY_MAX_BUFFERED, spill_prefix="{}-".format(self.id))
+        self.trajectory_stream = TrajectoryStream(self.trajectory, chunk_rows=TRAJECTORY_CHUNK_ROWS, ack_timeout=TRAJECTORY_ACK_TIMEOUT)
 
     def activate(self):
         """
@@ -649,6 +1156,9 @@ class OvercookedPsiturk(OvercookedGame):
         super(OvercookedPsiturk, self).activate()
         self.trial_id = self.psiturk_uid + str(self.start_time)
 
+        # Everything that stays constant for the duration of the trial is only logged once
+        self.trajectory.start_trial(self.trial_id, self.curr_layout, self.mdp.terrain_mtx, self.players, [player_id in self.human_players for player_id in self.players])
+
     def apply_actions(self):
         """
         Applies pending actions then logs transition data
@@ -656,34 +1166,28 @@ class OvercookedPsiturk(OvercookedGame):
         # Apply MDP logic
         prev_state, joint_action, info = super(OvercookedPsiturk, self).apply_actions()
 
-        # Log data to send to psiturk client
+        # Log data to send to psiturk client. Serialization is deferred until `get_data`
         curr_reward = sum(info['sparse_reward_by_agent'])
-        transition = {
-            "state" : json.dumps(prev_state.to_dict()),
-            "joint_action" : json.dumps(joint_action),
-            "reward" : curr_reward,
-            "time_left" : max(self.max_time - (time() - self.start_time), 0),
-            "score" : self.score,
-            "time_elapsed" : time() - self.start_time,
-            "cur_gameloop" : self.curr_tick,
-            "layout" : json.dumps(self.mdp.terrain_mtx),
-            "layout_name" : self.curr_layout,
-            "trial_id" : self.trial_id,
-            "player_0_id" : self.players[0],
-            "player_1_id" : self.players[1],
-            "player_0_is_human" : self.players[0] in self.human_players,
-            "player_1_is_human" : self.players[1] in self.human_players
-        }
-
-        self.trajectory.append(transition)
+        time_elapsed = time() - self.start_time
+        self.trajectory.record(prev_state, joint_action, curr_reward, self.score, max(self.max_time - time_elapsed, 0), time_elapsed, self.curr_tick)
 
     def get_data(self):
         """
         Returns and then clears the accumulated trajectory
         """
-        data = { "uid" : self.psiturk_uid  + "_" + str(time()), "trajectory" : self.trajectory }
-        self.trajectory = []
-        return data
+        return { "uid" : self.psiturk_uid  + "_" + str(time()), "trajectory" : self.trajectory.flush() }
+
+    def get_data_stream(self):
+        return self.trajectory_stream
+
+    def get_data_manifest(self):
+        """
+        Returns the manifest of every trajectory chunk uploaded since the last call. Clients reassemble the chunks
+        it lists into the payload `get_data` would have returned
+        """
+        manifest = self.trajectory_stream.take(final=True)
+        manifest['uid'] = self.psiturk_uid  + "_" + str(time())
+        return { "manifest" : manifest }
 
 
 class OvercookedTutorial(OvercookedGame):
@@ -0,0 +1,177 @@
+from contextlib import nullcontext
+from time import monotonic, sleep
+from utils import StateDeltaEncoder, TickClock
+from game import Game
+from metrics import GET_STATE_SECONDS
+
+# Whether `state_pong` broadcasts should only carry the changes since the previous broadcast
+STATE_DELTAS = True
+
+# Number of `state_pong` broadcasts between full-state keyframes when STATE_DELTAS is enabled
+KEYFRAME_INTERVAL = 30
+
+# How the game loop absorbs ticks that run late. One of 'catch_up', 'skip_broadcasts' or 'sleep' (see utils.TickClock)
+TICK_POLICY = 'catch_up'
+
+# Maximum number of missed ticks a game loop will try to make up before dropping them
+MAX_CATCH_UP_TICKS = 5
+
+# Number of seconds between uploads of pending trajectory chunks to clients
+TRAJECTORY_UPLOAD_INTERVAL = 5
+
+# Number of seconds between checks for acks of the final trajectory chunks of a finished game
+ACK_POLL_INTERVAL = 0.1
+
+def _configure(state_deltas=True, keyframe_interval=30, tick_policy='catch_up', max_catch_up_ticks=5, trajectory_upload_interval=5):
+    global STATE_DELTAS, KEYFRAME_INTERVAL, TICK_POLICY, MAX_CATCH_UP_TICKS, TRAJECTORY_UPLOAD_INTERVAL
+    STATE_DELTAS = state_deltas
+    KEYFRAME_INTERVAL = keyframe_interval
+    TICK_POLICY = tick_policy
+    MAX_CATCH_UP_TICKS = max_catch_up_ticks
+    TRAJECTORY_UPLOAD_INTERVAL = trajectory_upload_interval
+
+
+class GameLoop(object):
+    """
+    Applies real-time game updates and broadcasts state to all clients currently active in the game. Each
+    call to `step` is one wakeup of the game loop; all active games are stepped by a shared TickScheduler
+    rather than each running in its own background task
+
+    game (Game object):     Stores relevant game state. Note that the game id is the same as to socketio
+                            room id for all clients connected to this game
+    fps (int):              Number of game ticks that should happen every second
+    emit (callable):        `emit(event, data)` broadcasts an event to the game's room
+    spawn (callable):       `spawn(fn)` runs `fn` in a background task, i.e. `socketio.start_background_task`
+    on_finish (callable):   Called with the game once it is over, while holding the game lock, to clean it up
+    transition (callable):  Returns a context manager that the whole of `finish` runs in, i.e. a LifecycleMonitor
+                            transition
+
+    If STATE_DELTAS is set, `state_pong` payloads are produced by a per-room StateDeltaEncoder and carry
+    either a full keyframe or only the changes since the previous pong (see `static/js/state_sync.js`)
+
+    Ticks are paced by a TickClock against absolute deadlines, so the number of MDP steps per second does not
+    depend on how long ticking and broadcasting take. How overrun is absorbed is determined by TICK_POLICY
+
+    For games with a data stream (i.e. Psiturk), game data is uploaded as `trajectory_chunk` events every
+    TRAJECTORY_UPLOAD_INTERVAL seconds from a background task, and `reset_game`/`end_game` only carry a manifest.
+    Once the game is over, it is only cleaned up after the players still in it acked every chunk (chunks are re-sent
+    as usual meanwhile), or after twice the stream's ack timeout, so that the last chunks get retransmitted too
+
+    If stepping raises, the scheduler drops the loop and calls `abort`, which finishes the game all the same. The game
+    is always deactivated and handed to `on_finish`, even if collecting or uploading its data fails
+    """
+
+    def __init__(self, game, fps=30, emit=None, spawn=None, on_finish=None, transition=nullcontext):
+        self.game = game
+        self.status = Game.Status.ACTIVE
+        self.encoder = StateDeltaEncoder(keyframe_interval=KEYFRAME_INTERVAL)
+        self.clock = TickClock(fps=fps, policy=TICK_POLICY, max_catch_up=MAX_CATCH_UP_TICKS)
+        self.stream = game.get_data_stream()
+        self.next_upload = monotonic() + TRAJECTORY_UPLOAD_INTERVAL
+        self.uploading = False
+        self.emit = emit
+        self.spawn = spawn
+        self.on_finish = on_finish
+        self.transition = transition
+
+    def __repr__(self):
+        return "GameLoop(id={})".format(self.game.id)
+
+    def step(self):
+        """
+        Tick the game as many times as the clock says is due and broadcast the result. Returns the time at which
+        this loop should next be stepped, or None if the game is over
+        """
+        game = self.game
+        upload = False
+        if not game.lock.acquire(blocking=False):
+            # A socket handler is mid-update on this game, retry a tick later rather than stall every other game. Retrying
+            # straight away would spin the scheduler, and so starve the handler, as no steps were taken off the clock
+            return max(self.clock.next_tick_time(), monotonic() + self.clock.period)
+        try:
+            for _ in range(self.clock.steps_due()):
+                self.status = game.tick()
+                if self.status != Game.Status.ACTIVE:
+                    break
+            if self.status == Game.Status.RESET:
+                data = self.take_data()
+                upload = self.stream is not None
+            elif self.stream and monotonic() >= self.next_upload:
+                # Only detaches the pending transitions, serialization happens in the upload task
+                self.stream.take()
+                self.next_upload = monotonic() + TRAJECTORY_UPLOAD_INTERVAL
+                upload = True
+        finally:
+            game.lock.release()
+
+        if upload and not self.uploading:
+            self.uploading = True
+            self.spawn(self.upload)
+
+        if self.status == Game.Status.DONE or self.status == Game.Status.INACTIVE:
+            # Teardown joins NPC threads, so keep it off the scheduler
+            self.spawn(self.finish)
+            return None
+
+        if self.status == Game.Status.RESET:
+            self.emit('reset_game', { "state" : game.to_json(), "timeout" : game.reset_timeout, "data" : data})
+            # Clients rebuild their graphics from scratch on reset so the next pong must be a full state
+            self.encoder.request_keyframe()
+            self.clock.pause(game.reset_timeout/1000)
+        elif not self.clock.should_broadcast():
+            pass
+        else:
+            with GET_STATE_SECONDS.time():
+                state = game.get_state()
+            self.emit('state_pong', self.encoder.encode(state) if STATE_DELTAS else { "state" : state })
+        return self.clock.next_tick_time()
+
+    def take_data(self):
+        # Must be called while holding the game lock
+        if self.stream:
+            return self.game.get_data_manifest()
+        return self.game.get_data()
+
+    def upload(self):
+        try:
+            self.stream.retransmit(self.emit_chunk)
+            self.stream.drain(self.emit_chunk, recipients=self.game.human_players)
+        finally:
+            self.uploading = False
+
+    def emit_chunk(self, chunk):
+        self.emit('trajectory_chunk', chunk)
+
+    def abort(self):
+        # Called by the scheduler if `step` raised, which dropped this loop. Without finishing, the game would never be
+        # cleaned up and the transition started by its last player leaving (if any) would stay in flight
+        if self.status == Game.Status.ACTIVE or self.status == Game.Status.RESET:
+            self.status = Game.Status.DONE
+        self.spawn(self.finish)
+
+    def finish(self):
+        game = self.game
+        try:
+            with game.lock:
+                # Only detaches the remaining transitions, they are serialized below
+                data = self.take_data()
+            if self.stream:
+                # The remaining chunks must reach clients before the manifest that refers to them
+                self.stream.drain(self.emit_chunk, recipients=game.human_players)
+            self.emit('end_game', { "status" : self.status, "data" : data })
+            if self.stream:
+                self.await_acks()
+        finally:
+            with self.transition(), game.lock:
+                try:
+                    if self.status != Game.Status.INACTIVE:
+                        game.deactivate()
+                finally:
+                    self.on_finish(game)
+
+    def await_acks(self):
+        # Players leaving meanwhile are not waited on, and the game is not stepped anymore so nothing else is recorded
+        deadline = monotonic() + 2 * self.stream.ack_timeout
+        while self.stream.has_unacked(self.game.human_players) and monotonic() < deadline:
+            self.stream.retransmit(self.emit_chunk)
+            sleep(ACK_POLL_INTERVAL)
@@ -0,0 +1,68 @@
+"""
+Import-time benchmark for the server's Python modules
+
+Imports each module in a fresh interpreter with `-X importtime` and reports the cumulative import time along with the
+heaviest dependencies. Exits with a non-zero status if a module takes longer than `--max_seconds` to import, or if it
+(transitively) imports any of the heavy ML packages that must only ever be loaded lazily
+
+Usage (from the server directory):
+
+    python import_benchmark.py
+    python import_benchmark.py game app --max_seconds 3
+"""
+import argparse, subprocess, sys
+
+# Packages that must never be imported just by importing a server module
+FORBIDDEN_PACKAGES = ['ray', 'tensorflow', 'human_aware_rl', 'torch']
+
+
+def measure_import(module, repeats=3):
+    """
+    Returns (best cumulative import time in seconds, {package : cumulative seconds}) for importing `module` from scratch
+    """
+    best, best_packages = None, None
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError("Failed to import {}\n{}".format(module, proc.stderr))
+        packages = _parse_importtime(proc.stderr)
+        elapsed = packages.get(module, 0)
+        if best is None or elapsed < best:
+            best, best_packages = elapsed, packages
+    return best, best_packages
+
+def _parse_importtime(output):
+    # Lines look like "import time:       123 |       4567 | package.name"
+    packages = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        packages[name.strip()] = int(cumulative) / 1e6
+    return packages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Guard against import time regressions in server modules")
+    parser.add_argument('modules', nargs='*', default=['game'], help="Modules to benchmark")
+    parser.add_argument('--max_seconds', type=float, default=5.0, help="Fail if any module takes longer than this to import")
+    parser.add_argument('--top', type=int, default=10, help="Number of heaviest top-level packages to report")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        elapsed, packages = measure_import(module)
+        top_level = sorted(((t, name) for name, t in packages.items() if '.' not in name and name != module), reverse=True)
+        print("{}: {:.3f}s".format(module, elapsed))
+        for t, name in top_level[:args.top]:
+            print("    {:<30} {:.3f}s".format(name, t))
+
+        forbidden = sorted(set(name.split('.')[0] for name in packages) & set(FORBIDDEN_PACKAGES))
+        if forbidden:
+            print("FAIL: importing {} pulls in {}".format(module, ', '.join(forbidden)))
+            failed = True
+        if elapsed > args.max_seconds:
+            print("FAIL: importing {} took longer than {}s".format(module, args.max_seconds))
+            failed = True
+
+    sys.exit(1 if failed else 0)
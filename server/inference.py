@@ -0,0 +1,705 @@
+from threading import Lock, Thread, Condition, Event, get_ident
+from queue import Queue
+from time import monotonic, sleep
+from weakref import WeakValueDictionary, finalize
+from overcooked_ai_py.mdp.actions import Action
+from multiprocessing import Pipe
+from utils import Mailbox, start_spawned_process
+import numpy as np
+import itertools, logging, pickle, sys
+
+
+class BatchedInferenceService(object):
+    """
+    Collects pending NPC states from every game and computes actions for all NPCs that share an agent in a
+    single batched forward pass
+
+    Requests are grouped by agent key (the agent directory name). Each key gets one background worker that
+    waits until a request arrives, keeps collecting requests for at most `latency_budget` seconds (or until
+    `max_batch_size` are pending), then computes all of the batch's actions at once and hands each action to
+    the callback it was submitted with.
+
+    Each request is identified by a `request_id` (i.e. (game_id, npc_id)). Submitting a new state for a
+    request that is still pending replaces the stale state rather than queueing behind it. `cancel` never blocks: an
+    action that is still being computed when its request is cancelled is discarded once the batch completes. Resets
+    requested through `submit` are applied by the worker between batches, so they never race a forward pass
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, latency_budget=0.005, max_batch_size=32):
+        self.latency_budget = latency_budget
+        self.max_batch_size = max_batch_size
+        self.batchers = {}
+        self.lock = Lock()
+
+    def submit(self, key, request_id, agent, state, callback, reset=False):
+        """
+        Queue `state` to be acted on by `agent`. `callback(action)` is invoked from a worker thread once the action is
+        ready. If `reset`, `agent.reset()` is called by the worker before acting on `state`
+        """
+        with self.lock:
+            if key not in self.batchers:
+                self.batchers[key] = _AgentBatcher(key, self.latency_budget, self.max_batch_size)
+            batcher = self.batchers[key]
+        batcher.submit(request_id, agent, state, callback, reset)
+
+    def cancel(self, key, request_id):
+        """
+        Drop the pending request `request_id`, and the result of any action being computed for it. Used when a game is
+        deactivated
+        """
+        batcher = self.batchers.get(key, None)
+        if batcher:
+            batcher.cancel(request_id)
+
+    def get_stats(self):
+        return { key : batcher.get_stats() for key, batcher in list(self.batchers.items()) }
+
+
+class _AgentBatcher(object):
+    """
+    Background worker computing batched actions for all requests sharing one agent key
+    """
+
+    def __init__(self, key, latency_budget, max_batch_size):
+        self.key = key
+        self.latency_budget = latency_budget
+        self.max_batch_size = max_batch_size
+        self.pending = {}
+        # Only requests in flight (i.e. part of the running batch) have a generation, bumped when they are cancelled
+        self.generations = {}
+        self.running = set()
+        self.resets = set()
+        self.cond = Condition()
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_superseded = 0
+        self.num_discarded = 0
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request_id, agent, state, callback, reset=False):
+        with self.cond:
+            if request_id in self.pending:
+                self.num_superseded += 1
+            if reset:
+                self.resets.add(request_id)
+            self.pending[request_id] = (agent, state, callback, self.generations.get(request_id, 0))
+            self.cond.notify()
+
+    def cancel(self, request_id):
+        with self.cond:
+            self.pending.pop(request_id, None)
+            self.resets.discard(request_id)
+            if request_id in self.running:
+                self.generations[request_id] = self.generations.get(request_id, 0) + 1
+            else:
+                self.generations.pop(request_id, None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+                # Give other games a chance to join this batch, within our latency budget
+                deadline = monotonic() + self.latency_budget
+                while len(self.pending) < self.max_batch_size:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+
+                request_ids = list(self.pending)[:self.max_batch_size]
+                batch = [self.pending.pop(request_id) for request_id in request_ids]
+                resets = [request_id in self.resets for request_id in request_ids]
+                self.resets.difference_update(request_ids)
+                self.running.update(request_ids)
+
+            agents, states, callbacks, generations = zip(*batch)
+            try:
+                # Like NpcWorkerPool, run the forward pass off the hub so a hung one cannot stall every game
+                for agent, reset in zip(agents, resets):
+                    if reset:
+                        _call_policy(agent.reset)
+                actions = _call_policy(batch_actions, agents, states)
+            except Exception:
+                # NPCs in this batch simply STAY until their next state is submitted
+                logging.getLogger(__name__).exception("Batched inference failed for agent {}".format(self.key))
+                actions = None
+            with self.cond:
+                # Requests cancelled while the batch ran belong to a game that was deactivated (i.e. reset) since
+                current = [generation == self.generations.get(request_id, 0) for request_id, generation in zip(request_ids, generations)]
+                self.running.difference_update(request_ids)
+                for request_id in request_ids:
+                    if request_id not in self.pending:
+                        self.generations.pop(request_id, None)
+                if actions is None:
+                    continue
+                self.num_batches += 1
+                self.num_requests += len(batch)
+                self.num_discarded += current.count(False)
+            for callback, action, is_current in zip(callbacks, actions, current):
+                if is_current:
+                    callback(action)
+
+    def get_stats(self):
+        return {
+            "batches" : self.num_batches,
+            "requests" : self.num_requests,
+            "superseded" : self.num_superseded,
+            "discarded" : self.num_discarded,
+            "mean_batch_size" : self.num_requests / self.num_batches if self.num_batches else 0
+        }
+
+
+def is_batchable(agent):
+    """
+    Whether `agent` exposes the RLlib policy interface (see `human_aware_rl.rllib.rllib.RlLibAgent`)
+    """
+    return all(hasattr(agent, attr) for attr in ('policy', 'featurize', 'agent_index', 'rnn_state'))
+
+def batch_actions(agents, states):
+    """
+    Returns one action per (agent, state) pair. RLlib agents are evaluated with a single `compute_actions` call on
+    the first agent's policy (all agents in a batch are loaded from the same checkpoint); any other agent falls
+    back to its own `action` method
+    """
+    if not all(is_batchable(agent) for agent in agents):
+        return [agent.action(state)[0] for agent, state in zip(agents, states)]
+
+    obs = np.array([agent.featurize(state)[agent.agent_index] for agent, state in zip(agents, states)])
+    num_rnn_states = len(agents[0].rnn_state)
+    rnn_state = [np.concatenate([agent.rnn_state[i] for agent in agents]) for i in range(num_rnn_states)]
+    _, rnn_state, info = agents[0].policy.compute_actions(obs, rnn_state)
+
+    # Sample from the action distribution (rather than taking the argmax) to match RlLibAgent.action
+    logits = info["action_dist_inputs"]
+    logits = logits - np.max(logits, axis=1, keepdims=True)
+    probs = np.exp(logits) / np.sum(np.exp(logits), axis=1, keepdims=True)
+
+    actions = []
+    for i, agent in enumerate(agents):
+        action_idx = np.random.choice(len(Action.ALL_ACTIONS), p=probs[i])
+        actions.append(Action.INDEX_TO_ACTION[action_idx])
+        agent.rnn_state = [state[i:i+1] for state in rnn_state]
+    return actions
+
+
+class NpcWorkerPool(object):
+    """
+    Fixed-size pool of threads computing `policy.action(state)` for the NPCs of every game, replacing one consumer
+    thread per NPC
+
+    Each NPC is a task identified by a key (i.e. (game_id, npc_id)) with a single-slot Mailbox of pending states, so
+    only its freshest state is ever acted on. A task is never run by two workers at once, so policies do not need to
+    be thread safe. `cancel` and `remove` never block: an action that is still being computed when its task is
+    cancelled is simply discarded once it completes. A removed task is only forgotten once it is no longer in flight,
+    so a task resubmitted in the meantime (i.e. when a game is reactivated) still waits for the running call, and so
+    does the `reset` of its policy
+
+    Policies are run on real OS threads even when the server is monkey patched by eventlet (see `_call_policy`), so
+    that a CPU bound or hanging policy cannot block the hub, and with it the watchdog calling `replace_hung_workers`
+
+    Workers stuck in a single call can be replaced with `replace_hung_workers`, so that a hanging policy cannot
+    permanently take capacity away from every other NPC. At most `num_workers` workers are ever replaced at once
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, num_workers=8):
+        self.num_workers = num_workers
+        self.tasks = {}
+        self.ready = Queue()
+        self.lock = Lock()
+        self.workers = []
+        self.worker_ids = itertools.count()
+        self.busy_since = {}
+        self.abandoned = set()
+        self.num_completed = 0
+        self.num_discarded = 0
+        self.num_failed = 0
+        self.num_replaced = 0
+
+    def _ensure_started(self):
+        # Workers are started lazily so that importing/configuring the module does not spawn threads
+        if not self.workers:
+            for _ in range(self.num_workers):
+                self._start_worker()
+
+    def _start_worker(self):
+        t = Thread(target=self.run, args=(next(self.worker_ids),), daemon=True)
+        t.start()
+        self.workers.append(t)
+
+    def replace_hung_workers(self, timeout):
+        """
+        Start a replacement for every worker that has been computing a single action for more than `timeout` seconds.
+        Replaced workers exit once their call eventually returns
+        """
+        now = monotonic()
+        with self.lock:
+            for worker_id, started in list(self.busy_since.items()):
+                if now - started <= timeout or worker_id in self.abandoned or len(self.abandoned) >= self.num_workers:
+                    continue
+                self.abandoned.add(worker_id)
+                self.num_replaced += 1
+                self._start_worker()
+
+    def submit(self, key, policy, state, callback, reset=False):
+        """
+        Replace the pending state of task `key` with `state`. `callback(action)` is invoked from a worker thread.
+        If `reset`, `policy.reset()` is called by the worker before acting on `state`, i.e. once any action still
+        being computed for `key` has returned
+        """
+        with self.lock:
+            self._ensure_started()
+            task = self.tasks.get(key, None)
+            if not task:
+                task = self.tasks[key] = _NpcTask(key)
+            task.removed = False
+            task.needs_reset = task.needs_reset or reset
+            task.mailbox.put((policy, state, callback, task.generation))
+            if not task.scheduled:
+                task.scheduled = True
+                self.ready.put(task)
+
+    def cancel(self, key):
+        """
+        Drop the pending state of task `key`, and the result of any action being computed for it
+        """
+        with self.lock:
+            task = self.tasks.get(key, None)
+            if task:
+                task.generation += 1
+                task.mailbox.clear()
+
+    def remove(self, key):
+        """
+        Cancel task `key` and forget about it once it is no longer in flight. Used when a game is deactivated
+        """
+        with self.lock:
+            task = self.tasks.get(key, None)
+            if task:
+                task.generation += 1
+                task.mailbox.clear()
+                if task.scheduled:
+                    task.removed = True
+                else:
+                    del self.tasks[key]
+
+    def run(self, worker_id):
+        while True:
+            task = self.ready.get()
+            with self.lock:
+                item = task.mailbox.get(timeout=0)
+                if item is None:
+                    task.scheduled = False
+                    if task.removed and self.tasks.get(task.key, None) is task:
+                        del self.tasks[task.key]
+                    continue
+                self.busy_since[worker_id] = monotonic()
+                reset, task.needs_reset = task.needs_reset, False
+            policy, state, callback, generation = item
+            action = None
+            try:
+                if reset:
+                    _call_policy(policy.reset)
+                action, _ = _call_policy(policy.action, state)
+            except Exception:
+                logging.getLogger(__name__).exception("NPC inference failed for {}".format(task.key))
+            with self.lock:
+                del self.busy_since[worker_id]
+                replaced = worker_id in self.abandoned
+                if replaced:
+                    self.abandoned.discard(worker_id)
+                    self.workers = [t for t in self.workers if t.is_alive() and t.ident != get_ident()]
+                if action is None:
+                    self.num_failed += 1
+                elif generation != task.generation:
+                    self.num_discarded += 1
+                    action = None
+                else:
+                    self.num_completed += 1
+            if action is not None:
+                callback(action)
+            # Still marked as scheduled, so check for a state that arrived while we were busy
+            self.ready.put(task)
+            if replaced:
+                return
+
+    def get_task_stats(self, key):
+        task = self.tasks.get(key, None)
+        return task.mailbox.get_stats() if task else None
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "workers" : len(self.workers),
+                "busy" : len(self.busy_since),
+                "hung" : len(self.abandoned),
+                "replaced" : self.num_replaced,
+                "tasks" : len(self.tasks),
+                "ready" : self.ready.qsize(),
+                "completed" : self.num_completed,
+                "discarded" : self.num_discarded,
+                "failed" : self.num_failed
+            }
+
+
+class _NpcTask(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.mailbox = Mailbox()
+        self.generation = 0
+        self.scheduled = False
+        self.removed = False
+        self.needs_reset = False
+
+
+def _call_policy(fn, *args):
+    # Under eventlet's monkey patching our "threads" are greenlets, so run the call on one of eventlet's real OS
+    # threads instead. Otherwise it would block the hub until it returned
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher, tpool
+        if patcher.is_monkey_patched('thread'):
+            return tpool.execute(fn, *args)
+    return fn(*args)
+
+
+class AgentHealthMonitor(object):
+    """
+    Process-wide record of how well each agent meets its inference deadlines, shared by every game and backend
+
+    Games report every completed action (`record`) and every time an NPC went `deadline` seconds without producing
+    an action (`record_miss`). An agent that misses `max_misses` deadlines in a row is quarantined for
+    `quarantine_time` seconds, during which games stop querying it and play a fallback action instead. Completed
+    actions slower than `slo` seconds are counted as latency SLO violations
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, deadline=0.5, slo=0.1, max_misses=3, quarantine_time=300):
+        self.deadline = deadline
+        self.slo = slo
+        self.max_misses = max_misses
+        self.quarantine_time = quarantine_time
+        self.agents = {}
+        self.lock = Lock()
+
+    def _agent(self, agent_name):
+        if agent_name not in self.agents:
+            self.agents[agent_name] = { "actions" : 0, "slo_violations" : 0, "misses" : 0, "consecutive_misses" : 0, "quarantines" : 0, "quarantined_until" : 0 }
+        return self.agents[agent_name]
+
+    def record(self, agent_name, latency):
+        with self.lock:
+            agent = self._agent(agent_name)
+            agent['actions'] += 1
+            if latency > self.slo:
+                agent['slo_violations'] += 1
+            if latency <= self.deadline:
+                agent['consecutive_misses'] = 0
+
+    def record_miss(self, agent_name):
+        """
+        Returns True if this miss got the agent quarantined
+        """
+        with self.lock:
+            agent = self._agent(agent_name)
+            agent['misses'] += 1
+            agent['consecutive_misses'] += 1
+            if agent['consecutive_misses'] < self.max_misses or agent['quarantined_until'] > monotonic():
+                return False
+            agent['consecutive_misses'] = 0
+            agent['quarantines'] += 1
+            agent['quarantined_until'] = monotonic() + self.quarantine_time
+            logging.getLogger(__name__).warning("Quarantining agent {} for {}s after {} missed deadlines".format(agent_name, self.quarantine_time, self.max_misses))
+            return True
+
+    def is_quarantined(self, agent_name):
+        agent = self.agents.get(agent_name, None)
+        return bool(agent) and agent['quarantined_until'] > monotonic()
+
+    def get_stats(self):
+        now = monotonic()
+        with self.lock:
+            stats = {}
+            for agent_name, agent in self.agents.items():
+                stats[agent_name] = { key : value for key, value in agent.items() if key != 'quarantined_until' }
+                stats[agent_name]['quarantined_for'] = max(agent['quarantined_until'] - now, 0)
+            return stats
+
+
+class PolicyProcessPool(object):
+    """
+    Runs NPC policies in dedicated worker processes so that their forward passes do not hold the server's GIL
+
+    Each policy created through `create_policy` is loaded inside (and pinned to) the least loaded worker, which
+    reports back whether loading succeeded. States are sent to the worker over a pipe and actions come back the same
+    way; a single reader task in the server process polls the pipes and routes every action to the callback it was
+    requested with.
+
+    At most one request per policy is in flight at a time. A state submitted while the previous one is still
+    being evaluated replaces any other waiting state and is sent as soon as the in-flight action returns
+
+    Workers are started lazily, on the first call to `create_policy`, with `start_spawned_process` so that they
+    neither inherit the server's eventlet hub or sockets nor re-run the server's main module
+
+    Workers stuck in a single request can be replaced with `replace_hung_workers`, which kills them, starts a new
+    worker in their place and reloads every policy pinned to them. Requests in flight on a replaced worker never
+    return an action
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, num_workers=2, poll_interval=0.001, load_timeout=120):
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self.load_timeout = load_timeout
+        self.workers = []
+        self.policies = WeakValueDictionary()
+        self.loading = {}
+        self.loaders = {}
+        self.num_assigned = [0] * num_workers
+        self.num_replaced = 0
+        self.lock = Lock()
+        self._ids = itertools.count()
+
+    def _ensure_started(self):
+        if self.workers:
+            return
+        for _ in range(self.num_workers):
+            self.workers.append(self._start_worker())
+        Thread(target=self._read_actions, daemon=True).start()
+
+    def _start_worker(self):
+        conn, worker_conn = Pipe()
+        process = start_spawned_process(_policy_worker, worker_conn)
+        return (process, conn, Lock())
+
+    def create_policy(self, loader, *loader_args):
+        """
+        Returns a RemotePolicy for the agent built by `loader(*loader_args)` inside a worker process. Both `loader` and
+        its arguments must be picklable. Waits for the agent to be loaded, and raises whatever `loader` raised (or a
+        RuntimeError if the worker did not answer within `load_timeout` seconds)
+        """
+        with self.lock:
+            self._ensure_started()
+            worker_idx = self.num_assigned.index(min(self.num_assigned))
+            self.num_assigned[worker_idx] += 1
+            policy = RemotePolicy(self, next(self._ids), worker_idx)
+            self.policies[policy.id] = policy
+            # Kept to reload the policy if its worker is replaced
+            self.loaders[policy.id] = (loader, loader_args)
+        # Released (and closed in the worker) once the policy is garbage collected, whether or not it loaded
+        finalize(policy, self._release, policy.id, worker_idx)
+        loaded = self.loading[policy.id] = [Event(), None]
+        try:
+            self.send(worker_idx, ('load', policy.id, loader, loader_args))
+            if not loaded[0].wait(self.load_timeout):
+                raise RuntimeError("Policy worker {} did not load {} in time".format(worker_idx, loader_args))
+        finally:
+            self.loading.pop(policy.id, None)
+        if loaded[1] is not None:
+            raise loaded[1]
+        return policy
+
+    def _release(self, policy_id, worker_idx):
+        with self.lock:
+            self.num_assigned[worker_idx] -= 1
+            self.loaders.pop(policy_id, None)
+        self.send(worker_idx, ('close', policy_id))
+
+    def replace_hung_workers(self, timeout):
+        """
+        Replace every worker that has been computing a single action for more than `timeout` seconds. The policies
+        pinned to a replaced worker are reloaded in its replacement, and any state waiting on them is sent there next
+        """
+        now = monotonic()
+        failed = []
+        with self.lock:
+            policies = list(self.policies.values())
+            hung = { policy.worker_idx for policy in policies if policy.is_hung(now, timeout) }
+            for worker_idx in hung:
+                # Swap the worker out before killing it, so that a send failing because of the kill is retried on its
+                # replacement
+                old = self.workers[worker_idx]
+                self.workers[worker_idx] = self._start_worker()
+                old[0].kill()
+                self.num_replaced += 1
+                logging.getLogger(__name__).error("Replaced policy worker {}, stuck for more than {}s".format(worker_idx, timeout))
+                for policy in policies:
+                    if policy.worker_idx == worker_idx and policy.id in self.loaders:
+                        loader, loader_args = self.loaders[policy.id]
+                        self.send(worker_idx, ('load', policy.id, loader, loader_args))
+                        failed.append(policy)
+        # Only once their policies are queued for loading, so that waiting states follow them
+        for policy in failed:
+            policy._on_action(None)
+
+    def send(self, worker_idx, msg):
+        while True:
+            worker = self.workers[worker_idx]
+            _, conn, lock = worker
+            with lock:
+                try:
+                    conn.send(msg)
+                    return
+                except OSError:
+                    if self.workers[worker_idx] is worker:
+                        raise
+
+    def _read_actions(self):
+        # Poll rather than block on recv so this plays nicely with eventlet's cooperative scheduling
+        while True:
+            received = False
+            for worker_idx, (_, conn, _) in enumerate(list(self.workers)):
+                try:
+                    # Anything left in the pipe of a replaced worker is stale, its policies live in the replacement
+                    while conn.poll() and self.workers[worker_idx][1] is conn:
+                        kind, policy_id, result = conn.recv()
+                        received = True
+                        if kind == 'loaded':
+                            self._route_loaded(policy_id, result)
+                        else:
+                            self._route_action(policy_id, result)
+                except (EOFError, OSError):
+                    if self.workers[worker_idx][1] is not conn:
+                        continue
+                    # Worker died (i.e. server shutting down)
+                    return
+            if not received:
+                sleep(self.poll_interval)
+
+    def _route_loaded(self, policy_id, err):
+        loaded = self.loading.get(policy_id, None)
+        if loaded:
+            loaded[1] = err
+            loaded[0].set()
+
+    def _route_action(self, policy_id, action):
+        # Kept out of the polling loop so we never hold a strong reference that would keep a dead game's policy alive
+        policy = self.policies.get(policy_id, None)
+        if policy:
+            policy._on_action(action)
+
+    def get_stats(self):
+        return {
+            "workers" : len(self.workers),
+            "alive" : sum(process.is_alive() for process, _, _ in self.workers),
+            "policies_per_worker" : list(self.num_assigned),
+            "replaced" : self.num_replaced
+        }
+
+
+class RemotePolicy(object):
+    """
+    Server-side handle to an agent that lives in a PolicyProcessPool worker
+
+    Unlike local agents, actions are requested asynchronously through `request`
+    """
+
+    def __init__(self, pool, policy_id, worker_idx):
+        self.pool = pool
+        self.id = policy_id
+        self.worker_idx = worker_idx
+        self.lock = Lock()
+        self.in_flight = None
+        self.in_flight_since = None
+        self.waiting = None
+        self.num_requests = 0
+        self.num_superseded = 0
+
+    def reset(self):
+        self.pool.send(self.worker_idx, ('reset', self.id))
+
+    def request(self, state, callback):
+        """
+        Asynchronously compute an action for `state`. `callback(action)` is invoked from the pool's reader task
+        """
+        with self.lock:
+            self.num_requests += 1
+            if self.in_flight:
+                if self.waiting:
+                    self.num_superseded += 1
+                self.waiting = (state, callback)
+                return
+            self.in_flight = callback
+            self.in_flight_since = monotonic()
+        self.pool.send(self.worker_idx, ('act', self.id, state))
+
+    def is_hung(self, now, timeout):
+        """
+        Whether the in-flight request (if any) was sent more than `timeout` seconds before `now`
+        """
+        with self.lock:
+            return self.in_flight is not None and now - self.in_flight_since > timeout
+
+    def cancel(self):
+        """
+        Forget about any waiting or in-flight requests. The in-flight action (if any) will still arrive but is dropped
+        """
+        with self.lock:
+            self.waiting = None
+            if self.in_flight:
+                self.in_flight = _drop_action
+
+    def _on_action(self, action):
+        with self.lock:
+            callback = self.in_flight
+            self.in_flight = None
+            if self.waiting:
+                state, self.in_flight = self.waiting
+                self.in_flight_since = monotonic()
+                self.waiting = None
+                self.pool.send(self.worker_idx, ('act', self.id, state))
+        if callback and action is not None:
+            callback(action)
+
+
+def _drop_action(action):
+    pass
+
+def _policy_worker(conn):
+    """
+    Entry point of PolicyProcessPool workers. Serves ('load' | 'reset' | 'act' | 'close', policy_id, ...) messages until the pipe closes.
+    Answers every 'load' with ('loaded', policy_id, error or None) and every 'act' with ('action', policy_id, action or None)
+    """
+    agents = {}
+    logger = logging.getLogger(__name__)
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+        kind, policy_id = msg[0], msg[1]
+        try:
+            if kind == 'load':
+                loader, loader_args = msg[2], msg[3]
+                agents[policy_id] = loader(*loader_args)
+                conn.send(('loaded', policy_id, None))
+            elif kind == 'reset':
+                agents[policy_id].reset()
+            elif kind == 'act':
+                action, _ = agents[policy_id].action(msg[2])
+                conn.send(('action', policy_id, action))
+            elif kind == 'close':
+                agents.pop(policy_id, None)
+        except Exception as e:
+            logger.exception("Policy worker failed to handle '{}' for policy {}".format(kind, policy_id))
+            if kind == 'load':
+                conn.send(('loaded', policy_id, _picklable_error(e)))
+            elif kind == 'act':
+                # Let the server know this request is finished so it does not stall the policy
+                conn.send(('action', policy_id, None))
+
+def _picklable_error(e):
+    # Loader errors are re-raised in the server, which might not be able to unpickle i.e. Ray's exceptions
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(e.__repr__())
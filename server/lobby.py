@@ -0,0 +1,122 @@
+from threading import Lock
+from collections import OrderedDict, deque
+from time import monotonic
+from metrics import Histogram
+import json
+
+# Game parameters that identify a single user rather than the game they want to play, and so never prevent a match
+PER_USER_PARAMS = ('psiturk_uid',)
+
+LOBBY_WAIT_SECONDS = Histogram('overcooked_lobby_wait_seconds', "Time a waiting game spent in the lobby before being joined", buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+
+
+def lobby_key(game_name, params):
+    """
+    Returns a hashable key identifying the configuration of a game created as `game_name` with `params`. Two games
+    are compatible (i.e. a user asking for one may be matched with the other) iff their keys are equal
+    """
+    params = { key : value for key, value in params.items() if key not in PER_USER_PARAMS }
+    return json.dumps([game_name, params], sort_keys=True)
+
+
+class Lobby(object):
+    """
+    Index of the games waiting for players, grouped by configuration (see `lobby_key`)
+
+    Every game is in the lobby at most once, and `take` hands each one out to a single caller until it is added again.
+    Adding, taking and removing a game are all O(1), so games that are cleaned up while waiting never linger in the lobby.
+    `take` returns the game object itself rather than its id, which might be reused by a new game by the time the
+    caller looks it up
+
+    Instance variables:
+        - by_key (dict): Maps configuration keys to an OrderedDict of game_id -> (time since which it has been waiting,
+            game), oldest first
+        - keys (OrderedDict): Maps the id of every waiting game to its configuration key, oldest first
+        - waits (deque(float)): Time the most recently matched games spent waiting
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, history=1000):
+        self.lock = Lock()
+        self.by_key = {}
+        self.keys = OrderedDict()
+        self.waits = deque(maxlen=history)
+        self.num_matched = 0
+        self.num_removed = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, game_id):
+        return game_id in self.keys
+
+    def add(self, game, key):
+        with self.lock:
+            self._pop(game.id)
+            self.by_key.setdefault(key, OrderedDict())[game.id] = (monotonic(), game)
+            self.keys[game.id] = key
+
+    def take(self, key=None):
+        """
+        Removes and returns (game, key) of the longest waiting game whose configuration matches `key`, or of the
+        longest waiting game overall if `key` is None. Returns (None, None) if there is no such game
+        """
+        with self.lock:
+            if key is None:
+                game_id = next(iter(self.keys), None)
+            else:
+                game_id = next(iter(self.by_key.get(key, ())), None)
+            if game_id is None:
+                return None, None
+            key, (waiting_since, game) = self._pop(game_id)
+            wait = monotonic() - waiting_since
+            self.waits.append(wait)
+            self.num_matched += 1
+        LOBBY_WAIT_SECONDS.observe(wait)
+        return game, key
+
+    def remove(self, game_id):
+        """
+        Drops `game_id` from the lobby, i.e. because its game was cleaned up. Returns whether it was waiting
+        """
+        with self.lock:
+            removed = self._pop(game_id) is not None
+            if removed:
+                self.num_removed += 1
+            return removed
+
+    def _pop(self, game_id):
+        # Must be called while holding self.lock. Returns (key, (waiting since, game)), or None if the game was not waiting
+        key = self.keys.pop(game_id, None)
+        if key is None:
+            return None
+        games = self.by_key[key]
+        entry = games.pop(game_id)
+        if not games:
+            del self.by_key[key]
+        return key, entry
+
+    def ids(self):
+        """
+        Ids of all waiting games, longest waiting first
+        """
+        with self.lock:
+            return list(self.keys)
+
+    def get_stats(self):
+        now = monotonic()
+        with self.lock:
+            waits = sorted(self.waits)
+            oldest = min((next(iter(games.values()))[0] for games in self.by_key.values()), default=now)
+            return {
+                "waiting" : len(self.keys),
+                "configurations" : len(self.by_key),
+                "matched" : self.num_matched,
+                "removed" : self.num_removed,
+                "longest_current_wait" : now - oldest,
+                "mean_wait" : sum(waits) / len(waits) if waits else 0,
+                "median_wait" : waits[len(waits) // 2] if waits else 0,
+                "p90_wait" : waits[int(len(waits) * 0.9)] if waits else 0,
+                "max_wait" : waits[-1] if waits else 0
+            }
@@ -0,0 +1,208 @@
+"""
+Minimal, dependency-free metrics in the Prometheus text exposition format
+
+Metrics are registered in the module-level REGISTRY when they are created, and `REGISTRY.render()` returns the
+current value of all of them (served by the `/metrics` endpoint in app.py). Recording a value only takes a short
+lock and a few additions, so it is cheap enough for the tick path. Values that are already tracked elsewhere (queue
+depths, game counts, ...) are exposed through callback gauges that are only evaluated when rendering
+"""
+from threading import Lock
+from time import monotonic
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Default histogram buckets (in seconds), geared towards per-tick work at 30 FPS
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = Lock()
+        if registry:
+            registry.register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            if values not in self.children:
+                self.children[values] = self._new_child()
+            return self.children[values]
+
+    def _child(self):
+        # Metrics without labels have a single, unlabelled child
+        return self.labels()
+
+    def _format_labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, value) for name, value in pairs) + "}"
+
+    def render(self):
+        with self.lock:
+            children = list(self.children.items())
+        lines = []
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _Value(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._child().inc(amount)
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self.name, self._format_labels(values), child.value)]
+
+
+class Gauge(_Metric):
+    """
+    Gauge whose value is either set explicitly or, if `callback` is given, computed when rendered. A callback may
+    return a number, or a dict mapping label values (tuples) to numbers for labelled gauges
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, registry=REGISTRY):
+        super(Gauge, self).__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._child().set(value)
+
+    def render(self):
+        if not self.callback:
+            return super(Gauge, self).render()
+        try:
+            value = self.callback()
+        except Exception:
+            # Never fail a scrape because of a single metric
+            return []
+        if not isinstance(value, dict):
+            value = { () : value }
+        return ["{}{} {}".format(self.name, self._format_labels(values), v) for values, v in value.items()]
+
+    def _render_child(self, values, child):
+        return ["{}{} {}".format(self.name, self._format_labels(values), child.value)]
+
+
+class _HistogramValue(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._child().observe(value)
+
+    def time(self):
+        return self._child().time()
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            lines.append("{}_bucket{} {}".format(self.name, self._format_labels(values, [("le", le)]), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, self._format_labels(values), total))
+        lines.append("{}_count{} {}".format(self.name, self._format_labels(values), cumulative))
+        return lines
+
+
+
+##################
+# Server Metrics #
+##################
+
+TICK_SECONDS = Histogram('overcooked_tick_seconds', "Time spent in a single Game.tick call")
+APPLY_ACTIONS_SECONDS = Histogram('overcooked_apply_actions_seconds', "Time spent in OvercookedGame.apply_actions")
+GET_STATE_SECONDS = Histogram('overcooked_get_state_seconds', "Time spent serializing game state in Game.get_state")
+EMIT_SECONDS = Histogram('overcooked_emit_seconds', "Time spent emitting game loop socket.io events", labelnames=('event',))
+NPC_INFERENCE_SECONDS = Histogram('overcooked_npc_inference_seconds', "Time from requesting an NPC action until it is available", labelnames=('backend',))
+CREATE_GAME_SECONDS = Histogram('overcooked_create_game_seconds', "Time spent in try_create_game")
+
+TICKS = Counter('overcooked_ticks_total', "Number of game ticks")
+NPC_DEADLINE_MISSES = Counter('overcooked_npc_deadline_misses_total', "Number of times an NPC missed its inference deadline and played its fallback action")
+CREATE_GAME_FAILURES = Counter('overcooked_create_game_failures_total', "Number of failed try_create_game calls", labelnames=('reason',))
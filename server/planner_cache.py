@@ -0,0 +1,131 @@
+"""
+Persistent, content-addressed cache of MotionPlanners
+
+Computing a MotionPlanner for a layout takes seconds, and used to happen inside the request handler of the first
+potential-enabled game on each layout. Planners are instead persisted to `CACHE_DIR`/v<version>-<overcooked_ai version>/,
+keyed by a hash of the layout's contents (terrain, start positions and mdp params) and counter goals, so they survive
+restarts and are recomputed automatically whenever the layout or the overcooked_ai version changes. Planners are only
+read from disk the first time they are requested, then kept in memory for the life of the process.
+
+Planners can be precomputed ahead of time for every layout in config.json by running (from the server directory)
+
+    python planner_cache.py
+    python planner_cache.py --layouts cramped_room counter_circuit
+"""
+from threading import Lock
+from overcooked_ai_py.planning.planners import MotionPlanner, NO_COUNTERS_PARAMS
+import argparse, hashlib, json, os, pickle
+
+# Bumped whenever the on-disk format changes
+PLANNER_CACHE_VERSION = 1
+
+# Root directory for persisted planners
+CACHE_DIR = os.path.join('.', 'planner_cache')
+
+# In-memory planners, keyed by content hash
+_PLANNERS = {}
+
+# Mapping of content hash to Lock, so that concurrent requests for the same planner only compute it once
+_KEY_LOCKS = {}
+_LOCK = Lock()
+
+
+def configure(cache_dir):
+    global CACHE_DIR
+    CACHE_DIR = cache_dir
+
+def get_motion_planner(mdp, counter_goals=NO_COUNTERS_PARAMS):
+    """
+    Returns the MotionPlanner for `mdp`, loading it from disk or computing (and persisting) it if necessary
+    """
+    key = planner_key(mdp, counter_goals)
+    with _LOCK:
+        if key in _PLANNERS:
+            return _PLANNERS[key]
+        key_lock = _KEY_LOCKS.setdefault(key, Lock())
+
+    with key_lock:
+        if key not in _PLANNERS:
+            planner = _load(key)
+            if planner is None:
+                planner = MotionPlanner(mdp, counter_goals=counter_goals)
+                _save(key, planner)
+            with _LOCK:
+                _PLANNERS[key] = planner
+    return _PLANNERS[key]
+
+def planner_key(mdp, counter_goals):
+    """
+    Hash of everything a MotionPlanner depends on
+    """
+    contents = {
+        "terrain" : mdp.terrain_mtx,
+        "start_player_positions" : mdp.start_player_positions,
+        "mdp_params" : getattr(mdp, 'mdp_params', None),
+        "counter_goals" : counter_goals
+    }
+    return hashlib.sha256(json.dumps(contents, sort_keys=True, default=str).encode()).hexdigest()
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, "v{}-{}".format(PLANNER_CACHE_VERSION, _overcooked_version()), key + '.pkl')
+
+def _load(key):
+    path = cache_path(key)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Corrupt or incompatible file, recompute it
+        return None
+
+def _save(key, planner):
+    path = cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so that concurrent readers never observe a partial pickle
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(planner, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def _overcooked_version():
+    try:
+        from importlib.metadata import version
+        return version('overcooked_ai')
+    except Exception:
+        return 'unknown'
+
+def warm_up(layouts, mdp_params_list=({},), counter_goals=NO_COUNTERS_PARAMS):
+    """
+    Precompute and persist the planner of every (layout, mdp_params) combination. Returns { layout : error } for
+    any layout that failed
+    """
+    # Deferred to avoid a circular import, game.py imports this module
+    from game import get_mdp
+
+    errors = {}
+    for layout_name in layouts:
+        for mdp_params in mdp_params_list:
+            try:
+                mdp, _ = get_mdp(layout_name, mdp_params)
+                get_motion_planner(mdp, counter_goals)
+            except Exception as e:
+                errors[layout_name] = e
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute MotionPlanners for all configured layouts")
+    parser.add_argument('--config', default=os.getenv('CONF_PATH', 'config.json'), help="Server config to read layouts and cache location from")
+    parser.add_argument('--layouts', nargs='*', help="Layouts to warm up (defaults to every layout in the config)")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    configure(config['PLANNER_CACHE_DIR'])
+    layouts = args.layouts or sorted(set(config['layouts']) | set(config['psiturk']['experimentParams']['layouts']) | set(config['tutorial']['tutorialParams']['layouts']))
+
+    errors = warm_up(layouts, [{}, { "old_dynamics" : True }])
+    for layout_name in layouts:
+        print("{:<40} {}".format(layout_name, errors[layout_name].__repr__() if layout_name in errors else "ok"))
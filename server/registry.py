@@ -0,0 +1,234 @@
+from threading import Lock
+from collections import deque
+from contextlib import ExitStack
+from itertools import count
+
+
+class ShardedDict(object):
+    """
+    Dict split into `num_shards` independently locked shards, so that writes to different keys rarely contend
+
+    Single key operations are atomic. Iteration (`keys`, `values`, `items` and `iter`) works on a `snapshot`, copied
+    with every shard locked, so it neither fails nor observes a write half done when the dict is updated concurrently
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, num_shards=16):
+        self.shards = [({}, Lock()) for _ in range(max(1, num_shards))]
+
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
+
+    # Reads of a single key are atomic on a plain dict, so don't take the lock
+
+    def get(self, key, default=None):
+        return self._shard(key)[0].get(key, default)
+
+    def __getitem__(self, key):
+        return self._shard(key)[0][key]
+
+    def __contains__(self, key):
+        return key in self._shard(key)[0]
+
+    def __len__(self):
+        return sum(len(shard) for shard, _ in self.shards)
+
+    def __setitem__(self, key, value):
+        shard, lock = self._shard(key)
+        with lock:
+            shard[key] = value
+
+    def __delitem__(self, key):
+        shard, lock = self._shard(key)
+        with lock:
+            del shard[key]
+
+    def setdefault(self, key, default=None):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.setdefault(key, default)
+
+    def pop(self, key, *default):
+        shard, lock = self._shard(key)
+        with lock:
+            return shard.pop(key, *default)
+
+    def snapshot(self):
+        """
+        Returns a point in time copy of the whole dict
+        """
+        with ExitStack() as stack:
+            for _, lock in self.shards:
+                stack.enter_context(lock)
+            copy = {}
+            for shard, _ in self.shards:
+                copy.update(shard)
+            return copy
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def keys(self):
+        return list(self.snapshot())
+
+    def values(self):
+        return list(self.snapshot().values())
+
+    def items(self):
+        return list(self.snapshot().items())
+
+
+class _Shard(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.states = {}
+        self.games = {}
+        self.free = deque()
+
+
+class GameRegistry(object):
+    """
+    Lifecycle state of every game id, and the game object of every id in use. Each id is in exactly one state at a time
+    and only ever moves along
+
+        FREE -> RESERVED -> WAITING -> ACTIVE -> RESERVED -> FREE
+                                   \__________/
+
+    i.e. an id is reserved (for a game that is being created, or a user being admitted), holds a game that waits for
+    players then plays, is reserved again while its game is torn down and is finally freed. Every transition checks the
+    state it starts from and raises a ValueError if the id is not in it, so i.e. a double free fails loudly rather than
+    putting the same id up for reuse twice
+
+    Ids are spread over `num_shards` shards (by id), each with its own lock and list of free ids, so transitions of
+    different games rarely contend. `snapshot` locks every shard at once and so always sees a consistent registry
+
+    Instance variables:
+        - shards (list(_Shard)): Holds the state, game and (if free) place in the free list of every id with
+            id % num_shards == index
+
+    Note: This class IS thread safe
+    """
+
+    FREE = 'free'
+    RESERVED = 'reserved'
+    WAITING = 'waiting'
+    ACTIVE = 'active'
+
+    STATES = (FREE, RESERVED, WAITING, ACTIVE)
+
+    def __init__(self, max_games, num_shards=16):
+        self.shards = [_Shard() for _ in range(max(1, min(num_shards, max_games)))]
+        for game_id in range(max_games):
+            shard = self._shard(game_id)
+            shard.states[game_id] = self.FREE
+            shard.free.append(game_id)
+        # Rotates the shard `reserve` looks at first, so reservations are spread over all shards
+        self.next_shard = count()
+
+    def _shard(self, game_id):
+        return self.shards[game_id % len(self.shards)]
+
+    def _transition(self, shard, game_id, sources, target):
+        # Must be called while holding shard.lock
+        state = shard.states.get(game_id, None)
+        if state not in sources:
+            raise ValueError("Game id {} is {}, expected {}".format(game_id, state, ' or '.join(sources)))
+        shard.states[game_id] = target
+
+    def reserve(self):
+        """
+        FREE -> RESERVED. Returns a free id, or None if every id is in use
+        """
+        start = next(self.next_shard)
+        for i in range(len(self.shards)):
+            shard = self.shards[(start + i) % len(self.shards)]
+            with shard.lock:
+                if shard.free:
+                    game_id = shard.free.popleft()
+                    self._transition(shard, game_id, (self.FREE,), self.RESERVED)
+                    return game_id
+        return None
+
+    def release(self, game_id):
+        """
+        RESERVED -> FREE
+        """
+        shard = self._shard(game_id)
+        with shard.lock:
+            self._transition(shard, game_id, (self.RESERVED,), self.FREE)
+            shard.free.append(game_id)
+
+    def add(self, game):
+        """
+        RESERVED -> WAITING, for a newly created `game` using the id it reserved
+        """
+        shard = self._shard(game.id)
+        with shard.lock:
+            self._transition(shard, game.id, (self.RESERVED,), self.WAITING)
+            shard.games[game.id] = game
+
+    def activate(self, game_id):
+        """
+        WAITING -> ACTIVE
+        """
+        shard = self._shard(game_id)
+        with shard.lock:
+            self._transition(shard, game_id, (self.WAITING,), self.ACTIVE)
+
+    def remove(self, game_id):
+        """
+        WAITING or ACTIVE -> RESERVED. Returns the removed game. The id stays reserved until it is `release`d
+        """
+        shard = self._shard(game_id)
+        with shard.lock:
+            self._transition(shard, game_id, (self.WAITING, self.ACTIVE), self.RESERVED)
+            return shard.games.pop(game_id)
+
+    def get(self, game_id, default=None):
+        return self._shard(game_id).games.get(game_id, default) if game_id is not None else default
+
+    def state(self, game_id):
+        """
+        State of `game_id`, or None if it is not a valid id
+        """
+        return self._shard(game_id).states.get(game_id, None)
+
+    def __contains__(self, game_id):
+        return self.get(game_id) is not None
+
+    def __len__(self):
+        return sum(len(shard.games) for shard in self.shards)
+
+    def counts(self):
+        """
+        Returns { state : number of ids in that state }. Shards are counted one at a time, so this is cheap but might
+        be off by a transition in flight
+        """
+        counts = dict.fromkeys(self.STATES, 0)
+        for shard in self.shards:
+            with shard.lock:
+                for state in shard.states.values():
+                    counts[state] += 1
+        return counts
+
+    def snapshot(self):
+        """
+        Returns a point in time copy of the registry: { "states" : { id : state }, "games" : { id : game },
+        "free_ids" : [id] }
+        """
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.lock)
+            snapshot = { "states" : {}, "games" : {}, "free_ids" : [] }
+            for shard in self.shards:
+                snapshot['states'].update(shard.states)
+                snapshot['games'].update(shard.games)
+                snapshot['free_ids'].extend(shard.free)
+            return snapshot
+
+    def get_stats(self):
+        stats = self.counts()
+        stats['shards'] = len(self.shards)
+        return stats
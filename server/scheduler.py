@@ -0,0 +1,133 @@
+from threading import Lock, Event
+from collections import deque
+from time import monotonic, sleep
+import heapq, itertools
+
+
+class TickScheduler(object):
+    """
+    Steps an arbitrary number of periodic jobs from a single background task
+
+    Jobs are kept in a priority queue ordered by their next deadline. Time is divided into fixed-length slots and
+    every wakeup steps all jobs that are due before the end of the current slot as one batch, so games whose
+    deadlines fall close together share a single wakeup instead of each running its own timer.
+
+    A job is any object with a `step()` method. `step` is called once per deadline and must return the absolute
+    (`time.monotonic`) time at which it next wants to be stepped, or None once it is finished and should be dropped.
+    A job whose `step` raises is dropped too, after calling its `abort()` method (if it has one) so that it can release
+    whatever it holds
+
+    Instance variables:
+        - slot_duration (float): Length (in seconds) of a scheduling slot
+        - slots (deque((int, float))): (batch size, utilisation) of the most recent slots in which jobs were stepped.
+            Utilisation is the fraction of the slot spent stepping jobs, and can exceed 1 if the slot overran
+        - num_late_slots (int): Number of slots in which stepping the batch took longer than the slot itself
+
+    Note: `add` IS thread safe
+    """
+
+    def __init__(self, slot_duration, start_background_task, logger=None, history=300, sleep=sleep):
+        """
+        slot_duration (float):              Length (in seconds) of a scheduling slot
+        start_background_task (callable):   Used to spawn the scheduler loop, i.e. `socketio.start_background_task`
+        logger (logging.Logger):            Where exceptions raised by jobs are reported
+        history (int):                      Number of recent slots to keep utilisation data for
+        sleep (callable):                   Used to yield to other tasks after every batch, i.e. `socketio.sleep`
+        """
+        self.slot_duration = slot_duration
+        self.slots = deque(maxlen=history)
+        self.num_late_slots = 0
+        self.logger = logger
+        self._start_background_task = start_background_task
+        self._sleep = sleep
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._running = False
+
+    def add(self, job, deadline=None):
+        """
+        Schedule `job` to first be stepped at `deadline` (defaults to as soon as possible)
+        """
+        deadline = monotonic() if deadline is None else deadline
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, next(self._counter), job))
+            if not self._running:
+                self._running = True
+                self._start_background_task(self._run)
+        self._wakeup.set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                if not self._heap:
+                    # Exit when idle, `add` will restart us
+                    self._running = False
+                    return
+                next_deadline = self._heap[0][0]
+
+            wait = next_deadline - monotonic()
+            if wait > 0:
+                # Woken early if a job with a sooner deadline is added
+                self._wakeup.wait(wait)
+                continue
+
+            # Pop every job that is due before the end of the current slot
+            slot_start = monotonic()
+            slot_end = (slot_start // self.slot_duration + 1) * self.slot_duration
+            batch = []
+            with self._lock:
+                while self._heap and self._heap[0][0] < slot_end:
+                    batch.append(heapq.heappop(self._heap)[2])
+
+            for job in batch:
+                try:
+                    deadline = job.step()
+                except Exception:
+                    deadline = None
+                    if self.logger:
+                        self.logger.exception("Uncaught error while stepping {}".format(job))
+                    self._abort(job)
+                if deadline is not None:
+                    with self._lock:
+                        heapq.heappush(self._heap, (deadline, next(self._counter), job))
+
+            busy = monotonic() - slot_start
+            utilisation = busy / self.slot_duration
+            if utilisation > 1:
+                self.num_late_slots += 1
+            self.slots.append((len(batch), utilisation))
+
+            # Under eventlet nothing else runs until we yield, i.e. the socket handler a job is waiting on
+            self._sleep(0)
+
+    def _abort(self, job):
+        abort = getattr(job, 'abort', None)
+        if not abort:
+            return
+        try:
+            abort()
+        except Exception:
+            if self.logger:
+                self.logger.exception("Uncaught error while aborting {}".format(job))
+
+    def get_stats(self, num_recent=30):
+        """
+        Returns a JSON compatible summary of scheduler load
+        """
+        slots = list(self.slots)
+        utilisations = [util for _, util in slots]
+        return {
+            "jobs" : len(self),
+            "slot_ms" : self.slot_duration * 1000,
+            "late_slots" : self.num_late_slots,
+            "mean_batch_size" : sum(size for size, _ in slots) / len(slots) if slots else 0,
+            "mean_utilisation" : sum(utilisations) / len(utilisations) if slots else 0,
+            "max_utilisation" : max(utilisations) if slots else 0,
+            "recent_slots" : slots[-num_recent:]
+        }
@@ -0,0 +1,537 @@
+from threading import Lock, Thread, Event
+from time import sleep
+from game import Game, get_game_detail
+from gameloop import GameLoop
+from scheduler import TickScheduler
+from utils import start_spawned_process
+from multiprocessing import Pipe
+import itertools, logging, pickle
+import game as game_module, gameloop
+
+
+class ShardError(RuntimeError):
+    """
+    Raised when a game's worker process does not answer a request, i.e. because it died
+    """
+    pass
+
+
+class GameShardPool(object):
+    """
+    Runs games, and the GameLoops ticking them, in `num_workers` worker processes so that simulating games is not
+    capped by the single core of the process handling sockets
+
+    Each game is created inside (and pinned to) the live worker with the least load, as estimated by the `weight` each
+    game is created with. The front process holds a RemoteGame for it, which forwards requests to the game's worker
+    over a pipe. Requests that return something (i.e. `join`) block their caller until the worker replies, while
+    actions, keyframe requests and trajectory acks are fire and forget. Every request is handled on its own by the
+    worker, which takes the game's lock for it if needed: the front process never holds a worker's lock across requests
+
+    Worker output comes back over the same pipes and is read by a single reader task: `on_emit(game_id, event, data)`
+    is called for every event a game's loop broadcasts to its room (in order), and `on_finish(game_id)` is run in a
+    background task (`spawn`) once a game's loop is over and it can be cleaned up. If a worker dies, every game on it
+    is ended the same way
+
+    Every `stats_interval` seconds, each worker pushes the summary and TickClock stats of its games over the same pipe.
+    Monitoring (`get_tick_stats`, `RemoteGame.get_summary`) is served from the latest of these, so it never waits on a
+    worker nor takes any game's lock
+
+    Every worker configures its own copy of the game and gameloop modules with `game_settings` (kwargs of
+    `game._configure`) and `loop_settings` (kwargs of `gameloop._configure`), then warms up its caches with `warm_up`
+    ((layouts, mdp_params_list, agent_names), see `_shard_worker`). Workers are started lazily, on the first call to
+    `create_game` or `start`, with `start_spawned_process` so that they neither inherit the server's eventlet hub or
+    sockets nor re-run the server's main module
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, num_workers, game_settings, loop_settings, on_emit, on_finish, spawn, fps=30, slot_duration=0.01, warm_up=None, logger=None, poll_interval=0.001, timeout=10, create_timeout=120, stats_interval=1):
+        self.num_workers = num_workers
+        self.worker_args = (game_settings, loop_settings, fps, slot_duration, warm_up, stats_interval)
+        self.on_emit = on_emit
+        self.on_finish = on_finish
+        self.spawn = spawn
+        self.logger = logger or logging.getLogger(__name__)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.create_timeout = create_timeout
+        self.workers = []
+        self.alive = []
+        self.load = [0] * num_workers
+        self.games = {}
+        self.pending = {}
+        self.game_stats = [{} for _ in range(num_workers)]
+        self.lock = Lock()
+        self._ids = itertools.count()
+
+    def start(self):
+        with self.lock:
+            self._ensure_started()
+
+    def _ensure_started(self):
+        # Must be called while holding self.lock
+        if self.workers:
+            return
+        for _ in range(self.num_workers):
+            conn, worker_conn = Pipe()
+            process = start_spawned_process(_shard_worker, worker_conn, *self.worker_args)
+            self.workers.append((process, conn, Lock()))
+            self.alive.append(True)
+        Thread(target=self._read_output, daemon=True).start()
+
+    def create_game(self, game_cls, game_id, kwargs, weight=1):
+        """
+        Creates `game_cls(id=game_id, **kwargs)` in the least loaded worker and returns a RemoteGame for it. Raises
+        whatever the game's constructor raised, or a ShardError if no worker can host it
+        """
+        with self.lock:
+            self._ensure_started()
+            candidates = [idx for idx, alive in enumerate(self.alive) if alive]
+            if not candidates:
+                raise ShardError("Every game worker process died")
+            worker_idx = min(candidates, key=lambda idx : self.load[idx])
+            self.load[worker_idx] += weight
+            self.games[game_id] = (worker_idx, weight)
+        try:
+            _, membership = self._request(worker_idx, game_id, 'create', (game_cls, kwargs), timeout=self.create_timeout)
+        except Exception:
+            self._unassign(game_id)
+            raise
+        return RemoteGame(self, game_id, membership)
+
+    def close_game(self, game_id):
+        """
+        Drops the game from its worker. Must be called once the game is cleaned up
+        """
+        worker_idx = self._unassign(game_id)
+        if worker_idx is not None and self.alive[worker_idx]:
+            try:
+                self._send(worker_idx, ('cast', game_id, 'close', ()))
+            except ShardError:
+                pass
+
+    def _unassign(self, game_id):
+        with self.lock:
+            worker_idx, weight = self.games.pop(game_id, (None, 0))
+            if worker_idx is not None:
+                self.load[worker_idx] -= weight
+            return worker_idx
+
+    def _worker_of(self, game_id):
+        worker_idx, _ = self.games.get(game_id, (None, 0))
+        if worker_idx is None:
+            raise ShardError("Game {} is not hosted by any worker".format(game_id))
+        return worker_idx
+
+    def call(self, game_id, method, *args):
+        """
+        Calls `method(*args)` on the game in its worker and returns (result, membership), where `membership` describes
+        the game's players after the call (see `_get_membership`). Game methods run under the game's lock in the worker
+        """
+        return self._request(self._worker_of(game_id), game_id, method, args)
+
+    def cast(self, game_id, method, *args):
+        """
+        Calls `method(*args)` on the game in its worker without waiting for it. Errors are only logged by the worker,
+        and the call is dropped if the game's worker is gone
+        """
+        worker_idx, _ = self.games.get(game_id, (None, 0))
+        if worker_idx is None or not self.alive[worker_idx]:
+            return
+        try:
+            self._send(worker_idx, ('cast', game_id, method, args))
+        except ShardError:
+            pass
+
+    def _request(self, worker_idx, game_id, method, args, timeout=None):
+        request_id = next(self._ids)
+        reply = _Reply(worker_idx)
+        self.pending[request_id] = reply
+        try:
+            self._send(worker_idx, ('call', request_id, game_id, method, args))
+            if not reply.done.wait(timeout or self.timeout):
+                raise ShardError("Game worker {} did not answer '{}' for game {}".format(worker_idx, method, game_id))
+        finally:
+            self.pending.pop(request_id, None)
+        if not reply.ok:
+            raise reply.result
+        return reply.result
+
+    def _send(self, worker_idx, msg):
+        _, conn, lock = self.workers[worker_idx]
+        if not self.alive[worker_idx]:
+            raise ShardError("Game worker {} died".format(worker_idx))
+        try:
+            with lock:
+                conn.send(msg)
+        except (OSError, EOFError) as e:
+            raise ShardError("Game worker {} died".format(worker_idx)) from e
+
+    def _read_output(self):
+        # Poll rather than block on recv so this plays nicely with eventlet's cooperative scheduling
+        while any(self.alive):
+            received = False
+            for worker_idx, (_, conn, _) in enumerate(self.workers):
+                if not self.alive[worker_idx]:
+                    continue
+                try:
+                    while conn.poll():
+                        self._route(worker_idx, conn.recv())
+                        received = True
+                except (EOFError, OSError):
+                    self._on_worker_died(worker_idx)
+            if not received:
+                sleep(self.poll_interval)
+
+    def _route(self, worker_idx, msg):
+        kind = msg[0]
+        if kind == 'emit':
+            _, game_id, event, data = msg
+            self.on_emit(game_id, event, data)
+        elif kind == 'finish':
+            self.spawn(self.on_finish, msg[1])
+        elif kind == 'reply':
+            _, request_id, ok, result = msg
+            reply = self.pending.get(request_id, None)
+            if reply:
+                reply.set(ok, result)
+        elif kind == 'stats':
+            # Replaced wholesale, so games the worker dropped are dropped here too
+            self.game_stats[worker_idx] = msg[1]
+
+    def _on_worker_died(self, worker_idx):
+        self.logger.error("Game worker {} died".format(worker_idx))
+        self.alive[worker_idx] = False
+        self.game_stats[worker_idx] = {}
+        for reply in list(self.pending.values()):
+            if reply.worker_idx == worker_idx:
+                reply.set(False, ShardError("Game worker {} died".format(worker_idx)))
+        with self.lock:
+            game_ids = [game_id for game_id, (idx, _) in self.games.items() if idx == worker_idx]
+        for game_id in game_ids:
+            self.on_emit(game_id, 'end_game', { "status" : Game.Status.INACTIVE, "data" : {} })
+            self.spawn(self.on_finish, game_id)
+
+    def get_game_stats(self, game_id):
+        """
+        Returns the latest { "summary", "tick_stats" } pushed for `game_id` by its worker, or None if there are none yet
+        """
+        worker_idx, _ = self.games.get(game_id, (None, 0))
+        return self.game_stats[worker_idx].get(game_id, None) if worker_idx is not None else None
+
+    def get_tick_stats(self):
+        """
+        Returns { game_id : stats } with the latest TickClock stats pushed for every running loop
+        """
+        stats = {}
+        for worker_stats in list(self.game_stats):
+            stats.update({ game_id : game['tick_stats'] for game_id, game in worker_stats.items() if game['tick_stats'] })
+        return stats
+
+    def get_stats(self):
+        with self.lock:
+            games = [0] * self.num_workers
+            for worker_idx, _ in self.games.values():
+                games[worker_idx] += 1
+            return {
+                "workers" : len(self.workers),
+                "alive" : sum(self.alive),
+                "games_per_worker" : games,
+                "load_per_worker" : list(self.load),
+                "pending_requests" : len(self.pending)
+            }
+
+
+class _Reply(object):
+
+    def __init__(self, worker_idx):
+        self.worker_idx = worker_idx
+        self.done = Event()
+        self.ok = None
+        self.result = None
+
+    def set(self, ok, result):
+        self.ok = ok
+        self.result = result
+        self.done.set()
+
+
+class RemoteGame(object):
+    """
+    Front process handle to a game hosted by a GameShardPool worker. Stands in for the Game for everything socket
+    handlers do with one, so they need not know where the game runs
+
+    Membership (players, spectators, and whether the game is full, ready or empty) is served from a copy that every
+    forwarded call refreshes, so only requests that change it wait on the worker. Whether the game is active only
+    changes through `join` and `leave`, so a game that ends on its own stays active here until the pool's `on_finish`
+    cleans it up, as it would in a GameLoop's `finish`
+
+    Instance variables:
+        - lock (Lock): Serializes the front process' updates to this game (and the registries tracking it), as
+            `Game.lock` does. It is only ever held locally: every change to the game itself (i.e. a player leaving) is
+            a single request that the worker runs under the game's own lock, so the game is never ticked half way
+            through one
+
+    Note: Like Game, most operations are not on their own thread safe, `enqueue_action` is
+    """
+
+    def __init__(self, pool, game_id, membership):
+        self.pool = pool
+        self.id = game_id
+        self.lock = Lock()
+        self._is_active = membership['active']
+        self._update(membership)
+
+    def __repr__(self):
+        return "RemoteGame(id={})".format(self.id)
+
+    def _update(self, membership):
+        self.players = membership['players']
+        self.spectators = set(membership['spectators'])
+        self.human_players = set(membership['human_players'])
+        self._is_full = membership['full']
+        self._is_ready = membership['ready']
+        self._is_empty = membership['empty']
+        self._has_stream = membership['stream']
+        self._summary = membership['summary']
+
+    def _call(self, method, *args):
+        result, membership = self.pool.call(self.id, method, *args)
+        self._update(membership)
+        return result
+
+    @property
+    def is_active(self):
+        return self._is_active
+
+    def is_full(self):
+        return self._is_full
+
+    def is_ready(self):
+        return self._is_ready
+
+    def is_empty(self):
+        return self._is_empty
+
+    def join(self, user_id):
+        started = self._call('join', user_id)
+        if started:
+            self._is_active = True
+        return started
+
+    def leave(self, user_id):
+        stopped = self._call('leave', user_id)
+        if stopped:
+            self._is_active = False
+        return stopped
+
+    def start_loop(self):
+        """
+        Starts ticking the game, and broadcasting its state, from its worker's scheduler
+        """
+        return self._call('start_loop')
+
+    def enqueue_action(self, player_id, action):
+        self.pool.cast(self.id, 'enqueue_action', player_id, action)
+
+    def request_keyframe(self):
+        self.pool.cast(self.id, 'request_keyframe')
+
+    def get_state(self):
+        return self._call('get_state')
+
+    def to_json(self):
+        return self._call('to_json')
+
+    def get_summary(self):
+        """
+        Returns the latest summary pushed by the game's worker, or the one returned by the last forwarded call if it is
+        more recent (i.e. for a game that was just created)
+        """
+        stats = self.pool.get_game_stats(self.id)
+        if stats and stats['summary']['age'] > self._summary['age']:
+            return stats['summary']
+        return self._summary
+
+    def get_data(self):
+        return self._call('get_data')
+
+    def get_npc_stats(self):
+        return self._call('get_npc_stats')
+
+    def get_detail(self):
+        """
+        Returns `get_game_detail` of the game, along with its summary, collected by the worker in a single request
+        """
+        return self._call('detail')
+
+    def get_data_stream(self):
+        return _RemoteStream(self) if self._has_stream else None
+
+
+class _RemoteStream(object):
+    # The part of TrajectoryStream the front process uses
+
+    def __init__(self, game):
+        self.game = game
+
+    def ack(self, seq, recipient):
+        self.game.pool.cast(self.game.id, 'ack', seq, recipient)
+
+
+def _get_membership(game):
+    return {
+        "players" : list(game.players),
+        "spectators" : list(game.spectators),
+        "human_players" : list(getattr(game, 'human_players', ())),
+        "full" : game.is_full(),
+        "ready" : game.is_ready(),
+        "empty" : game.is_empty(),
+        "active" : game.is_active,
+        "stream" : game.get_data_stream() is not None,
+        "summary" : game.get_summary()
+    }
+
+
+class _Shard(object):
+    """
+    The games hosted by one GameShardPool worker process, and the scheduler ticking them
+    """
+
+    # Game methods the front process may call, all under the game's lock. Membership only changes through `join` and
+    # `leave`, which each make all of their changes under a single hold of the lock
+    GAME_METHODS = ('join', 'leave', 'get_state', 'to_json', 'get_data', 'get_npc_stats')
+
+    def __init__(self, conn, fps, slot_duration, logger, stats_interval=1):
+        self.conn = conn
+        self.stats_interval = stats_interval
+        self.send_lock = Lock()
+        self.fps = fps
+        self.logger = logger
+        self.games = {}
+        self.loops = {}
+        self.scheduler = TickScheduler(slot_duration, _start_thread, logger=logger)
+
+    def send(self, msg):
+        with self.send_lock:
+            self.conn.send(msg)
+
+    def serve(self):
+        while True:
+            try:
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                return
+            if msg[0] == 'call':
+                # Creating a game can take seconds (i.e. loading agents), don't hold up other games' actions meanwhile
+                _start_thread(self._serve_call, *msg[1:])
+            else:
+                _, game_id, method, args = msg
+                try:
+                    self.handle(game_id, method, args)
+                except Exception:
+                    self.logger.exception("Game worker failed to handle '{}' for game {}".format(method, game_id))
+
+    def _serve_call(self, request_id, game_id, method, args):
+        try:
+            result = self.handle(game_id, method, args)
+            if game_id is not None:
+                result = (result, _get_membership(self.games[game_id]))
+            reply = (request_id, True, result)
+        except Exception as e:
+            reply = (request_id, False, _picklable(e))
+        self.send(('reply',) + reply)
+
+    def handle(self, game_id, method, args):
+        if method == 'create':
+            game_cls, kwargs = args
+            self.games[game_id] = game_cls(id=game_id, **kwargs)
+        elif method == 'close':
+            self.games.pop(game_id, None)
+            self.loops.pop(game_id, None)
+        elif method == 'enqueue_action':
+            # Thread safe on its own
+            self.games[game_id].enqueue_action(*args)
+        elif method == 'start_loop':
+            game = self.games[game_id]
+            loop = GameLoop(game, fps=self.fps, emit=lambda event, data : self.send(('emit', game_id, event, data)), spawn=_start_thread, on_finish=self._on_finish)
+            self.loops[game_id] = loop
+            self.scheduler.add(loop)
+        elif method == 'request_keyframe':
+            loop = self.loops.get(game_id, None)
+            if loop:
+                loop.encoder.request_keyframe()
+        elif method == 'ack':
+            stream = self.games[game_id].get_data_stream()
+            if stream:
+                stream.ack(*args)
+        elif method == 'detail':
+            game = self.games[game_id]
+            loop = self.loops.get(game_id, None)
+            with game.lock:
+                detail = get_game_detail(game, loop.clock.get_stats() if loop else None)
+            detail['summary'] = game.get_summary()
+            return detail
+        elif method in self.GAME_METHODS:
+            game = self.games[game_id]
+            with game.lock:
+                return getattr(game, method)(*args)
+        else:
+            raise ValueError("Unknown game worker request '{}'".format(method))
+
+    def publish_stats(self):
+        # Pushes the summary and TickClock stats of every game to the front process, which serves monitoring requests
+        # from them rather than asking this worker. Summaries are safe to take without the game's lock
+        while True:
+            sleep(self.stats_interval)
+            stats = {}
+            for game_id, game in list(self.games.items()):
+                loop = self.loops.get(game_id, None)
+                stats[game_id] = { "summary" : game.get_summary(), "tick_stats" : loop.clock.get_stats() if loop else None }
+            try:
+                self.send(('stats', stats))
+            except (OSError, ValueError):
+                return
+
+    def _on_finish(self, game):
+        # Called by the game's loop, holding its lock. The game itself is kept until the front process closes it, as it
+        # might still forward requests (i.e. players leaving) until it has cleaned the game up
+        self.loops.pop(game.id, None)
+        self.send(('finish', game.id))
+
+
+def _start_thread(fn, *args):
+    thread = Thread(target=fn, args=args, daemon=True)
+    thread.start()
+    return thread
+
+def _picklable(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return ShardError(e.__repr__())
+
+def _shard_worker(conn, game_settings, loop_settings, fps, slot_duration, warm_up, stats_interval):
+    """
+    Entry point of GameShardPool workers. Serves requests about the worker's games until the pipe closes
+    """
+    logger = logging.getLogger(__name__)
+    if game_settings.get('npc_inference', None) == 'process':
+        # Workers are daemonic, so can't start policy processes of their own. Their NPCs already run off the server's
+        # GIL anyway
+        game_settings = dict(game_settings, npc_inference='threads')
+    game_module._configure(**game_settings)
+    gameloop._configure(**loop_settings)
+
+    if warm_up:
+        # Same as the front process does at startup when it hosts games itself
+        layouts, mdp_params_list, agent_names = warm_up
+        for layout_name, err in game_module.prewarm_mdps(layouts, mdp_params_list).items():
+            logger.error("Failed to prewarm layout {}: {}".format(layout_name, err.__repr__()))
+        for agent_name, err in game_module.preload_agents(agent_names).items():
+            logger.error("Failed to preload agent {}: {}".format(agent_name, err.__repr__()))
+
+    shard = _Shard(conn, fps, slot_duration, logger, stats_interval=stats_interval)
+    _start_thread(shard.publish_stats)
+    shard.serve()
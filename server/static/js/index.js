@@ -91,7 +91,21 @@ socket.on('creation_failed', function(data) {
     $('#overcooked').append(`<h4>Sorry, game creation code failed with error: ${JSON.stringify(err)}</>`);
 });
 
+socket.on('admission_queued', function(data) {
+    // Server is full, show our place in the admission queue until a game can be created for us
+    $('#waiting').hide();
+    $("#instructions").hide();
+    $('#tutorial').hide();
+    $('#lobby').show();
+    $('#leave').show();
+    $('#leave').attr("disabled", false);
+    let eta = data.eta === null ? "unknown" : `about ${Math.ceil(data.eta)} seconds`;
+    $("#overcooked").empty();
+    $('#overcooked').append(`<h4>The server is full. You are number ${data.position} of ${data.queued} in line (estimated wait: ${eta})</h4>`);
+});
+
 socket.on('start_game', function(data) {
+    reset_state_sync();
     // Hide game-over and lobby, show game title header
     if (window.intervalID !== -1) {
         clearInterval(window.intervalID);
@@ -125,6 +139,7 @@ socket.on('start_game', function(data) {
 });
 
 socket.on('reset_game', function(data) {
+    reset_state_sync();
     graphics_end();
     if (!window.spectating) {
         disable_key_listener();
@@ -147,7 +162,10 @@ socket.on('reset_game', function(data) {
 
 socket.on('state_pong', function(data) {
     // Draw state update
-    drawState(data['state']);
+    let state = apply_state_pong(socket, data);
+    if (state !== null) {
+        drawState(state);
+    }
 });
 
 socket.on('end_game', function(data) {
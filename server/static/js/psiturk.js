@@ -55,7 +55,18 @@ socket.on('creation_failed', function(data) {
     window.top.postMessage({ name : "error"}, "*");
 });
 
+socket.on('admission_queued', function(data) {
+    // Server is full, show our place in the admission queue until a game can be created for us. The lobby timeout
+    // (started by the first `waiting` event) does not apply until then
+    $('#game-over').hide();
+    $('#lobby').show();
+    let eta = data.eta === null ? "unknown" : `about ${Math.ceil(data.eta)} seconds`;
+    $("#overcooked").empty();
+    $('#overcooked').append(`<h4>The server is full. You are number ${data.position} of ${data.queued} in line (estimated wait: ${eta})</h4>`);
+});
+
 socket.on('start_game', function(data) {
+    reset_state_sync();
     // Hide game-over and lobby, show game title header
     if (window.intervalID !== -1) {
         clearInterval(window.intervalID);
@@ -81,6 +92,7 @@ socket.on('start_game', function(data) {
 });
 
 socket.on('reset_game', function(data) {
+    reset_state_sync();
     graphics_end();
     disable_key_listener();
     $("#overcooked").empty();
@@ -93,15 +105,18 @@ socket.on('reset_game', function(data) {
         };
         graphics_start(graphics_config);
         enable_key_listener();
-
-        // Propogate game stats to parent window (psiturk)
-        window.top.postMessage({ name : "data", data : data.data, done : false}, "*");
     }, data.timeout);
+
+    // Propogate game stats to parent window (psiturk) once all of its chunks have arrived
+    queue_trajectory_data(data.data, false);
 });
 
 socket.on('state_pong', function(data) {
     // Draw state update
-    drawState(data['state']);
+    let state = apply_state_pong(socket, data);
+    if (state !== null) {
+        drawState(state);
+    }
 });
 
 socket.on('end_game', function(data) {
@@ -119,7 +134,16 @@ socket.on('end_game', function(data) {
     }
 
     // Propogate game stats to parent window with psiturk code
-    window.top.postMessage({ name : "data", data : data.data, done : true }, "*");
+    queue_trajectory_data(data.data, true);
+});
+
+socket.on('trajectory_chunk', function(chunk) {
+    socket.emit('trajectory_ack', { seq : chunk.seq });
+    // Re-sent chunks that were already delivered to psiturk are ignored
+    if (chunk.seq > trajectory.posted_through) {
+        trajectory.chunks[chunk.seq] = chunk.rows;
+    }
+    post_trajectory_data();
 });
 
 socket.on('end_lobby', function() {
@@ -202,6 +226,49 @@ socket.on("connect", function() {
 });
 
 
+/* * * * * * * * * * * *
+ * Trajectory Streaming *
+ * * * * * * * * * * * */
+
+// The server uploads trajectory data in numbered chunks during play. `reset_game` and `end_game` then only carry a
+// manifest listing which chunks make up the data of that trial, which we reassemble before handing it to psiturk
+var trajectory = {
+    chunks : {},
+    pending : [],
+    posted_through : -1
+};
+
+var queue_trajectory_data = function(data, done) {
+    trajectory.pending.push({ data : data, done : done });
+    post_trajectory_data();
+};
+
+var post_trajectory_data = function() {
+    // Data is posted in the order it was received, so wait on the oldest manifest until it is complete
+    while (trajectory.pending.length > 0) {
+        let next = trajectory.pending[0];
+        let data = next.data;
+        let manifest = data.manifest;
+        if (manifest) {
+            for (let seq = manifest.first_seq; seq <= manifest.last_seq; seq++) {
+                if (!(seq in trajectory.chunks)) {
+                    return;
+                }
+            }
+            let rows = [];
+            for (let seq = manifest.first_seq; seq <= manifest.last_seq; seq++) {
+                rows = rows.concat(trajectory.chunks[seq]);
+                delete trajectory.chunks[seq];
+            }
+            trajectory.posted_through = Math.max(trajectory.posted_through, manifest.last_seq);
+            data = { uid : manifest.uid, trajectory : rows };
+        }
+        trajectory.pending.shift();
+        window.top.postMessage({ name : "data", data : data, done : next.done }, "*");
+    }
+};
+
+
 /* * * * * * * * * * *
  * Utility Functions *
  * * * * * * * * * * */
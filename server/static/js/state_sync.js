@@ -0,0 +1,76 @@
+/* * * * * * * * * * * * * * * * * * * * * * *
+ * Reconstruction of delta-encoded state pongs *
+ * * * * * * * * * * * * * * * * * * * * * * * */
+
+// Last full state received from the server, and the sequence number it corresponds to
+window.syncedState = null;
+window.syncedSeq = -1;
+window.resyncRequested = false;
+
+// Invoked at 'start_game' and 'reset_game' events. Deltas are dropped until the next keyframe arrives
+function reset_state_sync() {
+    window.syncedState = null;
+    window.syncedSeq = -1;
+    window.resyncRequested = false;
+};
+
+// Returns the full game state described by a 'state_pong' payload, or null if it cannot be reconstructed yet
+function apply_state_pong(socket, data) {
+    if (typeof(data.seq) === 'undefined') {
+        // Server is not delta encoding
+        return data.state;
+    }
+
+    if (data.keyframe) {
+        window.syncedState = data.state;
+        window.syncedSeq = data.seq;
+        window.resyncRequested = false;
+        return window.syncedState;
+    }
+
+    if (window.syncedState === null || data.seq !== window.syncedSeq + 1) {
+        // We missed a pong (or joined mid-game), so ask the server for a keyframe
+        if (!window.resyncRequested) {
+            window.resyncRequested = true;
+            socket.emit('resync', {});
+        }
+        return null;
+    }
+
+    window.syncedState = apply_delta(window.syncedState, data.delta);
+    window.syncedSeq = data.seq;
+    return window.syncedState;
+};
+
+function apply_dict_delta(prev, delta) {
+    let next = Object.assign({}, prev, delta.changed);
+    for (let i = 0; i < delta.removed.length; i++) {
+        delete next[delta.removed[i]];
+    }
+    return next;
+};
+
+function apply_delta(prev, delta) {
+    let next = apply_dict_delta(prev, delta);
+    if (typeof(delta.state) === 'undefined') {
+        return next;
+    }
+
+    let state = apply_dict_delta(prev.state, delta.state);
+    if (typeof(delta.state.players) !== 'undefined') {
+        state.players = prev.state.players.slice();
+        for (let idx in delta.state.players) {
+            state.players[parseInt(idx)] = delta.state.players[idx];
+        }
+    }
+    if (typeof(delta.state.objects) !== 'undefined') {
+        // Objects are uniquely identified by their position on the grid
+        let objects = {};
+        prev.state.objects.forEach(function(obj) { objects[obj.position.toString()] = obj; });
+        delta.state.objects.removed.forEach(function(pos) { delete objects[pos.toString()]; });
+        delta.state.objects.set.forEach(function(obj) { objects[obj.position.toString()] = obj; });
+        state.objects = Object.values(objects);
+    }
+    next.state = state;
+    return next;
+};
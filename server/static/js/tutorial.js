@@ -139,7 +139,15 @@ socket.on('creation_failed', function(data) {
     $('#try-again').attr("disabled", false);
 });
 
+socket.on('admission_queued', function(data) {
+    // Server is full, show our place in the admission queue until the tutorial can be created for us
+    let eta = data.eta === null ? "unknown" : `about ${Math.ceil(data.eta)} seconds`;
+    $("#overcooked").empty();
+    $('#overcooked').append(`<h4>The server is full. You are number ${data.position} of ${data.queued} in line (estimated wait: ${eta})</h4>`);
+});
+
 socket.on('start_game', function(data) {
+    reset_state_sync();
     curr_tutorial_phase = 0;
     graphics_config = {
         container_id : "overcooked",
@@ -161,6 +169,7 @@ socket.on('start_game', function(data) {
 });
 
 socket.on('reset_game', function(data) {
+    reset_state_sync();
     curr_tutorial_phase++;
     graphics_end();
     disable_key_listener();
@@ -185,7 +194,10 @@ socket.on('reset_game', function(data) {
 
 socket.on('state_pong', function(data) {
     // Draw state update
-    drawState(data['state']);
+    let state = apply_state_pong(socket, data);
+    if (state !== null) {
+        drawState(state);
+    }
 });
 
 socket.on('end_game', function(data) {
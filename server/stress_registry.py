@@ -0,0 +1,197 @@
+"""
+Concurrency stress test for the global game registries
+
+In `registry` mode, worker threads drive a bare GameRegistry through every lifecycle transition (including failed
+creations and double frees) while a checker thread keeps verifying snapshots of it. In `app` mode, every worker is a
+socket.io test client of the real server that randomly creates, joins, leaves and disconnects, while the checker keeps
+running `_ensure_consistent_state` on consistent snapshots, pausing the clients every other time so that it gets to see
+the server between transitions under any load. Both modes finally check that every id was freed
+
+Exits with a non-zero status if any invariant was violated
+
+Usage (from the server directory, `app` mode needs the server's dependencies):
+
+    python stress_registry.py registry --workers 32 --seconds 10
+    python stress_registry.py app --workers 64 --seconds 60
+"""
+import argparse, random, sys, threading, time
+from registry import GameRegistry
+
+
+class _StubGame(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+def check_registry_snapshot(snapshot, max_games):
+    """
+    Invariants that hold for every snapshot of a GameRegistry, whatever is in flight
+    """
+    states = snapshot['states']
+    assert len(states) == max_games, "ID lost"
+    free_ids = set(game_id for game_id, state in states.items() if state == GameRegistry.FREE)
+    assert len(snapshot['free_ids']) == len(set(snapshot['free_ids'])), "ID freed twice"
+    assert set(snapshot['free_ids']) == free_ids, "Free list in inconsistent state"
+    in_use = set(game_id for game_id, state in states.items() if state in (GameRegistry.WAITING, GameRegistry.ACTIVE))
+    assert set(snapshot['games']) == in_use, "Game registered under a free or reserved ID"
+    assert all(game.id == game_id for game_id, game in snapshot['games'].items()), "Game registered under another ID"
+
+
+def stress_registry(workers, seconds, max_games, num_shards):
+    registry = GameRegistry(max_games, num_shards=num_shards)
+    deadline = time.monotonic() + seconds
+    errors = []
+    ops = [0] * workers
+
+    def work(idx):
+        rng = random.Random(idx)
+        try:
+            while time.monotonic() < deadline:
+                game_id = registry.reserve()
+                if game_id is None:
+                    time.sleep(0)
+                    continue
+                if rng.random() < 0.2:
+                    # Creation failed
+                    registry.release(game_id)
+                    continue
+                registry.add(_StubGame(game_id))
+                time.sleep(0)
+                if rng.random() < 0.7:
+                    registry.activate(game_id)
+                    time.sleep(0)
+                registry.remove(game_id)
+                try:
+                    registry.remove(game_id)
+                    errors.append("Double free of {} went unnoticed".format(game_id))
+                except ValueError:
+                    pass
+                registry.release(game_id)
+                ops[idx] += 1
+        except Exception as e:
+            errors.append(repr(e))
+
+    def check():
+        while time.monotonic() < deadline:
+            try:
+                check_registry_snapshot(registry.snapshot(), max_games)
+            except AssertionError as e:
+                errors.append(str(e))
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(workers)] + [threading.Thread(target=check)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = registry.snapshot()
+    check_registry_snapshot(snapshot, max_games)
+    if len(snapshot['free_ids']) != max_games:
+        errors.append("Only {} of {} ids were freed".format(len(snapshot['free_ids']), max_games))
+    print("{} game lifecycles in {}s".format(sum(ops), seconds))
+    return errors
+
+
+def stress_app(workers, seconds, game_seconds, snapshot_timeout):
+    import app as server
+
+    params = { "playerZero" : "human", "playerOne" : "human", "layouts" : ["cramped_room"], "gameTime" : game_seconds }
+    deadline = time.monotonic() + seconds
+    errors = []
+    counts = { "ops" : 0, "snapshots" : 0, "inconsistent" : 0 }
+    # Cleared by the checker every other snapshot, so that it also gets to see the server between transitions
+    running = threading.Event()
+    running.set()
+
+    def work(idx):
+        rng = random.Random(idx)
+        client = server.socketio.test_client(server.app)
+        try:
+            while time.monotonic() < deadline:
+                running.wait()
+                op = rng.random()
+                if op < 0.3:
+                    client.emit('create', { "params" : dict(params) })
+                elif op < 0.6:
+                    client.emit('join', { "params" : dict(params), "create_if_not_found" : rng.random() < 0.5 })
+                elif op < 0.85:
+                    client.emit('leave', {})
+                else:
+                    client.disconnect()
+                    client = server.socketio.test_client(server.app)
+                # Drop whatever the server sent, only the registries are checked
+                client.get_received()
+                counts['ops'] += 1
+                time.sleep(rng.random() * 0.01)
+        except Exception as e:
+            errors.append(repr(e))
+        finally:
+            client.disconnect()
+
+    def check():
+        while time.monotonic() < deadline:
+            if running.is_set():
+                running.clear()
+            else:
+                running.set()
+            # Waits longer than the debug endpoints, which would rarely find a quiet moment on a server this busy
+            snapshot, consistent = server.LIFECYCLE.snapshot(server._take_snapshot, timeout=snapshot_timeout)
+            counts['snapshots'] += 1
+            if not consistent:
+                counts['inconsistent'] += 1
+            else:
+                try:
+                    server._ensure_consistent_state(snapshot)
+                except AssertionError as e:
+                    errors.append(str(e))
+            time.sleep(0.01)
+        running.set()
+
+    threads = [threading.Thread(target=work, args=(idx,)) for idx in range(workers)] + [threading.Thread(target=check)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Every client is gone, so every game should wind down and free its id
+    drain_deadline = time.monotonic() + game_seconds + 10
+    while time.monotonic() < drain_deadline and server.REGISTRY.counts()[GameRegistry.FREE] < server.MAX_GAMES:
+        time.sleep(0.1)
+    snapshot, consistent = server.get_snapshot()
+    try:
+        server._ensure_consistent_state(snapshot)
+    except AssertionError as e:
+        errors.append(str(e))
+    if len(snapshot['free_ids']) != server.MAX_GAMES:
+        errors.append("Only {} of {} ids were freed".format(len(snapshot['free_ids']), server.MAX_GAMES))
+    if snapshot['user_rooms']:
+        errors.append("{} users still in a room".format(len(snapshot['user_rooms'])))
+    if len(server.ADMISSIONS):
+        errors.append("{} users still queued for admission".format(len(server.ADMISSIONS)))
+    if server.CAPACITY.reservations:
+        errors.append("{} capacity reservations leaked".format(len(server.CAPACITY.reservations)))
+    print("{} socket events in {}s, {} snapshots ({} inconsistent)".format(counts['ops'], seconds, counts['snapshots'], counts['inconsistent']))
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hammer the game registries from many threads and check their invariants")
+    parser.add_argument('mode', choices=['registry', 'app'], help="Stress a bare GameRegistry or the server's socket handlers")
+    parser.add_argument('--workers', type=int, default=32, help="Number of concurrent threads (or clients)")
+    parser.add_argument('--seconds', type=float, default=10, help="How long to keep hammering")
+    parser.add_argument('--max_games', type=int, default=50, help="Number of game ids (registry mode)")
+    parser.add_argument('--shards', type=int, default=16, help="Number of registry shards (registry mode)")
+    parser.add_argument('--game_seconds', type=int, default=2, help="Length of each game (app mode)")
+    parser.add_argument('--snapshot_timeout', type=float, default=1, help="Maximum time to wait for a consistent snapshot (app mode)")
+    args = parser.parse_args()
+
+    if args.mode == 'registry':
+        errors = stress_registry(args.workers, args.seconds, args.max_games, args.shards)
+    else:
+        errors = stress_app(args.workers, args.seconds, args.game_seconds, args.snapshot_timeout)
+
+    for error in sorted(set(errors)):
+        print("FAIL: {} ({} times)".format(error, errors.count(error)))
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,428 @@
+from array import array
+from collections import deque
+from itertools import islice
+from threading import Lock, Thread
+from queue import Queue
+from time import monotonic
+from overcooked_ai_py.mdp.actions import Action
+import json, logging, mmap, os, tempfile
+
+
+class TrajectoryRecorder(object):
+    """
+    Compact, columnar log of the transitions of an OvercookedPsiturk game
+
+    Values that are constant within a trial (layout, player ids, whether players are human) are stored once per trial
+    when `start_trial` is called. Every call to `record` only appends to typed per-field column buffers; states are kept
+    as references and actions as action indices. Nothing is JSON serialized until the trajectory is flushed
+
+    If `spill_dir` is set, at most `max_buffered` transitions are kept in memory. Past that, the buffered transitions are
+    handed to a background writer, which serializes them (one JSON row per line) to a spill file of their own and then
+    releases them from memory, so `record` never serializes on the tick path. Spill files are streamed back, in order,
+    and deleted once the snapshot holding them is closed
+
+    Methods:
+        - flush: Returns the trajectory in the legacy row-per-transition format and clears the recorder. Only used
+            by games without a TrajectoryStream (or at shutdown), as it builds every row at once
+        - flush_columns: Returns the in-memory trajectory as a list of per-trial columnar dicts and clears the recorder
+        - detach: Cheaply hands everything recorded so far over to a TrajectorySnapshot and clears the recorder, so
+            that serialization can happen elsewhere
+    """
+
+    def __init__(self, spill_dir=None, max_buffered=900, spill_prefix='trajectory-'):
+        self.trials = []
+        self.spill_dir = spill_dir
+        self.max_buffered = max_buffered
+        self.spill_prefix = spill_prefix
+        self.spills = []
+        self.num_buffered = 0
+        self.num_spilled = 0
+
+    def start_trial(self, trial_id, layout_name, terrain, player_ids, player_is_human):
+        self.trials.append(_Trial(trial_id, layout_name, terrain, player_ids, player_is_human))
+
+    def record(self, state, joint_action, reward, score, time_left, time_elapsed, tick):
+        self.trials[-1].record(state, joint_action, reward, score, time_left, time_elapsed, tick)
+        self.num_buffered += 1
+        if self.spill_dir and self.num_buffered >= self.max_buffered:
+            self.spill()
+
+    def __len__(self):
+        return self.num_buffered + self.num_spilled
+
+    def spill(self):
+        """
+        Hands all buffered transitions over to the background writer, which appends them to a spill file and releases
+        them from memory. Only detaches them here
+        """
+        num_rows = self.num_buffered
+        trials = self._take_trials()
+        if not trials:
+            return
+        spill = _Spill(trials, self.spill_dir, self.spill_prefix)
+        self.spills.append(spill)
+        self.num_spilled += num_rows
+        _SPILL_WRITER.put(spill)
+
+    def detach(self):
+        num_rows = len(self)
+        snapshot = TrajectorySnapshot(self._take_trials(), self.spills, num_rows)
+        self.spills = []
+        self.num_spilled = 0
+        return snapshot
+
+    def _take_trials(self):
+        # Keep the current trial open (but empty) so that subsequent records still have somewhere to go
+        trials = [trial for trial in self.trials if len(trial)]
+        self.trials = [self.trials[-1].empty_copy()] if self.trials else []
+        self.num_buffered = 0
+        return trials
+
+    def flush(self):
+        """
+        Returns the list of transition dicts accumulated since the last flush, in the format expected by psiturk
+        """
+        snapshot = self.detach()
+        try:
+            return list(snapshot.iter_rows())
+        finally:
+            snapshot.close()
+
+    def flush_columns(self):
+        """
+        Returns one JSON compatible dict per trial with all per-tick fields stored as parallel lists. Transitions that
+        have already been spilled to disk are not included, use `flush` to retrieve them
+        """
+        return [trial.to_columns() for trial in self._take_trials()]
+
+
+class TrajectorySnapshot(object):
+    """
+    Transitions detached from a TrajectoryRecorder, possibly partly spilled to disk. Rows are only serialized (or read
+    back from the spill files) while iterating. `close` must be called once the snapshot is no longer needed
+    """
+
+    def __init__(self, trials, spills, num_rows):
+        self.trials = trials
+        self.spills = spills
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def iter_rows(self):
+        for spill in self.spills:
+            for row in spill.iter_rows():
+                yield row
+        for trial in self.trials:
+            for row in trial.to_rows():
+                yield row
+
+    def close(self):
+        for spill in self.spills:
+            spill.close()
+        self.spills = []
+        self.trials = []
+
+
+class _Spill(object):
+    """
+    Transitions handed to the _SpillWriter. Read from memory until the writer is done with them, from the spill file
+    afterwards
+    """
+
+    def __init__(self, trials, spill_dir, spill_prefix):
+        self.trials = trials
+        self.spill_dir = spill_dir
+        self.spill_prefix = spill_prefix
+        self.path = None
+        self.closed = False
+        self.lock = Lock()
+
+    def write(self):
+        # Called by the writer thread only. The trials are read concurrently, but never modified, by `iter_rows`
+        with self.lock:
+            if self.closed:
+                return
+            trials = self.trials
+        os.makedirs(self.spill_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(prefix=self.spill_prefix, suffix='.jsonl', dir=self.spill_dir)
+        with os.fdopen(fd, 'w') as f:
+            for trial in trials:
+                for row in trial.to_rows():
+                    f.write(json.dumps(row))
+                    f.write('\n')
+        with self.lock:
+            if self.closed:
+                _remove(path)
+                return
+            self.path = path
+            self.trials = None
+
+    def iter_rows(self):
+        with self.lock:
+            trials, path = self.trials, self.path
+        if trials is not None:
+            for trial in trials:
+                for row in trial.to_rows():
+                    yield row
+            return
+        if not os.path.getsize(path):
+            return
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b''):
+                    yield json.loads(line)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.trials = None
+            if self.path:
+                _remove(self.path)
+            self.path = None
+
+
+class _SpillWriter(object):
+    """
+    Single background thread writing every recorder's spills, in the order they were handed over
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.lock = Lock()
+        self.thread = None
+
+    def put(self, spill):
+        with self.lock:
+            # Started lazily so that importing the module does not spawn threads
+            if not self.thread:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.queue.put(spill)
+
+    def run(self):
+        while True:
+            spill = self.queue.get()
+            try:
+                spill.write()
+            except OSError:
+                logging.getLogger(__name__).exception("Failed to spill trajectory to {}".format(spill.spill_dir))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+_SPILL_WRITER = _SpillWriter()
+
+
+class TrajectoryStream(object):
+    """
+    Streams the transitions of a TrajectoryRecorder to clients as numbered chunks of at most `chunk_rows` rows,
+    instead of one large payload at the end of every trial
+
+    Uploading is split in two so that the caller can keep its critical section short:
+        - take (call while holding the lock protecting the recorder): detaches pending transitions and reserves
+          sequence numbers for the chunks they will be sent in. With `final=True`, also closes the current segment
+          and returns its manifest, i.e. the range of chunks making up the data of the trial
+        - drain (call from anywhere): serializes and emits every taken chunk, in sequence order
+
+    Every chunk is kept until all of its recipients have acknowledged it, and is re-emitted by `retransmit` if that
+    takes longer than `ack_timeout` seconds
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, recorder, chunk_rows=300, ack_timeout=10):
+        self.recorder = recorder
+        self.chunk_rows = chunk_rows
+        self.ack_timeout = ack_timeout
+        self.lock = Lock()
+        self.send_lock = Lock()
+        self.queue = deque()
+        self.unacked = {}
+        self.next_seq = 0
+        self.segment_start = 0
+        self.segment_rows = 0
+        self.chunks_sent = 0
+        self.rows_sent = 0
+        self.retransmits = 0
+
+    def take(self, final=False):
+        snapshot = self.recorder.detach()
+        with self.lock:
+            num_chunks = -(-len(snapshot) // self.chunk_rows)
+            if num_chunks:
+                self.queue.append((self.next_seq, snapshot))
+            else:
+                snapshot.close()
+            self.next_seq += num_chunks
+            self.segment_rows += len(snapshot)
+            if not final:
+                return None
+            manifest = { "first_seq" : self.segment_start, "last_seq" : self.next_seq - 1, "num_rows" : self.segment_rows }
+            self.segment_start = self.next_seq
+            self.segment_rows = 0
+            return manifest
+
+    def drain(self, emit, recipients=()):
+        """
+        Emits all taken chunks. `emit(chunk)` is called once per chunk; `recipients` are the ids expected to ack it
+        """
+        # Held throughout so that concurrent drains can never interleave (and so reorder) their chunks
+        with self.send_lock:
+            while True:
+                with self.lock:
+                    if not self.queue:
+                        return
+                    seq, snapshot = self.queue.popleft()
+                try:
+                    rows = snapshot.iter_rows()
+                    while True:
+                        chunk_rows = list(islice(rows, self.chunk_rows))
+                        if not chunk_rows:
+                            break
+                        chunk = { "seq" : seq, "rows" : chunk_rows }
+                        with self.lock:
+                            if recipients:
+                                self.unacked[seq] = (monotonic(), chunk, set(recipients))
+                            self.chunks_sent += 1
+                            self.rows_sent += len(chunk_rows)
+                        emit(chunk)
+                        seq += 1
+                finally:
+                    snapshot.close()
+
+    def ack(self, seq, recipient):
+        with self.lock:
+            if seq not in self.unacked:
+                return
+            pending = self.unacked[seq][2]
+            pending.discard(recipient)
+            if not pending:
+                del self.unacked[seq]
+
+    def retransmit(self, emit):
+        """
+        Re-emits every chunk that has been waiting on an ack for longer than `ack_timeout`
+        """
+        now = monotonic()
+        with self.lock:
+            expired = [seq for seq, (sent_at, _, _) in self.unacked.items() if now - sent_at > self.ack_timeout]
+            chunks = []
+            for seq in sorted(expired):
+                _, chunk, pending = self.unacked[seq]
+                self.unacked[seq] = (now, chunk, pending)
+                chunks.append(chunk)
+            self.retransmits += len(chunks)
+        for chunk in chunks:
+            emit(chunk)
+
+    def has_pending(self):
+        with self.lock:
+            return bool(self.queue)
+
+    def has_unacked(self, recipients):
+        """
+        Whether any emitted chunk is still waiting on an ack from one of `recipients`
+        """
+        recipients = set(recipients)
+        with self.lock:
+            return any(pending & recipients for _, _, pending in self.unacked.values())
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "next_seq" : self.next_seq,
+                "queued_snapshots" : len(self.queue),
+                "unacked_chunks" : len(self.unacked),
+                "chunks_sent" : self.chunks_sent,
+                "rows_sent" : self.rows_sent,
+                "retransmits" : self.retransmits
+            }
+
+
+class _Trial(object):
+
+    def __init__(self, trial_id, layout_name, terrain, player_ids, player_is_human):
+        self.trial_id = trial_id
+        self.layout_name = layout_name
+        self.terrain = terrain
+        self.player_ids = list(player_ids)
+        self.player_is_human = list(player_is_human)
+        self.states = []
+        self.actions = [array('b') for _ in self.player_ids]
+        self.rewards = array('l')
+        self.scores = array('l')
+        self.time_left = array('d')
+        self.time_elapsed = array('d')
+        self.ticks = array('l')
+
+    def empty_copy(self):
+        return _Trial(self.trial_id, self.layout_name, self.terrain, self.player_ids, self.player_is_human)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def record(self, state, joint_action, reward, score, time_left, time_elapsed, tick):
+        self.states.append(state)
+        for column, action in zip(self.actions, joint_action):
+            column.append(Action.ACTION_TO_INDEX[action])
+        self.rewards.append(reward)
+        self.scores.append(score)
+        self.time_left.append(time_left)
+        self.time_elapsed.append(time_elapsed)
+        self.ticks.append(tick)
+
+    def joint_actions(self):
+        return [tuple(Action.INDEX_TO_ACTION[idx] for idx in joint_idx) for joint_idx in zip(*self.actions)]
+
+    def to_rows(self):
+        # Serialized once and shared by every row of the trial
+        layout = json.dumps(self.terrain)
+        constants = {
+            "layout" : layout,
+            "layout_name" : self.layout_name,
+            "trial_id" : self.trial_id
+        }
+        for i, (player_id, is_human) in enumerate(zip(self.player_ids, self.player_is_human)):
+            constants["player_{}_id".format(i)] = player_id
+            constants["player_{}_is_human".format(i)] = is_human
+
+        rows = []
+        for i, joint_action in enumerate(self.joint_actions()):
+            row = {
+                "state" : json.dumps(self.states[i].to_dict()),
+                "joint_action" : json.dumps(joint_action),
+                "reward" : self.rewards[i],
+                "time_left" : self.time_left[i],
+                "score" : self.scores[i],
+                "time_elapsed" : self.time_elapsed[i],
+                "cur_gameloop" : self.ticks[i]
+            }
+            row.update(constants)
+            rows.append(row)
+        return rows
+
+    def to_columns(self):
+        return {
+            "trial_id" : self.trial_id,
+            "layout_name" : self.layout_name,
+            "layout" : self.terrain,
+            "player_ids" : self.player_ids,
+            "player_is_human" : self.player_is_human,
+            "columns" : {
+                "state" : [state.to_dict() for state in self.states],
+                "joint_action" : self.joint_actions(),
+                "reward" : self.rewards.tolist(),
+                "score" : self.scores.tolist(),
+                "time_left" : self.time_left.tolist(),
+                "time_elapsed" : self.time_elapsed.tolist(),
+                "cur_gameloop" : self.ticks.tolist()
+            }
+        }
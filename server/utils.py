@@ -1,64 +1,353 @@
-from threading import Lock
+from threading import Lock, Condition
+from time import monotonic
+import multiprocessing as mp
+import sys
 
-class ThreadSafeSet(set):
 
-    def __init__(self, *args, **kwargs):
-        super(ThreadSafeSet, self).__init__(*args, **kwargs)
+class Mailbox(object):
+    """
+    Single-slot, latest-value mailbox. `put` never blocks and overwrites any value that has not been consumed yet, so
+    a slow consumer always receives the freshest value and at most one value is ever held
+
+    Instance variables:
+        - puts (int): Number of values put into the mailbox
+        - superseded (int): Number of values overwritten before any consumer took them
+        - dropped (int): Number of values discarded by `clear` before any consumer took them
+
+    Note: This class IS thread safe
+    """
+
+    _EMPTY = object()
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.value = self._EMPTY
+        self.puts = 0
+        self.superseded = 0
+        self.dropped = 0
+
+    def put(self, value):
+        with self.cond:
+            if self.value is not self._EMPTY:
+                self.superseded += 1
+            self.value = value
+            self.puts += 1
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Blocks until a value is available then takes it. Returns None if `timeout` elapses first
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.value is not self._EMPTY, timeout=timeout):
+                return None
+            value, self.value = self.value, self._EMPTY
+            return value
+
+    def clear(self):
+        with self.cond:
+            if self.value is not self._EMPTY:
+                self.dropped += 1
+            self.value = self._EMPTY
+
+    def empty(self):
+        return self.value is self._EMPTY
+
+    def get_stats(self):
+        with self.cond:
+            return { "puts" : self.puts, "superseded" : self.superseded, "dropped" : self.dropped, "pending" : self.value is not self._EMPTY }
+
+
+
+class LifecycleMonitor(object):
+    """
+    Tracks in-flight global state transitions (creating, joining, leaving and tearing down games), each of which updates
+    several registries one after the other. Transitions never wait on each other; `snapshot` waits (up to a timeout) for
+    a moment at which none of them is half done, and holds off new ones only while it copies the registries
+
+    A transition is either scoped to a block (`with monitor.transition():`) or, if it ends on another thread, bracketed
+    by `begin(key)` and `end(key)`. Both can be nested and `end` on a key that was never begun is a no-op
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self):
+        self.cond = Condition(Lock())
+        self.in_flight = set()
+        self.num_snapshots = 0
+        self.num_inconsistent = 0
+
+    def begin(self, key):
+        with self.cond:
+            self.in_flight.add(key)
+
+    def end(self, key):
+        with self.cond:
+            self.in_flight.discard(key)
+            if not self.in_flight:
+                self.cond.notify_all()
+
+    def transition(self):
+        return _Transition(self)
+
+    def snapshot(self, take, timeout=None):
+        """
+        Calls `take()` once no transition is in flight and returns (result, consistent). If transitions are still in
+        flight after `timeout` seconds, `take` is called anyway and `consistent` is False
+        """
+        with self.cond:
+            consistent = self.cond.wait_for(lambda: not self.in_flight, timeout=timeout)
+            self.num_snapshots += 1
+            if not consistent:
+                self.num_inconsistent += 1
+            return take(), consistent
+
+    def get_stats(self):
+        with self.cond:
+            return { "in_flight" : len(self.in_flight), "snapshots" : self.num_snapshots, "inconsistent_snapshots" : self.num_inconsistent }
+
+
+class _Transition(object):
+
+    def __init__(self, monitor):
+        self.monitor = monitor
+
+    def __enter__(self):
+        self.monitor.begin(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.monitor.end(self)
+
+
+
+class StateDeltaEncoder(object):
+    """
+    Encodes successive `Game.get_state()` payloads for a single room as a stream of keyframes and deltas
+
+    Each call to `encode` returns a payload with a monotonically increasing `seq` number. Keyframes carry the
+    full state, while deltas only carry top-level values that changed along with the changed players and objects
+    of the nested overcooked state. A keyframe is emitted every `keyframe_interval` payloads, on the first call,
+    and whenever `request_keyframe` has been called (i.e. on client resync or game reset)
+
+    Note: This class IS thread safe
+    """
+
+    def __init__(self, keyframe_interval=30):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.last_state = None
+        self.needs_keyframe = True
         self.lock = Lock()
-        
 
-    def add(self, *args):
+    def request_keyframe(self):
+        """
+        Force the next call to `encode` to return a full keyframe
+        """
         with self.lock:
-            retval = super(ThreadSafeSet, self).add(*args)
-        return retval
+            self.needs_keyframe = True
 
-    def clear(self, *args):
+    def encode(self, state):
+        """
+        Returns the `state_pong` payload for `state`, relative to the previously encoded state
+        """
         with self.lock:
-            retval = super(ThreadSafeSet, self).clear(*args)
-        return retval
+            self.seq += 1
+            is_keyframe = self.needs_keyframe or self.last_state is None
+            if self.keyframe_interval and self.seq % self.keyframe_interval == 0:
+                is_keyframe = True
 
-    def pop(self, *args):
-        with self.lock:
-            if len(self):
-                retval = super(ThreadSafeSet, self).pop(*args)
+            if is_keyframe:
+                payload = { "seq" : self.seq, "keyframe" : True, "state" : state }
             else:
-                retval = None
-        return retval
+                payload = { "seq" : self.seq, "keyframe" : False, "delta" : _diff_game_state(self.last_state, state) }
 
-    def remove(self, item):
-        with self.lock:
-            if item in self:
-                retval = super(ThreadSafeSet, self).remove(item)
-            else:
-                retval = None
-        return retval
+            # `get_state` builds a fresh dict every call so it is safe to hold on to a reference
+            self.last_state = state
+            self.needs_keyframe = False
+        return payload
 
-class ThreadSafeDict(dict):
 
-    def __init__(self, *args, **kwargs):
-        super(ThreadSafeDict, self).__init__(*args, **kwargs)
-        self.lock = Lock()
+def _diff_dict(prev, curr, nested=()):
+    """
+    Returns ({key : value}, [removed_keys]) for all keys of `curr` not in `nested` whose value differs from `prev`
+    """
+    changed = { key : val for key, val in curr.items() if key not in nested and (key not in prev or prev[key] != val) }
+    removed = [key for key in prev if key not in curr]
+    return changed, removed
 
-    def clear(self, *args, **kwargs):
-        with self.lock:
-            retval = super(ThreadSafeDict, self).clear(*args, **kwargs)
-        return retval
+def _diff_game_state(prev, curr):
+    """
+    Diff two `get_state` dicts. The nested overcooked `state` (if present) is diffed player-by-player and object-by-object
+    """
+    nested = ('state',) if isinstance(prev.get('state'), dict) and isinstance(curr.get('state'), dict) else ()
+    changed, removed = _diff_dict(prev, curr, nested)
+    delta = { "changed" : changed, "removed" : removed }
+    if nested:
+        delta['state'] = _diff_overcooked_state(prev['state'], curr['state'])
+    return delta
 
-    def pop(self, *args, **kwargs):
-        with self.lock:
-            retval = super(ThreadSafeDict, self).pop(*args, **kwargs)
-        return retval
+def _diff_overcooked_state(prev, curr):
+    per_item = tuple(key for key in ('players', 'objects') if isinstance(prev.get(key), list) and isinstance(curr.get(key), list))
+    if 'players' in per_item and len(prev['players']) != len(curr['players']):
+        # Player count changed, fall back to sending the whole list
+        per_item = tuple(key for key in per_item if key != 'players')
+    changed, removed = _diff_dict(prev, curr, per_item)
+    delta = { "changed" : changed, "removed" : removed }
 
-    def __setitem__(self, *args, **kwargs):
-        with self.lock:
-            retval = super(ThreadSafeDict, self).__setitem__(*args, **kwargs)
-        return retval
+    if 'players' in per_item:
+        delta['players'] = { idx : player for idx, (prev_player, player) in enumerate(zip(prev['players'], curr['players'])) if prev_player != player }
 
-    def __delitem__(self, item):
-        with self.lock:
-            if item in self:
-                retval = super(ThreadSafeDict, self).__delitem__(item)
-            else:
-                retval = None
-        return retval
+    if 'objects' in per_item:
+        # Objects are uniquely identified by their position on the grid
+        prev_objects = { _position_key(obj) : obj for obj in prev['objects'] }
+        curr_objects = { _position_key(obj) : obj for obj in curr['objects'] }
+        delta['objects'] = {
+            "set" : [obj for key, obj in curr_objects.items() if prev_objects.get(key) != obj],
+            "removed" : [list(key) for key in prev_objects if key not in curr_objects]
+        }
+    return delta
+
+def _position_key(obj):
+    return tuple(obj['position'])
+
+
+class TickClock(object):
+    """
+    Fixed-timestep pacing for a single game loop. Ticks are scheduled against absolute deadlines
+    (start + n / fps) rather than by sleeping 1/fps after each tick, so the time spent ticking and
+    broadcasting does not accumulate as drift
+
+    Policies for handling overrun (i.e. waking up after one or more deadlines already passed):
+        - 'catch_up': Run all missed simulation steps back-to-back (at most `max_catch_up` per wakeup)
+                      and broadcast once afterwards
+        - 'skip_broadcasts': Run one simulation step per wakeup but skip the broadcast and the sleep
+                      while behind schedule, so the loop catches up as fast as the CPU allows
+        - 'sleep': Legacy behavior, sleep 1/fps after every tick regardless of how long the tick took
+
+    If the loop falls more than `max_catch_up` steps behind, the missed deadlines are dropped and the
+    schedule is re-anchored so that the `max_catch_up` steps run now end on the current time
+    """
+
+    POLICIES = ('catch_up', 'skip_broadcasts', 'sleep')
+
+    def __init__(self, fps=30, policy='catch_up', max_catch_up=5):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown tick policy {}".format(policy))
+        self.period = 1 / fps
+        self.fps = fps
+        self.policy = policy
+        self.max_catch_up = max(1, int(max_catch_up))
+        self.restart()
+
+    def restart(self):
+        """
+        Re-anchor the schedule so the next tick is due immediately. Called at start of play and after pauses (i.e. resets)
+        """
+        self.next_deadline = monotonic()
+        self.start_time = self.next_deadline
+        self.paused_time = 0
+        self.num_steps = 0
+        self.num_overruns = 0
+        self.num_dropped = 0
+        self.num_skipped_broadcasts = 0
+        self.max_overrun = 0
+
+    def pause(self, duration):
+        """
+        Shift the schedule by `duration` seconds without counting the pause against the achieved tick rate
+        """
+        self.next_deadline = monotonic() + duration
+        self.paused_time += duration
+
+    def steps_due(self):
+        """
+        Returns the number of simulation steps that should be run now and advances the schedule accordingly
+        """
+        now = monotonic()
+        if self.policy == 'sleep':
+            self.num_steps += 1
+            return 1
+
+        overrun = now - self.next_deadline
+        if overrun > self.period:
+            self.num_overruns += 1
+            self.max_overrun = max(self.max_overrun, overrun)
+
+        missed = int(max(overrun, 0) // self.period) + 1
+        if missed > self.max_catch_up:
+            # Too far behind to catch up, drop the backlog rather than bursting. The steps that are run are the latest
+            # missed ones, so the schedule neither runs ahead of wall time nor stalls afterwards
+            self.num_dropped += missed - self.max_catch_up
+            self.next_deadline = now - (self.max_catch_up - 1) * self.period
+            missed = self.max_catch_up
+
+        steps = missed if self.policy == 'catch_up' else 1
+        self.next_deadline += steps * self.period
+        self.num_steps += steps
+        return steps
+
+    def should_broadcast(self):
+        """
+        Whether the state resulting from the latest steps should be sent to clients
+        """
+        if self.policy == 'skip_broadcasts' and monotonic() > self.next_deadline:
+            self.num_skipped_broadcasts += 1
+            return False
+        return True
+
+    def wait_time(self):
+        """
+        Number of seconds to sleep until the next tick is due
+        """
+        if self.policy == 'sleep':
+            # Still honours `pause` (i.e. the reset timeout), as the legacy loop did
+            return max(self.next_deadline - monotonic(), self.period)
+        return max(self.next_deadline - monotonic(), 0)
+
+    def next_tick_time(self):
+        """
+        Absolute (`time.monotonic`) time at which the next tick is due
+        """
+        return monotonic() + self.wait_time()
+
+    @property
+    def tick_rate(self):
+        """
+        Achieved simulation steps per second of (unpaused) play
+        """
+        elapsed = monotonic() - self.start_time - self.paused_time
+        return self.num_steps / elapsed if elapsed > 0 else 0
+
+    def get_stats(self):
+        return {
+            "policy" : self.policy,
+            "target_fps" : self.fps,
+            "tick_rate" : self.tick_rate,
+            "steps" : self.num_steps,
+            "overruns" : self.num_overruns,
+            "max_overrun" : self.max_overrun,
+            "dropped_steps" : self.num_dropped,
+            "skipped_broadcasts" : self.num_skipped_broadcasts
+        }
+
+
+def start_spawned_process(target, *args):
+    """
+    Starts `target(*args)` in a new daemonic process using the 'spawn' start method, so it inherits neither the
+    server's eventlet hub nor its sockets. Returns the process
 
+    'spawn' normally re-runs the main module (i.e. app.py, which monkey patches eventlet and sets up the whole server)
+    in the child. The main module is hidden while the process starts so that the child only imports what `target`
+    needs, which must therefore not be defined in the main module
+    """
+    main = sys.modules['__main__']
+    hidden = { name : getattr(main, name) for name in ('__spec__', '__file__') if hasattr(main, name) }
+    main.__spec__ = None
+    main.__dict__.pop('__file__', None)
+    try:
+        process = mp.get_context('spawn').Process(target=target, args=args, daemon=True)
+        process.start()
+    finally:
+        main.__dict__.update(hidden)
+    return process